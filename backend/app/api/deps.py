@@ -1,9 +1,18 @@
 from typing import Generator
-from app.db.session import SessionLocal
+from app.services.jobs import RecommendationJobManager, job_manager
+from app.services.recommendation_store import RecommendationStore, recommendation_store
 
 def get_db() -> Generator:
+    # Imported here so the read API never loads SQLAlchemy unless an endpoint needs a session
+    from app.db.session import SessionLocal
     try:
         db = SessionLocal()
         yield db
     finally:
         db.close()
+
+def get_recommendation_store() -> RecommendationStore:
+    return recommendation_store
+
+def get_job_manager() -> RecommendationJobManager:
+    return job_manager
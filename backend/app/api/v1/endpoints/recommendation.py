@@ -1,16 +1,70 @@
-from fastapi import APIRouter, HTTPException
-from app.db.mongo import mongo_db
-from typing import Any
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response, status
+from app.api.deps import get_job_manager, get_recommendation_store
+from app.core.config import settings
+from app.schemas.job import RecommendationJobStatus
+from app.services.jobs import RecommendationJobManager
+from app.services.recommendation_store import RecommendationStore
+from typing import Any, Optional
 
 router = APIRouter()
 
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    # Weak comparison, as required for If-None-Match
+    return "*" in candidates or etag in (tag[2:] if tag.startswith("W/") else tag for tag in candidates)
+
 @router.get("/recommendations/{user_id}", response_model=Any)
-def read_recommendation(user_id: str):
+async def read_recommendation(
+    user_id: str,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    recommendation_store: RecommendationStore = Depends(get_recommendation_store),
+):
     """
     Get existing recommendation for a user from MongoDB.
+    Returns 304 when the client's If-None-Match ETag is still current.
     """
-    
-    result = mongo_db.collection.find_one({"user_id": user_id}, {"_id": 0})
-    if not result:
+    found = await recommendation_store.get(user_id)
+    if not found:
         raise HTTPException(status_code=404, detail="User recommendation not found")
+
+    result, etag = found
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
     return result
+
+@router.post(
+    "/recommendations/{user_id}/refresh",
+    response_model=RecommendationJobStatus,
+    status_code=status.HTTP_202_ACCEPTED,
+)
+async def refresh_recommendation(
+    user_id: str,
+    job_manager: RecommendationJobManager = Depends(get_job_manager),
+):
+    """
+    Compute a fresh recommendation for a user in the background.
+    Concurrent refreshes for the same user share a single pipeline run and job id.
+    """
+    job, coalesced = job_manager.submit(user_id)
+    return RecommendationJobStatus(**job.to_dict(), coalesced=coalesced)
+
+@router.get("/recommendations/jobs/{job_id}", response_model=RecommendationJobStatus)
+async def read_recommendation_job(
+    job_id: str,
+    wait: float = Query(0, ge=0, description="Seconds to long-poll for the job to finish."),
+    job_manager: RecommendationJobManager = Depends(get_job_manager),
+):
+    """
+    Poll an on-demand recommendation job; with `wait`, block until it finishes or the wait expires.
+    """
+    job = job_manager.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Recommendation job not found")
+
+    await job_manager.wait(job, min(wait, settings.JOB_MAX_WAIT_SECONDS))
+    return RecommendationJobStatus(**job.to_dict())
@@ -0,0 +1,95 @@
+import random
+from datetime import date
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.orm import Session, sessionmaker
+from app.db.base_class import Base
+from app.models.mutual_funds import SIPTransaction, SIPInstallments, SIPSchedule, MutualFundSchemes
+
+SCHEME_PREFIXES = ["HDFC", "ICICI Prudential", "SBI", "Axis", "Kotak", "Nippon India", "Parag Parikh", "Mirae Asset"]
+SCHEME_TYPES = ["Flexi Cap", "Large Cap", "Mid Cap", "Small Cap", "Nifty 50 Index", "ELSS Tax Saver", "Balanced Advantage"]
+
+
+def create_sqlite_session(url: str = "sqlite://") -> Session:
+    """
+    Create all tables on a (by default in-memory) SQLite database and return a session.
+    The connection is shared across threads so worker pools see the same data.
+    """
+    engine = create_engine(url, connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+
+
+def seed_portfolios(
+    db: Session,
+    users: int,
+    sips_per_user: int = 4,
+    installments_per_sip: int = 24,
+    schemes: int = 200,
+    missing_totals_ratio: float = 0.0,
+    stopped_ratio: float = 0.1,
+    seed: int = 42,
+) -> None:
+    """
+    Seed a synthetic portfolio dataset: `users` users, each holding `sips_per_user`
+    SIPs drawn from a universe of `schemes` schemes, each SIP with its schedule and
+    `installments_per_sip` monthly installments. Installments of a scheme follow
+    one NAV series (within a few percent, as NAVs move during a month). Active
+    SIPs ran until this month and are next due next month; a `stopped_ratio`
+    share stopped earlier and has no next due date. A `missing_totals_ratio`
+    share of schedules has no totals, to exercise the installment fallback.
+    """
+    rng = random.Random(seed)
+    today = date.today()
+    next_due = date(today.year + today.month // 12, today.month % 12 + 1, 1)
+
+    scheme_rows, nav_series = [], {}
+    for i in range(schemes):
+        name = f"{SCHEME_PREFIXES[i % len(SCHEME_PREFIXES)]} {SCHEME_TYPES[i % len(SCHEME_TYPES)]} Fund {i // len(SCHEME_TYPES)} - Direct Growth"
+        scheme_rows.append({"id": i + 1, "scheme_code": f"MF{i + 1:05d}", "scheme_name": name})
+        # Monthly NAVs, oldest first, ending this month
+        base_nav, growth = rng.uniform(10, 500), rng.uniform(-0.005, 0.02)
+        months = installments_per_sip + 24
+        nav_series[scheme_rows[-1]["scheme_code"]] = [base_nav * (1 + growth) ** m for m in range(months)]
+    db.bulk_insert_mappings(MutualFundSchemes, scheme_rows)
+
+    txn_rows, schedule_rows, installment_rows = [], [], []
+    sip_id = 0
+    for u in range(users):
+        user_id = f"user-{u:06d}"
+        for scheme in rng.sample(scheme_rows, min(sips_per_user, schemes)):
+            sip_id += 1
+            amount = float(rng.choice([500, 1000, 2000, 2500, 5000, 10000]))
+            stopped = rng.random() < stopped_ratio
+            series = nav_series[scheme["scheme_code"]]
+            end = len(series) - (rng.randint(3, 24) if stopped else 0)
+
+            units_total = 0.0
+            for month_nav in series[end - installments_per_sip:end]:
+                nav = round(month_nav * (1 + rng.uniform(-0.02, 0.02)), 4)
+                units = round(amount / nav, 4)
+                units_total += units
+                installment_rows.append({
+                    "sip_id": sip_id, "amount": amount, "nav": nav, "units": units, "status": "SUCCESS",
+                })
+
+            txn_rows.append({
+                "id": sip_id, "user_id": user_id, "scheme_code": scheme["scheme_code"],
+                "amount": amount, "units": round(units_total, 4), "txn_type": "SIP",
+                "txn_status": "STOPPED" if stopped else "ACTIVE",
+            })
+
+            has_totals = rng.random() >= missing_totals_ratio
+            schedule_rows.append({
+                "id": sip_id,
+                "sip_id": sip_id,
+                "total_invested_amount": amount * installments_per_sip if has_totals else None,
+                "total_units_allocated": round(units_total, 4) if has_totals else None,
+                "completed_installments": installments_per_sip,
+                "next_due_date": None if stopped else next_due.replace(day=rng.randint(1, 28)),
+            })
+
+    db.bulk_insert_mappings(SIPTransaction, txn_rows)
+    db.bulk_insert_mappings(SIPSchedule, schedule_rows)
+    db.bulk_insert_mappings(SIPInstallments, installment_rows)
+    db.commit()
@@ -0,0 +1,303 @@
+"""
+Local stand-ins for the external services, so pipeline benchmarks never
+call (or pay for) the real providers:
+
+* `FakePerplexityServer`: a local HTTP server speaking the chat-completions
+  format. `MarketDataService` talks to it over its real pooled session /
+  httpx client, so pooling, batching, retries and caching are all exercised.
+* `FakeGeminiClient`: drop-in for `genai.Client` (`models` and `aio.models`).
+* `InMemoryMongo`: just enough of pymongo's collection API for the batch
+  engine, checkpoints and persistent caches.
+
+Latency is drawn from a lognormal distribution given its median and p95,
+and a configurable share of calls fails with a retryable 503.
+"""
+import asyncio
+import copy
+import json
+import math
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+from app.utils.common import extract_json
+
+CATEGORIES = ["Equity: Flexi Cap", "Equity: Large Cap", "Equity: Mid Cap", "Equity: Small Cap", "Hybrid: Balanced Advantage"]
+RISK_LEVELS = ["Moderate", "Moderately High", "High", "Very High"]
+
+
+class LatencyModel:
+    """
+    Lognormal latency with the given median and 95th percentile (seconds),
+    plus an error rate. Seeded, so runs are reproducible.
+    """
+
+    def __init__(self, median: float, p95: float, error_rate: float = 0.0, seed: int = 0):
+        self.median = max(median, 0.0)
+        self.sigma = math.log(p95 / median) / 1.6449 if median > 0 and p95 > median else 0.0
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self) -> float:
+        if self.median <= 0:
+            return 0.0
+        with self._lock:
+            return self.median * math.exp(self._rng.gauss(0, self.sigma))
+
+    def should_fail(self) -> bool:
+        with self._lock:
+            return self._rng.random() < self.error_rate
+
+
+def fake_fund(name: str) -> Dict[str, Any]:
+    """Deterministic, schema-valid fund details for `name`."""
+    rng = random.Random(zlib.crc32(name.encode()))
+    return {
+        "name": name,
+        "category": rng.choice(CATEGORIES),
+        "nav": f"{rng.uniform(10, 900):.2f}",
+        "aum": f"{rng.randint(500, 90000)} Cr",
+        "returns": {"1Y": f"{rng.uniform(-5, 35):.1f}%", "3Y": f"{rng.uniform(5, 25):.1f}%", "5Y": f"{rng.uniform(8, 22):.1f}%"},
+        "risk_level": rng.choice(RISK_LEVELS),
+        "resource_url": f"https://example.com/funds/{zlib.crc32(name.encode())}",
+    }
+
+
+class FakePerplexityServer:
+    """
+    Threaded HTTP server answering single-fund and batch fetch prompts with
+    deterministic fund details, after a sampled delay.
+    """
+
+    SINGLE_PATTERN = re.compile(r'data for: "(.*)"')
+    BATCH_PATTERN = re.compile(r"EACH of these funds:\s*(\[.*?\])\s*\n", re.S)
+
+    def __init__(self, latency: LatencyModel):
+        self.latency = latency
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/chat/completions"
+
+    def start(self) -> "FakePerplexityServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-perplexity", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def answer(self, prompt: str) -> Dict[str, Any]:
+        batch = self.BATCH_PATTERN.search(prompt)
+        if batch:
+            names = json.loads(batch.group(1))
+            content = {"funds": [dict(fake_fund(n), requested_name=n, found=True) for n in names]}
+        else:
+            single = self.SINGLE_PATTERN.search(prompt)
+            content = fake_fund(single.group(1) if single else "Unknown Fund")
+        text = json.dumps(content)
+        return {
+            "choices": [{"message": {"content": text}}],
+            "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(text) // 4},
+        }
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                time.sleep(server.latency.sample())
+                with server._lock:
+                    server.requests += 1
+                    failed = server.latency.should_fail()
+                    server.errors += failed
+                if failed:
+                    self._send(503, {"error": "simulated overload"})
+                else:
+                    self._send(200, server.answer(body["messages"][-1]["content"]))
+
+            def _send(self, status: int, payload: dict) -> None:
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args) -> None:
+                pass
+
+        return Handler
+
+
+class FakeProviderError(Exception):
+    """Retryable provider error; `code` is read like google-genai's APIError."""
+
+    def __init__(self, code: int = 503):
+        super().__init__(f"simulated provider error {code}")
+        self.code = code
+
+
+class FakeGeminiClient:
+    """
+    Stand-in for `genai.Client`: recommends funds from the prompt's candidate
+    shortlist (or from `fund_names` without one) and enriches the payload
+    embedded in the prompt, after a sampled delay. Prompt sizes are kept
+    per kind of call.
+    """
+
+    CANDIDATES_PATTERN = re.compile(r"Candidates .*?:\n(\[.*\])\n", re.S)
+
+    def __init__(self, latency: LatencyModel, fund_names: List[str]):
+        self.latency = latency
+        self.fund_names = fund_names
+        self.requests = 0
+        self.errors = 0
+        self.prompt_chars: Dict[str, List[int]] = defaultdict(list)
+        self._lock = threading.Lock()
+        self.models = SimpleNamespace(generate_content=self._generate)
+        self.aio = SimpleNamespace(models=SimpleNamespace(generate_content=self._generate_async))
+
+    def _answer(self, prompt: str) -> SimpleNamespace:
+        payload = extract_json(prompt)
+        enrich = isinstance(payload, dict) and "recommended_funds" in payload
+        with self._lock:
+            self.requests += 1
+            self.prompt_chars["enrich" if enrich else "recommend"].append(len(prompt))
+            failed = self.latency.should_fail()
+            self.errors += failed
+        if failed:
+            raise FakeProviderError()
+
+        if enrich:
+            recommended = [
+                dict(fund, pros=["Consistent long-term returns"], cons=["Higher expense ratio"])
+                for fund in payload["recommended_funds"]
+            ]
+            content = {
+                "user_fund_details": payload.get("user_fund_details", []),
+                "recommendations": recommended,
+                "ranking": [fund.get("name") for fund in recommended[:3]],
+            }
+        else:
+            rng = random.Random(zlib.crc32(prompt.encode()))
+            shortlist = self.CANDIDATES_PATTERN.search(prompt)
+            names = [row[0] for row in json.loads(shortlist.group(1))] if shortlist else self.fund_names
+            content = {"recommended_fund_names": rng.sample(names, min(5, len(names)))}
+
+        text = json.dumps(content)
+        usage = SimpleNamespace(prompt_token_count=len(prompt) // 4, candidates_token_count=len(text) // 4)
+        return SimpleNamespace(text=text, usage_metadata=usage)
+
+    def _generate(self, model: str, contents: str, config: Any = None) -> SimpleNamespace:
+        time.sleep(self.latency.sample())
+        return self._answer(contents)
+
+    async def _generate_async(self, model: str, contents: str, config: Any = None) -> SimpleNamespace:
+        await asyncio.sleep(self.latency.sample())
+        return self._answer(contents)
+
+
+class InMemoryCollection:
+    """
+    Thread-safe subset of a pymongo collection: equality, `$in` and `$gt`
+    filters, `$set`/`$setOnInsert`/`$inc` updates and `UpdateOne` bulk writes.
+    """
+
+    def __init__(self):
+        self._docs: Dict[Any, dict] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _matches(doc: dict, query: dict) -> bool:
+        for field, condition in query.items():
+            value = doc.get(field)
+            if isinstance(condition, dict):
+                if "$in" in condition and value not in condition["$in"]:
+                    return False
+                if "$gt" in condition and (value is None or not value > condition["$gt"]):
+                    return False
+            elif value != condition:
+                return False
+        return True
+
+    @staticmethod
+    def _project(doc: dict, projection: Optional[dict]) -> dict:
+        doc = copy.deepcopy(doc)
+        if not projection:
+            return doc
+        fields = [f for f, keep in projection.items() if keep and f != "_id"]
+        projected = {f: doc[f] for f in fields if f in doc}
+        if projection.get("_id", 1) and "_id" in doc:
+            projected["_id"] = doc["_id"]
+        return projected
+
+    def create_index(self, *args, **kwargs) -> str:
+        return "in-memory"
+
+    def find(self, query: Optional[dict] = None, projection: Optional[dict] = None) -> List[dict]:
+        with self._lock:
+            return [self._project(d, projection) for d in self._docs.values() if self._matches(d, query or {})]
+
+    def find_one(self, query: Optional[dict] = None, projection: Optional[dict] = None, sort=None) -> Optional[dict]:
+        docs = self.find(query, projection)
+        if sort:
+            for field, direction in reversed(sort):
+                docs.sort(key=lambda d: d.get(field), reverse=direction < 0)
+        return docs[0] if docs else None
+
+    def update_one(self, query: dict, update: dict, upsert: bool = False) -> None:
+        with self._lock:
+            self._update(query, update, upsert)
+
+    def _update(self, query: dict, update: dict, upsert: bool) -> None:
+        doc = next((d for d in self._docs.values() if self._matches(d, query)), None)
+        if doc is None:
+            if not upsert:
+                return
+            doc = {k: v for k, v in query.items() if not isinstance(v, dict)}
+            doc.setdefault("_id", doc.get("user_id", len(self._docs)))
+            doc.update(copy.deepcopy(update.get("$setOnInsert", {})))
+            self._docs[doc["_id"]] = doc
+        doc.update(copy.deepcopy(update.get("$set", {})))
+        for field, amount in update.get("$inc", {}).items():
+            doc[field] = doc.get(field, 0) + amount
+
+    def bulk_write(self, operations: list, ordered: bool = True) -> None:
+        with self._lock:
+            for op in operations:
+                # pymongo's UpdateOne keeps its arguments in private slots
+                self._update(op._filter, op._doc, op._upsert)
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+
+class InMemoryMongo:
+    """`db[name]` returns a lazily created InMemoryCollection."""
+
+    def __init__(self):
+        self._collections: Dict[str, InMemoryCollection] = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name: str) -> InMemoryCollection:
+        with self._lock:
+            return self._collections.setdefault(name, InMemoryCollection())
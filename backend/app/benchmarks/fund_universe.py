@@ -0,0 +1,103 @@
+"""
+Lookup throughput and accuracy of the fund-universe index on a synthetic
+scheme master with LLM-style name variations. Besides names of indexed
+schemes, it looks up schemes held out of the index and names without plan
+and option; any match for those is a wrong (or arbitrary) scheme.
+
+    python -m app.benchmarks.fund_universe --schemes 20000 --queries 5000
+    python -m app.benchmarks.fund_universe --min-score 0.6 --min-margin 0
+"""
+import argparse
+import random
+import time
+from app.benchmarks.dataset import SCHEME_PREFIXES, SCHEME_TYPES
+from app.core.config import settings
+from app.services.fund_universe import FundUniverseIndex
+
+PLANS = ["Direct Plan", "Regular Plan"]
+OPTIONS = ["Growth", "IDCW"]
+
+
+def scheme_names(count: int):
+    names = []
+    i = 0
+    while len(names) < count:
+        series = f" {i // (len(SCHEME_PREFIXES) * len(SCHEME_TYPES))}" if i >= len(SCHEME_PREFIXES) * len(SCHEME_TYPES) else ""
+        base = f"{SCHEME_PREFIXES[i % len(SCHEME_PREFIXES)]} {SCHEME_TYPES[(i // len(SCHEME_PREFIXES)) % len(SCHEME_TYPES)]} Fund{series}"
+        for plan in PLANS:
+            for option in OPTIONS:
+                names.append(f"{base} - {plan} - {option}")
+        i += 1
+    return names[:count]
+
+
+def vary(name: str, rng: random.Random) -> str:
+    """How LLMs tend to restate a scheme name."""
+    choice = rng.random()
+    if choice < 0.25:
+        return name.upper()
+    if choice < 0.5:
+        return name.replace(" - ", " ").replace("Plan", "").replace("  ", " ")
+    if choice < 0.7:
+        return name.replace("Direct Plan", "Direct").replace("Regular Plan", "Regular").replace(" Fund", "")
+    if choice < 0.85:
+        i = rng.randrange(len(name) - 1)
+        return name[:i] + name[i + 1] + name[i] + name[i + 2:]  # transposed letters
+    return name.replace("&", "and").replace("Fund", "Fund,")
+
+
+def without_plan(name: str) -> str:
+    """The scheme name alone, e.g. "HDFC Flexi Cap Fund"; it fits all four plan/option variants."""
+    return name.split(" - ")[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--schemes", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=5000)
+    parser.add_argument("--held-out", type=float, default=0.1, help="Share of schemes left out of the index")
+    parser.add_argument("--min-score", type=float, default=settings.FUND_UNIVERSE_MIN_SCORE)
+    parser.add_argument("--min-margin", type=float, default=settings.FUND_UNIVERSE_MIN_MARGIN)
+    args = parser.parse_args()
+
+    rng = random.Random(3)
+    names = scheme_names(args.schemes)
+    rows = [(i + 1, f"MF{i + 1:06d}", name) for i, name in enumerate(names)]
+    held_out = set(rng.sample(range(len(rows)), int(len(rows) * args.held_out)))
+    indexed = [i for i in range(len(rows)) if i not in held_out]
+
+    index = FundUniverseIndex(min_score=args.min_score, min_margin=args.min_margin)
+    start = time.perf_counter()
+    index.load_rows(rows[i] for i in indexed)
+    build_seconds = time.perf_counter() - start
+
+    targets = [rng.choice(indexed) for _ in range(args.queries)]
+    queries = [vary(names[t], rng) for t in targets]
+
+    start = time.perf_counter()
+    matches = [index.resolve(q) for q in queries]
+    cold_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for q in queries:
+        index.resolve(q)
+    warm_seconds = time.perf_counter() - start
+
+    correct = sum(1 for t, m in zip(targets, matches) if m and m.scheme_code == rows[t][1])
+    unmatched = sum(1 for m in matches if m is None)
+    absent = [vary(names[t], rng) for t in sorted(held_out)[:args.queries]]
+    absent_matched = sum(1 for q in absent if index.resolve(q))
+    planless = list(dict.fromkeys(without_plan(names[t]) for t in targets))
+    planless_matched = sum(1 for q in planless if index.resolve(q))
+
+    print(f"Schemes: {len(indexed)} indexed, {len(held_out)} held out | build {build_seconds:.2f}s | "
+          f"{index.stats()['trigrams']} trigrams | min score {args.min_score}, margin {args.min_margin}")
+    print(f"Cold lookups: {args.queries / cold_seconds:,.0f}/s | warm (cached): {args.queries / warm_seconds:,.0f}/s")
+    print(f"Indexed schemes: {correct / args.queries:.1%} correct, {unmatched} unmatched, "
+          f"{args.queries - correct - unmatched} wrong scheme")
+    print(f"Held-out schemes: {absent_matched} of {len(absent)} matched to another scheme")
+    print(f"Names without plan/option: {planless_matched} of {len(planless)} matched to an arbitrary variant")
+
+
+if __name__ == "__main__":
+    main()
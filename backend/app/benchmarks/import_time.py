@@ -0,0 +1,109 @@
+"""
+Startup-time budget check. Imports each entrypoint in a fresh interpreter
+under `python -X importtime`, without API keys in the environment, and
+fails when it is slower than its budget or loads a module it should not
+(e.g. the read API loading google-genai, the batch job loading FastAPI).
+
+    python -m app.benchmarks.import_time
+    python -m app.benchmarks.import_time --runs 5 --top 15
+
+Exits with status 1 on any violation, so it can gate CI.
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+from typing import Dict, List, NamedTuple, Tuple
+
+# Lines look like "import time:  self [us] | cumulative | <indent>package"
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$")
+
+
+class Entrypoint(NamedTuple):
+    module: str
+    budget_seconds: float
+    forbidden: Tuple[str, ...]
+
+
+ENTRYPOINTS = [
+    # Read API: the pipeline is loaded by the first refresh job
+    Entrypoint("app.main", 1.0, ("google.genai", "sqlalchemy", "pymysql", "numpy", "httpx", "tenacity")),
+    # Batch job: pipeline only, no web framework
+    Entrypoint("app.scripts.process_all_users", 1.5, ("fastapi", "starlette", "google.genai")),
+]
+
+
+def measure(module: str) -> Tuple[float, Dict[str, float], List[Tuple[str, float]]]:
+    """
+    Import `module` in a fresh interpreter. Returns its cumulative import
+    time, the cumulative time of every module loaded and the module's
+    direct imports with their cumulative times.
+    """
+    env = {k: v for k, v in os.environ.items() if not k.endswith("_API_KEY")}
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, env=env, cwd=os.getcwd(),
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{proc.stderr[-2000:]}")
+
+    loaded: Dict[str, float] = {}
+    children: List[Tuple[str, float]] = []
+    direct: List[Tuple[str, float]] = []
+    for line in proc.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        cumulative = int(match.group(2)) / 1e6
+        depth = (len(match.group(3)) - 1) // 2
+        name = match.group(4)
+        loaded[name] = cumulative
+        # A module is reported after its imports, one indent level deeper
+        if depth == 1:
+            children.append((name, cumulative))
+        elif depth == 0:
+            if name == module:
+                direct = children
+            children = []
+    return loaded.get(module, 0.0), loaded, direct
+
+
+def check(entry: Entrypoint, runs: int, top: int) -> List[str]:
+    # The fastest run is the least disturbed by disk cache and scheduler noise
+    results = [measure(entry.module) for _ in range(max(runs, 1))]
+    seconds, loaded, direct = min(results, key=lambda r: r[0])
+
+    print(f"{entry.module}: {seconds:.3f}s (budget {entry.budget_seconds:.1f}s, best of {len(results)})")
+    for name, cumulative in sorted(direct, key=lambda t: t[1], reverse=True)[:top]:
+        print(f"    {cumulative:7.3f}s  {name}")
+
+    violations = []
+    if seconds > entry.budget_seconds:
+        violations.append(f"{entry.module} took {seconds:.3f}s, over its {entry.budget_seconds:.1f}s budget")
+    for name in entry.forbidden:
+        if name in loaded:
+            violations.append(f"{entry.module} imports {name}")
+    return violations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3, help="Fresh interpreters per entrypoint; the fastest counts")
+    parser.add_argument("--top", type=int, default=8, help="Slowest direct imports to list")
+    args = parser.parse_args()
+
+    violations = []
+    for entry in ENTRYPOINTS:
+        violations.extend(check(entry, args.runs, args.top))
+
+    if violations:
+        print("\nStartup budget violations:")
+        for violation in violations:
+            print(f"  - {violation}")
+        sys.exit(1)
+    print("\nAll entrypoints within their startup budget.")
+
+
+if __name__ == "__main__":
+    main()
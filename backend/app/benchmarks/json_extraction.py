@@ -0,0 +1,180 @@
+"""
+Compare the legacy regex-based `extract_json` with the single-pass
+bracket-matching extractor over a corpus of Perplexity/Gemini-style responses.
+
+    python -m app.benchmarks.json_extraction --responses 500 --repeat 5
+"""
+import argparse
+import json
+import random
+import re
+import time
+from collections import Counter
+from app.benchmarks.dataset import SCHEME_PREFIXES, SCHEME_TYPES
+from app.utils.common import extract_json_with_path
+
+
+def legacy_extract_json(text):
+    """The pre-rewrite implementation, kept verbatim for comparison."""
+    if not text:
+        return None
+
+    text = text.replace("```json", "").replace("```", "").strip()
+    text = re.sub(r"\[\d+\]", "", text)
+
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+
+    match = re.search(r"\{(?:.|\n)*\}", text)
+    if match:
+        candidate = re.sub(r"\[\d+\]", "", match.group())
+        try:
+            return json.loads(candidate)
+        except json.JSONDecodeError:
+            return None
+
+    return None
+
+
+def _fund(rng: random.Random) -> dict:
+    name = f"{rng.choice(SCHEME_PREFIXES)} {rng.choice(SCHEME_TYPES)} Fund - Direct Growth"
+    return {
+        "name": name,
+        "category": rng.choice(["Equity", "Hybrid", "Debt"]),
+        "nav": f"{rng.uniform(10, 900):.2f}",
+        "aum": f"{rng.randint(500, 90000)} Cr",
+        "returns": {k: f"{rng.uniform(-5, 30):.1f}%" for k in ("1Y", "3Y", "5Y")},
+        "risk_level": rng.choice(["Moderate", "High", "Very High"]),
+        "resource_url": f"https://www.valueresearchonline.com/funds/{rng.randint(1000, 99999)}/",
+    }
+
+
+def _cite(rng: random.Random) -> str:
+    return "".join(f"[{rng.randint(1, 12)}]" for _ in range(rng.randint(1, 3)))
+
+
+def perplexity_response(rng: random.Random) -> str:
+    """Fenced JSON with citation markers after values, as sonar models return it."""
+    fund = _fund(rng)
+    lines = []
+    for key, value in fund.items():
+        encoded = json.dumps(value)
+        if key in ("nav", "aum", "risk_level") and rng.random() < 0.7:
+            encoded += _cite(rng)
+        lines.append(f'  "{key}": {encoded}')
+    body = "{\n" + ",\n".join(lines) + "\n}"
+    return f"```json\n{body}\n```\n\nSources: {_cite(rng)}"
+
+
+def perplexity_batch_response(rng: random.Random) -> str:
+    funds = [dict(_fund(rng), requested_name=f"Fund {i}", found=True) for i in range(5)]
+    body = json.dumps({"funds": funds}, indent=2).replace('",\n', f'"{_cite(rng)},\n', 3)
+    return f"Here is the data you asked for {_cite(rng)}:\n```json\n{body}\n```"
+
+
+def gemini_response(rng: random.Random) -> str:
+    """Gemini mostly returns bare or fenced JSON, sometimes with a preamble."""
+    payload = {
+        "recommended_funds": [
+            dict(_fund(rng), rank=i + 1, pros=["Consistent returns"] * 3, cons=["Higher expense ratio"] * 2)
+            for i in range(5)
+        ],
+        "analysis": "Long-form rationale. " * rng.randint(20, 200),
+    }
+    body = json.dumps(payload, indent=2)
+    style = rng.random()
+    if style < 0.4:
+        return body
+    if style < 0.8:
+        return f"```json\n{body}\n```"
+    return f"Based on your portfolio, here are my recommendations:\n\n{body}\n\nLet me know if you need more detail."
+
+
+def citation_in_string_response(rng: random.Random) -> str:
+    """A `[n]` that is part of the data; the legacy extractor silently rewrites it."""
+    fund = _fund(rng)
+    fund["name"] = f"{fund['name']} [{rng.randint(1, 9)}]"
+    fund["resource_url"] += f"?ref=[{rng.randint(1, 9)}]"
+    return f"```json\n{json.dumps(fund, indent=2)}\n```"
+
+
+def array_before_object_response(rng: random.Random) -> str:
+    """A preamble listing the picks as an array before the full answer; the object is the payload."""
+    names = [_fund(rng)["name"] for _ in range(rng.randint(2, 5))]
+    body = json.dumps({"recommended_fund_names": names}, indent=2)
+    return f"Top picks: {json.dumps(names)}.\n\nFull answer:\n```json\n{body}\n```"
+
+
+def broken_response(rng: random.Random) -> str:
+    return rng.choice([
+        "I could not find reliable data for this fund.",
+        '{"name": "Truncated Fund", "nav": "12.',
+        "```json\n{\"name\": \"Unclosed\"\n```",
+    ])
+
+
+def truncated_response(rng: random.Random) -> str:
+    """
+    A response cut off by the token limit after a complete nested value; the
+    nested fund list or returns dict must not be returned as the answer.
+    """
+    if rng.random() < 0.5:
+        body = json.dumps({"user_fund_details": [_fund(rng) for _ in range(3)], "recommended_funds": [_fund(rng)]}, indent=2)
+    else:
+        body = json.dumps(_fund(rng), indent=2)
+    # Cut after the first complete nested value, somewhere before the payload closes
+    cut = rng.randint(body.index("}") + 1, len(body) - 2)
+    return f"```json\n{body[:cut]}" if rng.random() < 0.5 else body[:cut]
+
+
+GENERATORS = {
+    "perplexity": perplexity_response,
+    "perplexity_batch": perplexity_batch_response,
+    "gemini": gemini_response,
+    "citation_in_string": citation_in_string_response,
+    "array_before_object": array_before_object_response,
+    "broken": broken_response,
+    "truncated": truncated_response,
+}
+
+
+def build_corpus(responses: int, seed: int = 7) -> dict:
+    rng = random.Random(seed)
+    return {kind: [generate(rng) for _ in range(responses)] for kind, generate in GENERATORS.items()}
+
+
+def _time(fn, texts, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in texts:
+            fn(text)
+        best = min(best, time.perf_counter() - start)
+    return best / len(texts) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--responses", type=int, default=500, help="Responses per kind")
+    parser.add_argument("--repeat", type=int, default=5, help="Timing repetitions (best is reported)")
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.responses)
+    print(f"{'kind':<20}{'avg chars':>10}{'legacy us':>11}{'new us':>9}{'speedup':>9}{'differ':>8}  paths")
+    for kind, texts in corpus.items():
+        legacy_us = _time(legacy_extract_json, texts, args.repeat)
+        new_us = _time(extract_json_with_path, texts, args.repeat)
+        results = [extract_json_with_path(t) for t in texts]
+        differ = sum(legacy_extract_json(t) != data for t, (data, _) in zip(texts, results))
+        paths = Counter(path for _, path in results)
+        avg_chars = sum(map(len, texts)) // len(texts)
+        print(
+            f"{kind:<20}{avg_chars:>10}{legacy_us:>11.1f}{new_us:>9.1f}"
+            f"{legacy_us / new_us:>8.1f}x{differ:>8}  {dict(paths)}"
+        )
+
+
+if __name__ == "__main__":
+    main()
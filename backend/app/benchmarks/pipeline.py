@@ -0,0 +1,177 @@
+"""
+Offline end-to-end benchmark of the batch recommendation job. Gemini and
+Perplexity are replaced by local fakes with configurable latency and error
+rates, portfolios come from an in-memory SQLite dataset and results go to
+an in-memory Mongo, so runs are free and reproducible.
+
+    python -m app.benchmarks.pipeline --users 200 --workers 16 --mode async
+    python -m app.benchmarks.pipeline --gemini-latency 1.5,4 --error-rate 0.02
+
+Reports batch throughput plus p50/p95/p99 per pipeline stage and per
+external call.
+"""
+import argparse
+import asyncio
+import logging
+import tempfile
+import threading
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from app.benchmarks.dataset import create_sqlite_session, seed_portfolios
+from app.benchmarks.fakes import FakeGeminiClient, FakePerplexityServer, InMemoryMongo, LatencyModel, fake_fund
+from app.core.config import settings
+from app.db.mongo import MongoDB
+from app.models.mutual_funds import MutualFundSchemes
+from app.services.advisor import advisor_service
+from app.services.batch import BatchProcessor
+from app.services.staged_batch import StagedBatchProcessor, parse_stage_workers
+from app.services.fund_metrics import fund_metrics_store
+from app.services.fund_universe import fund_universe
+from app.services.market_data import market_data_service
+from app.services.portfolio import portfolio_service
+from app.utils.metrics import add_timing_listener, remove_timing_listener
+from app.utils.prompt_loader import prompt_registry
+from app.utils.rate_limiter import build_provider_limiter
+
+
+class TimingRecorder:
+    """Collects raw stage/call timings so exact percentiles can be reported."""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def __call__(self, series: str, seconds: float) -> None:
+        with self._lock:
+            self.samples[series].append(seconds)
+
+    def percentiles(self) -> Dict[str, Tuple[int, float, float, float]]:
+        with self._lock:
+            samples = {series: list(values) for series, values in self.samples.items()}
+        return {
+            series: (len(values), *np.percentile(values, [50, 95, 99]))
+            for series, values in sorted(samples.items())
+        }
+
+
+def parse_latency(value: str) -> Tuple[float, float]:
+    """Parse "median,p95" in seconds, e.g. "0.8,2.5"."""
+    median, p95 = (float(v) for v in value.split(","))
+    return median, p95
+
+
+def install_fakes(args, db) -> Tuple[FakePerplexityServer, FakeGeminiClient]:
+    """Point the service singletons at the local fakes and an in-memory Mongo."""
+    # MongoDB keeps its handles on the class
+    MongoDB.db = InMemoryMongo()
+    MongoDB.collection = MongoDB.db["user_recommendations"]
+    # Throwaway fund metrics store, so runs never touch FUND_METRICS_DIR
+    fund_metrics_store.path = tempfile.mkdtemp(prefix="fund-metrics-")
+
+    # The fakes ignore the key, but the real clients refuse to start without one
+    settings.PERPLEXITY_API_KEY = settings.PERPLEXITY_API_KEY or "benchmark"
+    server = FakePerplexityServer(LatencyModel(*args.perplexity_latency, error_rate=args.error_rate, seed=args.seed)).start()
+    market_data_service.BASE_URL = server.url
+
+    schemes = db.query(MutualFundSchemes.scheme_code, MutualFundSchemes.scheme_name).order_by(MutualFundSchemes.id).all()
+    if settings.FUND_METRICS_ENABLED:
+        # A metrics store covering the universe, as left behind by earlier batch runs
+        fund_metrics_store.record(dict(fake_fund(name), scheme_code=code) for code, name in schemes)
+        fund_metrics_store.flush()
+
+    # Gemini "recommends" real scheme names, so they resolve like production answers
+    scheme_names = [name for _, name in schemes]
+    gemini = FakeGeminiClient(LatencyModel(*args.gemini_latency, error_rate=args.error_rate, seed=args.seed + 1), scheme_names)
+    advisor_service.client = gemini
+
+    # The configured production quotas would dominate the numbers; 0 means unlimited
+    market_data_service.limiter = build_provider_limiter("perplexity", args.rate, burst=max(int(args.rate), 1))
+    advisor_service.limiter = build_provider_limiter("gemini", args.rate, burst=max(int(args.rate), 1))
+    return server, gemini
+
+
+def print_report(summary: dict, recorder: TimingRecorder, server: FakePerplexityServer, gemini: FakeGeminiClient) -> None:
+    print(f"\nBatch: {summary['succeeded']} succeeded, {summary['failed']} failed, {summary['skipped']} skipped "
+          f"in {summary['elapsed_seconds']}s -> {summary['users_per_minute']} users/min")
+    print(f"Calls: perplexity={server.requests} ({server.errors} errors), gemini={gemini.requests} ({gemini.errors} errors)")
+    if "fund_prefetch" in summary:
+        print(f"Fund prefetch: {summary['fund_prefetch']}")
+    if "fund_metrics" in summary:
+        print(f"Fund metrics: {summary['fund_metrics']}")
+    for name, stats in summary.get("stages", {}).items():
+        print(f"Stage {name}: {stats}")
+    for kind, sizes in sorted(gemini.prompt_chars.items()):
+        print(f"Gemini {kind} prompts: {len(sizes)} calls, {np.mean(sizes):.0f} chars on average")
+    print(f"Caches: fund_details={market_data_service.cache.stats()}, gemini={advisor_service.cache.stats()}")
+
+    print(f"\n{'series':<32}{'count':>8}{'p50 s':>10}{'p95 s':>10}{'p99 s':>10}")
+    for series, (count, p50, p95, p99) in recorder.percentiles().items():
+        print(f"{series:<32}{count:>8}{p50:>10.3f}{p95:>10.3f}{p99:>10.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--sips", type=int, default=4, help="SIPs per user")
+    parser.add_argument("--installments", type=int, default=24,
+                        help="Installments per SIP; below LOCAL_ANALYTICS_MIN_HISTORY_MONTHS held funds are fetched remotely")
+    parser.add_argument("--schemes", type=int, default=200, help="Size of the fund universe")
+    parser.add_argument("--workers", type=int, default=settings.BATCH_WORKERS)
+    parser.add_argument("--mode", choices=["staged", "threads", "async"], default="staged")
+    parser.add_argument("--stage-workers", type=parse_stage_workers, default=None, metavar="STAGE=N,...",
+                        help="Staged mode pool sizes, e.g. recommend=8,enrich=8")
+    parser.add_argument("--gemini-latency", type=parse_latency, default=(0.8, 2.5), metavar="MEDIAN,P95")
+    parser.add_argument("--perplexity-latency", type=parse_latency, default=(1.5, 5.0), metavar="MEDIAN,P95")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of provider calls failing with a retryable 503")
+    parser.add_argument("--rate", type=float, default=0, help="Per-provider calls/sec limit (0 = unlimited)")
+    parser.add_argument("--no-prefetch", action="store_true", help="Disable the batch fund prefetch")
+    parser.add_argument("--no-cache", action="store_true", help="Disable the Gemini response cache")
+    parser.add_argument("--no-prerank", action="store_true", help="Let Gemini pick from the whole market, without the local shortlist")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    settings.ADVISOR_CACHE_ENABLED = not args.no_cache
+    settings.BATCH_PREFETCH_FUNDS = not args.no_prefetch
+    settings.PRERANK_ENABLED = not args.no_prerank
+
+    db = create_sqlite_session()
+    seed_portfolios(db, users=args.users, sips_per_user=args.sips, installments_per_sip=args.installments,
+                    schemes=args.schemes, seed=args.seed)
+    prompt_registry.load_all()
+    fund_universe.refresh(db)
+    server, gemini = install_fakes(args, db)
+
+    recorder = TimingRecorder()
+    add_timing_listener(recorder)
+    try:
+        user_ids = portfolio_service.get_all_user_ids(db)
+        if args.mode == "staged":
+            processor = StagedBatchProcessor(run_id="benchmark", force=True, stage_workers=args.stage_workers)
+        else:
+            processor = BatchProcessor(run_id="benchmark", workers=args.workers, force=True)
+        if args.mode == "async":
+            summary = asyncio.run(run_async(processor, db, user_ids))
+        else:
+            summary = processor.run(db, user_ids)
+        print_report(summary, recorder, server, gemini)
+    finally:
+        remove_timing_listener(recorder)
+        market_data_service.close()
+        server.stop()
+        db.close()
+
+
+async def run_async(processor: BatchProcessor, db, user_ids):
+    try:
+        return await processor.run_async(db, user_ids)
+    finally:
+        await market_data_service.aclose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Compare the legacy per-user portfolio query (which fanned out over
+SIPInstallments) with the installment-aware aggregation.
+
+    python -m app.benchmarks.portfolio_query --users 200 --installments 240
+"""
+import argparse
+import time
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from app.benchmarks.dataset import create_sqlite_session, seed_portfolios
+from app.models.mutual_funds import SIPTransaction, SIPInstallments, SIPSchedule, MutualFundSchemes
+from app.services.portfolio import portfolio_service
+
+
+def legacy_rows(db: Session, user_id: str):
+    """The pre-fix query: every SIP row is repeated once per installment."""
+    return (
+        db.query(
+            SIPTransaction.scheme_code,
+            MutualFundSchemes.scheme_name,
+            SIPTransaction.amount.label("sip_amount"),
+            SIPSchedule.total_invested_amount,
+            SIPSchedule.total_units_allocated,
+        )
+        .join(SIPSchedule, SIPSchedule.sip_id == SIPTransaction.id)
+        .outerjoin(SIPInstallments, SIPInstallments.sip_id == SIPTransaction.id)
+        .join(MutualFundSchemes, MutualFundSchemes.scheme_code == SIPTransaction.scheme_code)
+        .filter(SIPTransaction.user_id == user_id)
+        .filter(SIPSchedule.total_invested_amount.isnot(None))
+        .all()
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--sips", type=int, default=4, help="SIPs per user")
+    parser.add_argument("--installments", type=int, default=240, help="Installments per SIP")
+    args = parser.parse_args()
+
+    db = create_sqlite_session()
+    seed_portfolios(db, users=args.users, sips_per_user=args.sips, installments_per_sip=args.installments)
+    user_ids = portfolio_service.get_all_user_ids(db)
+
+    start = time.perf_counter()
+    legacy_count = 0
+    legacy_invested = 0.0
+    for user_id in user_ids:
+        rows = legacy_rows(db, user_id)
+        legacy_count += len(rows)
+        legacy_invested += sum(float(r.total_invested_amount or 0) for r in rows)
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for user_id in user_ids:
+        portfolio_service.get_aggregated_portfolio(db, user_id)
+    per_user_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    bulk_count = 0
+    for _, portfolio in portfolio_service.iter_aggregated_portfolios(db, user_ids):
+        bulk_count += len(portfolio)
+    bulk_seconds = time.perf_counter() - start
+
+    print(f"Users: {len(user_ids)} | SIPs/user: {args.sips} | installments/SIP: {args.installments}")
+    print(f"{'path':<28}{'rows':>12}{'seconds':>12}")
+    print(f"{'legacy per-user join':<28}{legacy_count:>12}{legacy_seconds:>12.3f}")
+    print(f"{'aggregated per-user':<28}{'-':>12}{per_user_seconds:>12.3f}")
+    print(f"{'aggregated bulk':<28}{bulk_count:>12}{bulk_seconds:>12.3f}")
+    actual_invested = float(db.query(func.sum(SIPSchedule.total_invested_amount)).scalar() or 0)
+    print(
+        f"Invested total: legacy {legacy_invested:,.2f} vs schedule {actual_invested:,.2f} "
+        f"({legacy_invested / actual_invested if actual_invested else 0:.0f}x inflated)"
+    )
+
+
+if __name__ == "__main__":
+    main()
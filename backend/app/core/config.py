@@ -1,5 +1,5 @@
 from pydantic_settings import BaseSettings
-from typing import Optional
+from typing import List, Optional
 
 class Settings(BaseSettings):
     PROJECT_NAME: str = "Mutual Fund Recommendation Engine"
@@ -18,8 +18,101 @@ class Settings(BaseSettings):
     MONGO_DB_NAME: str = "mf_recommendations_db"
 
     # API Keys
-    PERPLEXITY_API_KEY: str
-    GEMINI_API_KEY: str
+    # Only required by the recommendation pipeline; checked when a provider is first used
+    PERPLEXITY_API_KEY: Optional[str] = None
+    GEMINI_API_KEY: Optional[str] = None
+
+    # Perplexity HTTP Connection Pool
+    PERPLEXITY_POOL_SIZE: int = 20  # Max pooled keep-alive connections (sync and async)
+    PERPLEXITY_CONNECT_TIMEOUT: float = 5.0
+    PERPLEXITY_READ_TIMEOUT: float = 40.0
+    PERPLEXITY_KEEPALIVE_SECONDS: float = 60.0  # Idle time before a pooled connection is dropped (async)
+
+    # Funds per batched Perplexity request (1 = one request per fund)
+    MARKET_DATA_BATCH_SIZE: int = 5
+
+    # External API Rate Limits (per process unless RATE_LIMIT_SHARED)
+    PERPLEXITY_RATE_PER_SECOND: float = 2.0
+    PERPLEXITY_BURST: int = 5
+    GEMINI_RATE_PER_SECOND: float = 5.0
+    GEMINI_BURST: int = 10
+    LLM_MIN_CONCURRENCY: int = 1
+    LLM_INITIAL_CONCURRENCY: int = 4  # Starting point; grows on success up to LLM_MAX_CONCURRENCY
+    LLM_MAX_CONCURRENCY: int = 16  # Adaptive (AIMD) concurrency ceiling per provider
+    RATE_LIMIT_MAX_WAIT_SECONDS: float = 60.0  # Reject calls that would wait longer than this
+    RATE_LIMIT_SHARED: bool = False  # Enforce rates across processes via MongoDB
+
+    # Fund Universe Index (resolves LLM fund names to scheme codes)
+    FUND_UNIVERSE_MIN_SCORE: float = 0.75  # Minimum trigram similarity for a fuzzy match
+    FUND_UNIVERSE_MIN_MARGIN: float = 0.05  # Lead over the second-best scheme; closer matches are ambiguous
+    FUND_UNIVERSE_REFRESH_SECONDS: int = 60 * 60  # API refresh interval for new schemes (0 disables)
+
+    # Local Holding Analytics (from SIP installments)
+    LOCAL_ANALYTICS_ENABLED: bool = True  # Use local NAV/returns for held funds instead of Perplexity
+    LOCAL_ANALYTICS_MIN_HISTORY_MONTHS: int = 12  # Months of NAV history needed to skip the external fetch
+    LOCAL_ANALYTICS_MAX_NAV_AGE_MONTHS: int = 1  # Latest installment NAV must be at most this many months old
+    LOCAL_ANALYTICS_SAMPLE_SIPS: int = 50  # Active SIPs per scheme whose installments make up its NAV history
+
+    # Pipeline
+    # Max number of concurrent Perplexity fetches within a single pipeline run (1 = sequential)
+    PIPELINE_FETCH_CONCURRENCY: int = 4
+
+    # On-demand Recommendation Jobs
+    JOB_RESULT_TTL_SECONDS: int = 600  # How long finished jobs can still be polled
+    JOB_MAX_WAIT_SECONDS: int = 60  # Upper bound for long-poll waits
+    API_PRELOAD_PIPELINE: bool = False  # Load the pipeline at startup instead of on the first refresh job
+
+    # Recommendation Read Cache (API)
+    RECOMMENDATION_CACHE_TTL_SECONDS: int = 60  # Bounds staleness after writes from other processes
+    RECOMMENDATION_CACHE_MAX_ENTRIES: int = 10000
+    RECOMMENDATION_CACHE_WATCH: bool = False  # Invalidate via change stream (requires a replica set)
+
+    # Batch Processing
+    BATCH_WORKERS: int = 4  # Users processed in parallel by process_all_users
+    BATCH_PROGRESS_INTERVAL_SECONDS: int = 30
+    PORTFOLIO_BULK_CHUNK_SIZE: int = 500  # Users per bulk aggregation query / rows per fetch
+    PORTFOLIO_INSTALLMENT_FALLBACK: bool = True  # Sum installments when schedule totals are missing
+    INSTALLMENT_PAID_STATUSES: List[str] = ["SUCCESS", "SUCCESSFUL", "PAID", "COMPLETED", "ALLOTTED"]  # Others (failed, pending) are ignored
+    RESULT_WRITE_BATCH_SIZE: int = 100  # Recommendations per Mongo bulk_write
+    RESULT_WRITE_FLUSH_SECONDS: float = 5.0  # Max time a finished result waits in the write buffer
+    RECOMMENDATION_MAX_AGE_DAYS: float = 7  # Recompute unchanged portfolios once their recommendation is older
+    BATCH_PREFETCH_FUNDS: bool = True  # Fetch each distinct held fund once per run before the pipelines need it
+    BATCH_PREFETCH_CONCURRENCY: int = 8  # Concurrent Perplexity requests during the prefetch
+
+    # Staged Batch Mode (one worker pool per pipeline stage, bounded queues in between)
+    BATCH_STAGE_QUEUE_SIZE: int = 32  # Max users waiting in front of each stage
+    BATCH_FETCH_USER_WORKERS: int = 4
+    BATCH_RECOMMEND_WORKERS: int = 4
+    BATCH_FETCH_RECOMMENDED_WORKERS: int = 4
+    BATCH_ENRICH_WORKERS: int = 4
+
+    # Fund Details Cache
+    FUND_CACHE_TTL_SECONDS: int = 24 * 60 * 60  # NAVs are published once a day
+    FUND_CACHE_MAX_ENTRIES: int = 5000
+    FUND_CACHE_PERSIST: bool = True  # Mirror cache entries into MongoDB
+
+    # Fund Metrics Store (numeric NAV/AUM/returns per scheme code, memory-mapped .npy columns)
+    FUND_METRICS_ENABLED: bool = True
+    FUND_METRICS_DIR: str = "data/fund_metrics"  # Relative paths are resolved against the backend directory
+    FUND_METRICS_RELOAD_SECONDS: float = 60.0  # How often readers check for a newer version
+
+    # Candidate Pre-ranking (local shortlist from the fund metrics store, offered to Gemini)
+    PRERANK_ENABLED: bool = True
+    PRERANK_SHORTLIST_SIZE: int = 10
+    PRERANK_MAX_PER_CATEGORY: int = 3
+    PRERANK_MIN_UNIVERSE: int = 20  # With fewer ranked funds, Gemini picks from the whole market as before
+
+    # Gemini Response Cache (keyed by canonical payload + prompt version)
+    ADVISOR_CACHE_ENABLED: bool = True
+    ADVISOR_CACHE_TTL_SECONDS: int = 24 * 60 * 60
+    ADVISOR_CACHE_MAX_ENTRIES: int = 2000
+    ADVISOR_CACHE_PERSIST: bool = True
+
+    # Prompts
+    PROMPT_HOT_RELOAD: bool = False  # Recompile prompt files when they change on disk
+
+    # Observability (Prometheus metrics are always served on /metrics)
+    OTEL_TRACING_ENABLED: bool = False  # Also emit pipeline stages as OpenTelemetry spans (needs opentelemetry-api)
 
     @property
     def SQLALCHEMY_DATABASE_URI(self) -> str:
@@ -1,8 +1,9 @@
-from fastapi import HTTPException, status
+# http.HTTPStatus instead of fastapi.status, so services (and the batch job) don't import FastAPI
+from http import HTTPStatus
 
 class AppError(Exception):
     """Base class for all application errors."""
-    def __init__(self, message: str, status_code: int = status.HTTP_500_INTERNAL_SERVER_ERROR):
+    def __init__(self, message: str, status_code: int = HTTPStatus.INTERNAL_SERVER_ERROR):
         self.message = message
         self.status_code = status_code
         super().__init__(message)
@@ -12,7 +13,21 @@ class ExternalServiceError(AppError):
     def __init__(self, service_name: str, detail: str):
         super().__init__(
             message=f"External service '{service_name}' failed: {detail}",
-            status_code=status.HTTP_503_SERVICE_UNAVAILABLE
+            status_code=HTTPStatus.SERVICE_UNAVAILABLE
+        )
+
+class RateLimitExceededError(ExternalServiceError):
+    """Raised when a call to an external service cannot get through the local rate limit in time."""
+    def __init__(self, service_name: str):
+        super().__init__(service_name, "rate limit exceeded, call rejected")
+        self.status_code = HTTPStatus.TOO_MANY_REQUESTS
+
+class ConfigurationError(AppError):
+    """Raised when a setting required by the requested feature (e.g. an API key) is missing."""
+    def __init__(self, setting: str):
+        super().__init__(
+            message=f"Required setting '{setting}' is not configured",
+            status_code=HTTPStatus.SERVICE_UNAVAILABLE
         )
 
 class DatabaseError(AppError):
@@ -20,7 +35,7 @@ class DatabaseError(AppError):
     def __init__(self, detail: str):
         super().__init__(
             message=f"Database error: {detail}",
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
+            status_code=HTTPStatus.INTERNAL_SERVER_ERROR
         )
 
 class DataNotFoundError(AppError):
@@ -28,5 +43,5 @@ class DataNotFoundError(AppError):
     def __init__(self, item_name: str):
         super().__init__(
             message=f"{item_name} not found",
-            status_code=status.HTTP_404_NOT_FOUND
+            status_code=HTTPStatus.NOT_FOUND
         )
@@ -0,0 +1,137 @@
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from app.utils.metrics import stage
+
+logger = logging.getLogger(__name__)
+
+# Called after each flush with the keys written and {key: error} for the ones that failed
+FlushCallback = Callable[[List[Any], Dict[Any, str]], None]
+
+
+class BulkUpsertWriter:
+    """
+    Buffers documents and upserts them (keyed by `key_field`) with unordered
+    `bulk_write` batches. A batch is flushed when it reaches `batch_size` or
+    has waited `flush_interval` seconds; `close()` (or leaving the `with`
+    block) flushes whatever is left. A failed write only fails its own
+    documents, which are reported to `on_flush` with their error.
+    """
+
+    def __init__(
+        self,
+        collection_getter: Callable[[], Any],
+        key_field: str,
+        batch_size: int,
+        flush_interval: float,
+        on_flush: Optional[FlushCallback] = None,
+    ):
+        self._collection_getter = collection_getter
+        self.key_field = key_field
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self.on_flush = on_flush
+
+        # Keyed by document key, so a user finished twice is written once
+        self._buffer: Dict[Any, dict] = {}
+        self._oldest: Optional[float] = None
+        self._buffer_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+
+        self.written = 0
+        self.failed = 0
+        self.flushes = 0
+
+    def start(self) -> "BulkUpsertWriter":
+        if self.flush_interval > 0 and self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_periodically, name="bulk-writer", daemon=True)
+            self._flusher.start()
+        return self
+
+    def __enter__(self) -> "BulkUpsertWriter":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def add(self, document: dict) -> None:
+        """Queue a document; flushes in the calling thread once the batch is full."""
+        if self._closed.is_set():
+            raise RuntimeError("BulkUpsertWriter is closed")
+        with self._buffer_lock:
+            self._buffer[document[self.key_field]] = document
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self.flush()
+
+    def _flush_periodically(self) -> None:
+        while not self._closed.wait(min(self.flush_interval, 1.0)):
+            with self._buffer_lock:
+                due = self._oldest is not None and time.monotonic() - self._oldest >= self.flush_interval
+            if due:
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.error(f"Periodic flush failed: {e}")
+
+    def flush(self) -> None:
+        """Write everything buffered so far."""
+        with self._flush_lock:
+            with self._buffer_lock:
+                batch = list(self._buffer.values())
+                self._buffer = {}
+                self._oldest = None
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch: List[dict]) -> None:
+        keys = [doc[self.key_field] for doc in batch]
+        operations = [
+            UpdateOne({self.key_field: key}, {"$set": doc}, upsert=True)
+            for key, doc in zip(keys, batch)
+        ]
+        failed: Dict[Any, str] = {}
+        try:
+            # One observation per batch, not per document
+            with stage("mongo_write"):
+                self._collection_getter().bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # Unordered: everything not listed in writeErrors was applied
+            for error in e.details.get("writeErrors", []):
+                failed[keys[error["index"]]] = error.get("errmsg", str(error))
+        except Exception as e:
+            failed = {key: str(e) for key in keys}
+
+        written = [key for key in keys if key not in failed]
+        self.flushes += 1
+        self.written += len(written)
+        self.failed += len(failed)
+        if failed:
+            logger.error(f"Bulk upsert: {len(failed)}/{len(batch)} documents failed, e.g. {next(iter(failed.items()))}")
+        else:
+            logger.debug(f"Bulk upsert: wrote {len(batch)} documents")
+
+        if self.on_flush:
+            self.on_flush(written, failed)
+
+    def close(self) -> None:
+        """Stop the periodic flusher and write any remaining documents."""
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+
+    def stats(self) -> Dict[str, int]:
+        with self._buffer_lock:
+            pending = len(self._buffer)
+        return {"written": self.written, "failed": self.failed, "flushes": self.flushes, "pending": pending}
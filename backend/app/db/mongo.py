@@ -1,10 +1,14 @@
-from pymongo import MongoClient
+from pymongo import AsyncMongoClient, MongoClient
 from app.core.config import settings
 
 class MongoDB:
     client: MongoClient = None
     db = None
     collection = None
+    # Non-blocking client for the API's read path
+    async_client: AsyncMongoClient = None
+    async_db = None
+    async_collection = None
 
     @classmethod
     def connect(cls):
@@ -20,10 +24,52 @@ class MongoDB:
             
             cls.db = cls.client[settings.MONGO_DB_NAME]
             cls.collection = cls.db["user_recommendations"]
+            cls.ensure_indexes()
+
+    @classmethod
+    def ensure_indexes(cls):
+        """
+        One recommendation document per user: upserts and API lookups by
+        user_id use this index instead of scanning the collection.
+        """
+        try:
+            cls.collection.create_index("user_id", unique=True, name="user_id_unique")
+        except Exception as e:
+            # e.g. duplicates left by older runs; lookups still work, just slower
+            print(f"Could not create unique user_id index on user_recommendations: {e}")
     
+    @classmethod
+    def get_collection(cls, name: str):
+        """
+        Return a collection from the connected database, or None when
+        MongoDB has not been connected in this process.
+        """
+        if cls.db is None:
+            return None
+        return cls.db[name]
+
+    @classmethod
+    async def connect_async(cls):
+        if cls.async_client is None:
+            cls.async_client = AsyncMongoClient(settings.MONGO_URI, serverSelectionTimeoutMS=5000)
+            try:
+                await cls.async_client.admin.command("ping")
+            except Exception as e:
+                print(f"Failed to connect to MongoDB (async): {e}")
+                raise e
+
+            cls.async_db = cls.async_client[settings.MONGO_DB_NAME]
+            cls.async_collection = cls.async_db["user_recommendations"]
+
     @classmethod
     def close(cls):
         if cls.client:
             cls.client.close()
 
+    @classmethod
+    async def close_async(cls):
+        if cls.async_client:
+            await cls.async_client.close()
+            cls.async_client = None
+
 mongo_db = MongoDB()
@@ -1,10 +1,14 @@
 import logging
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
 from app.core.config import settings
 from app.api.v1.router import api_router
 from app.db.mongo import mongo_db
+from app.services.jobs import job_manager
+from app.services.recommendation_store import recommendation_store
 from app.core.logging import setup_logging
+from app.utils.prompt_loader import prompt_registry
+from app.utils.metrics import CONTENT_TYPE, render_latest
 
 from app.core.exceptions import AppError
 from app.core.handlers import app_exception_handler, general_exception_handler
@@ -31,6 +35,7 @@ app.add_middleware(
 @app.on_event("startup")
 def startup_db_client():
     logger.info("Starting up Mutual Fund Recommendation Engine...")
+    prompt_registry.load_all()
     mongo_db.connect()
     logger.info("Database connection established.")
 
@@ -40,8 +45,27 @@ def shutdown_db_client():
     mongo_db.close()
     logger.info("Database connection closed.")
 
+@app.on_event("startup")
+async def startup_async_mongo_client():
+    await mongo_db.connect_async()
+    recommendation_store.start_watching()
+    # Otherwise the pipeline (LLM clients, SQL, fund universe) is loaded by the first refresh job
+    if settings.API_PRELOAD_PIPELINE:
+        await job_manager.warm_up()
+
+@app.on_event("shutdown")
+async def shutdown_background_jobs():
+    await job_manager.shutdown()
+    await recommendation_store.stop_watching()
+    await mongo_db.close_async()
+
 app.include_router(api_router, prefix=settings.API_V1_STR)
 
 @app.get("/")
 def root():
     return {"message": "Mutual Fund Recommendation Engine API is running"}
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """Prometheus scrape endpoint: stage/external-call latencies, retries, tokens and cache hit ratios."""
+    return Response(render_latest(), media_type=CONTENT_TYPE)
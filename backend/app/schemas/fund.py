@@ -1,4 +1,5 @@
-from pydantic import BaseModel
+from datetime import datetime
+from pydantic import BaseModel, Field
 from typing import Optional, Dict, List, Any
 
 class FundReturns(BaseModel):
@@ -11,6 +12,7 @@ class FundReturns(BaseModel):
 
 class FundDetails(BaseModel):
     name: str
+    scheme_code: Optional[str] = None
     category: Optional[str] = None
     nav: Optional[str] = None
     aum: Optional[str] = None
@@ -22,6 +24,24 @@ class FundDetails(BaseModel):
     pros: Optional[List[str]] = None
     cons: Optional[List[str]] = None
 
+    # When Perplexity answered; kept with the cached entry, left out of prompts and responses
+    fetched_at: Optional[datetime] = Field(default=None, exclude=True)
+
+class FundMetrics(BaseModel):
+    """Numeric view of FundDetails, as held in the fund metrics store."""
+    scheme_code: str
+    nav: Optional[float] = None
+    aum_crore: Optional[float] = None
+    # Returns in percent, e.g. 12.5 for "12.5%"
+    return_1y: Optional[float] = None
+    return_3y: Optional[float] = None
+    return_5y: Optional[float] = None
+    # SEBI riskometer level: 1 (Low) .. 6 (Very High), 0 if unknown
+    risk_level: int = 0
+    # Index into fund_metrics.FUND_CATEGORIES, 0 if unknown
+    category: int = 0
+    fetched_at: Optional[datetime] = None
+
 class RecommendationResponse(BaseModel):
     user_fund_details: List[FundDetails]
     recommended_funds: List[FundDetails]
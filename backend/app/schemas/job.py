@@ -0,0 +1,13 @@
+from datetime import datetime
+from pydantic import BaseModel
+from typing import Optional, Dict, Any
+
+class RecommendationJobStatus(BaseModel):
+    job_id: str
+    user_id: str
+    status: str  # pending | running | completed | failed
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    coalesced: bool = False  # True when the request joined an already running job
@@ -0,0 +1,64 @@
+import sys
+import os
+import argparse
+from datetime import timedelta, timezone
+
+# Ensure the app is in the python path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../'))
+
+from app.core.config import settings
+from app.db.session import SessionLocal
+from app.db.mongo import mongo_db
+from app.services.fund_metrics import FundMetricsStore, normalize_fund_metrics
+from app.services.fund_universe import fund_universe
+from app.services.market_data import MarketDataService
+import logging
+
+# Configure Logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("FundMetrics")
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Backfill the fund metrics store from the persisted fund details cache."
+    )
+    parser.add_argument("--path", default=settings.FUND_METRICS_DIR,
+                        help="Store directory, relative to the backend directory (default: FUND_METRICS_DIR).")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    store = FundMetricsStore(args.path)
+    db = SessionLocal()
+    try:
+        mongo_db.connect()
+        # Cached details are keyed by fund name; the store needs the scheme code
+        fund_universe.refresh(db)
+
+        cached = mongo_db.get_collection(MarketDataService.CACHE_COLLECTION).find({}, {"value": 1, "expires_at": 1})
+        updates, unresolved = [], 0
+        for doc in cached:
+            details = dict(doc.get("value") or {})
+            details["scheme_code"] = details.get("scheme_code") or fund_universe.code_for(details.get("name") or doc["_id"])
+            if not details["scheme_code"]:
+                unresolved += 1
+                continue
+            # Entries cached before fetch times were kept: estimate it from the expiry
+            expires_at = doc.get("expires_at")
+            fetched_at = expires_at.replace(tzinfo=timezone.utc) - timedelta(seconds=settings.FUND_CACHE_TTL_SECONDS) if expires_at else None
+            metrics = normalize_fund_metrics(details, fetched_at)
+            if metrics is not None:
+                updates.append(metrics)
+
+        store.record_metrics(updates)
+        version = store.flush()
+        logger.info(f"Fund metrics {version}: {len(updates)} funds from cache, {unresolved} names without a scheme code")
+
+        store.snapshot()
+        logger.info(f"Fund metrics store: {store.stats()}")
+    finally:
+        db.close()
+        mongo_db.close()
+
+if __name__ == "__main__":
+    main()
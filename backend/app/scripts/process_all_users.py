@@ -1,72 +1,108 @@
 import sys
 import os
+import argparse
+import asyncio
+from datetime import datetime, timezone
 
 # Ensure the app is in the python path
 sys.path.append(os.path.join(os.path.dirname(__file__), '../../'))
 
+from app.core.config import settings
 from app.db.session import SessionLocal
 from app.db.mongo import mongo_db
 from app.services.portfolio import portfolio_service
-from app.services.recommendation import recommendation_service
-from app.utils.helpers import pretty_print
+from app.services.market_data import market_data_service
+from app.services.advisor import advisor_service
+from app.services.fund_universe import fund_universe
+from app.services.batch import BatchProcessor, BatchCheckpoint, parse_shard
+from app.services.staged_batch import StagedBatchProcessor, parse_stage_workers
+from app.utils.prompt_loader import prompt_registry
+from app.utils.metrics import stage_summary
+from app.utils.rate_limiter import rate_limiter_stats
 import logging
 
 # Configure Logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("BatchProcessor")
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate recommendations for all users.")
+    parser.add_argument("--workers", type=int, default=settings.BATCH_WORKERS,
+                        help="Number of users processed in parallel (threads/async modes).")
+    parser.add_argument("--shard", type=parse_shard, default=(0, 1), metavar="i/N",
+                        help="Only process shard i of N (e.g. 0/4) to split users across machines.")
+    parser.add_argument("--run-id", default=None,
+                        help="Run identifier; reuse an existing id to resume that run.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Resume the latest unfinished run for this shard.")
+    parser.add_argument("--mode", choices=["staged", "threads", "async"], default="staged",
+                        help="staged: one worker pool per pipeline stage (BATCH_*_WORKERS); "
+                             "threads: one thread per in-flight user; async: all pipelines on one event loop.")
+    parser.add_argument("--stage-workers", type=parse_stage_workers, default=None, metavar="STAGE=N,...",
+                        help="Staged mode pool sizes, e.g. recommend=8,enrich=8 (defaults: BATCH_*_WORKERS).")
+    parser.add_argument("--force", action="store_true",
+                        help="Recompute every user, even if the portfolio is unchanged since the stored recommendation.")
+    return parser.parse_args()
+
+async def run_async(processor: BatchProcessor, db, user_ids):
+    try:
+        return await processor.run_async(db, user_ids)
+    finally:
+        await market_data_service.aclose()
+
 def main():
+    args = parse_args()
     db = SessionLocal()
     try:
+        prompt_registry.load_all()
         mongo_db.connect()
-        
-        all_users = portfolio_service.get_all_user_ids(db)
-        logger.info(f"Found {len(all_users)} users. Running pipeline...")
-
-        for user_id in all_users:
-            logger.info(f"Running recommendation workflow for user: {user_id}")
-            
-            try:
-                # 1. Get Portfolio
-                portfolio = portfolio_service.get_aggregated_portfolio(db, user_id)
-                if not portfolio:
-                    logger.warning(f"No portfolio found for user {user_id}, skipping.")
-                    continue
-
-                # 2. Calculate Budget (Logic duplicated from API, ideally moved to service but fine here for script)
-                sip_amounts = [p.get("avg_sip_amount") for p in portfolio if p.get("avg_sip_amount")]
-                invested_amounts = [p.get("total_invested_amount") for p in portfolio if p.get("total_invested_amount")]
 
-                if sip_amounts:
-                    budget = round(sum(sip_amounts) / len(sip_amounts))
-                elif invested_amounts:
-                    budget = round(sum(invested_amounts) / len(invested_amounts))
-                else:
-                    budget = 0
+        run_id = args.run_id
+        if args.resume and not run_id:
+            run_id = BatchCheckpoint.latest_unfinished_run(args.shard)
+            if run_id:
+                logger.info(f"Resuming run {run_id}")
+        if not run_id:
+            run_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
 
-                fund_names = [p["scheme_name"] for p in portfolio]
+        fund_universe.refresh(db)
+        all_users = portfolio_service.get_all_user_ids(db)
+        logger.info(f"Found {len(all_users)} users. Running pipeline...")
 
-                # 3. Run Pipeline
-                result = recommendation_service.run_pipeline(fund_names)
-                
-                # 4. Save to Mongo
-                mongo_db.collection.update_one(
-                    {"user_id": user_id},
-                    {"$set": {
-                        "user_id": user_id,
-                        "budget": budget,
-                        "recommendation": result
-                    }},
-                    upsert=True
-                )
-                logger.info(f"Saved for user {user_id}")
+        if args.mode == "staged":
+            processor = StagedBatchProcessor(run_id=run_id, shard=args.shard, force=args.force, stage_workers=args.stage_workers)
+        else:
+            processor = BatchProcessor(run_id=run_id, workers=args.workers, shard=args.shard, force=args.force)
+        if args.mode == "async":
+            summary = asyncio.run(run_async(processor, db, all_users))
+        else:
+            summary = processor.run(db, all_users)
 
-            except Exception as e:
-                logger.error(f"Error processing user {user_id}: {e}")
+        logger.info(f"Batch summary: {summary}")
+        logger.info(
+            f"Recomputed {summary['succeeded']} users, kept {summary['unchanged']} unchanged, "
+            f"{summary['failed']} failed, {summary['skipped']} without portfolio."
+        )
+        if "fund_prefetch" in summary:
+            prefetch = summary["fund_prefetch"]
+            logger.info(
+                f"Fund prefetch: {prefetch['distinct_funds']} distinct funds for {prefetch['remote_references']} fund references "
+                f"({prefetch['served_locally']} more served locally), {prefetch['fetches_saved']} fetches saved."
+            )
+        if "fund_metrics" in summary:
+            logger.info(f"Fund metrics store: {summary['fund_metrics']}")
+        logger.info(f"Fund details cache stats: {market_data_service.cache.stats()}")
+        logger.info(f"Gemini response cache stats: {advisor_service.cache.stats()}")
+        logger.info(f"Fund universe lookups: {fund_universe.stats()}")
+        logger.info(f"Perplexity connection stats: {market_data_service.connection_stats()}")
+        logger.info(f"Perplexity call metrics (single vs batch): {market_data_service.api_metrics()}")
+        logger.info(f"Rate limiter stats: {rate_limiter_stats()}")
+        logger.info(f"Pipeline stage timings: {stage_summary()}")
 
     finally:
         db.close()
         mongo_db.close()
+        market_data_service.close()
 
 if __name__ == "__main__":
     main()
@@ -1,73 +1,272 @@
+import copy
 import json
-from google import genai
-from google.genai import types
-from typing import List, Dict, Any, Optional
+import threading
+from typing import Callable, List, Dict, Any, Optional
 from app.core.config import settings
-from app.utils.common import extract_json
-from app.utils.prompt_loader import load_prompt
+from app.core.exceptions import ConfigurationError
+from app.db.mongo import mongo_db
+from app.utils.cache import TieredCache
+from app.utils.common import extract_json, fingerprint, normalize_fund_name
+from app.utils.metrics import external_call, record_tokens
+from app.utils.prompt_loader import load_prompt, prompt_version
 from app.schemas.fund import FundDetails
-import logging
-
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type, before_sleep_log
+from app.utils.rate_limiter import RATE_LIMIT_COLLECTION, build_provider_limiter
+from app.utils.retry import external_retry
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Shared retry policy; tenacity awaits between attempts for the async methods
+gemini_retry = external_retry(logger, "gemini")
+
+RECOMMEND_PROMPT = "fund_recommendation.txt"
+SHORTLIST_PROMPT = "fund_recommendation_shortlist.txt"
+ENRICH_PROMPT = "fund_enrichment.txt"
+
+def _sorted_funds(funds: List[Any]) -> List[Any]:
+    """
+    Order funds (detail dicts, or compact rows starting with the name) by
+    normalized name so equivalent portfolios produce the same prompt.
+    """
+    def name(fund: Any) -> str:
+        return str((fund.get("name") if isinstance(fund, dict) else fund[0]) or "")
+    return sorted(funds or [], key=lambda f: normalize_fund_name(name(f)))
+
+def _valid_recommendation(data: Any) -> bool:
+    names = data.get("recommended_fund_names") if isinstance(data, dict) else None
+    return isinstance(names, list) and bool(names) and all(isinstance(name, str) for name in names)
+
+def _valid_enrichment(data: Any) -> bool:
+    # The frontend iterates all three lists
+    return isinstance(data, dict) and all(
+        isinstance(data.get(key), list) for key in ("user_fund_details", "recommendations", "ranking")
+    )
+
+def _checked(data: Any, valid: Callable[[Any], bool], operation: str) -> Optional[Dict[str, Any]]:
+    """
+    The parsed answer if it has the shape callers expect, else None. None is
+    never cached, so a malformed answer is not served to every identical
+    portfolio for the cache TTL; the next request asks again.
+    """
+    if data is not None and not valid(data):
+        logger.warning(f"Gemini {operation} answer has an unexpected shape, discarding it")
+        return None
+    return data
+
+def _record_usage(resp, operation: str) -> None:
+    usage = getattr(resp, "usage_metadata", None)
+    if usage is not None:
+        record_tokens("gemini", operation, usage.prompt_token_count, usage.candidates_token_count)
+
 class AdvisorService:
+    CACHE_COLLECTION = "advisor_response_cache"
+
     def __init__(self):
-        self.client = genai.Client(api_key=settings.GEMINI_API_KEY)
         self.model = "gemini-2.5-flash-lite"
+        self.temperature = 0.2
+        # google-genai is slow to import and needs the API key; both wait for the first call
+        self._client = None
+        self._config = None
+        self._client_lock = threading.Lock()
+        self.limiter = build_provider_limiter(
+            "gemini",
+            rate_per_second=settings.GEMINI_RATE_PER_SECOND,
+            burst=settings.GEMINI_BURST,
+            collection_getter=lambda: mongo_db.get_collection(RATE_LIMIT_COLLECTION),
+        )
+        self.cache = TieredCache(
+            name="advisor_responses",
+            maxsize=settings.ADVISOR_CACHE_MAX_ENTRIES,
+            ttl_seconds=settings.ADVISOR_CACHE_TTL_SECONDS,
+            collection_getter=(lambda: mongo_db.get_collection(self.CACHE_COLLECTION))
+            if settings.ADVISOR_CACHE_PERSIST else None,
+        )
 
-    @retry(
-        stop=stop_after_attempt(3),
-        wait=wait_exponential(multiplier=1, min=2, max=10),
-        retry=retry_if_exception_type(Exception),
-        reraise=True,
-        before_sleep=before_sleep_log(logger, logging.WARNING)
-    )
-    def recommend_fund_names(self, user_fund_details: List[dict]) -> Dict[str, List[str]]:
+    @property
+    def client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    if not settings.GEMINI_API_KEY:
+                        raise ConfigurationError("GEMINI_API_KEY")
+                    from google import genai
+                    self._client = genai.Client(api_key=settings.GEMINI_API_KEY)
+        return self._client
+
+    @client.setter
+    def client(self, client) -> None:
+        # Lets tests and benchmarks swap in a fake client
+        self._client = client
+
+    @property
+    def config(self):
+        if self._config is None:
+            from google.genai import types
+            self._config = types.GenerateContentConfig(temperature=self.temperature)
+        return self._config
+
+    def _cache_key(self, prompt_file: str, payload: Any) -> str:
         """
-        Given user fund details, recommend 5 fund NAMES only.
+        Fingerprint of everything that determines a Gemini answer. Editing the
+        prompt file or switching models yields new keys, so stale answers are never served.
         """
-        prompt = load_prompt(
-            "fund_recommendation.txt",
+        return fingerprint({
+            "prompt": prompt_file,
+            "prompt_version": prompt_version(prompt_file),
+            "model": self.model,
+            "temperature": self.temperature,
+            "payload": payload,
+        })
+
+    def _cache_enabled(self, use_cache: bool) -> bool:
+        return use_cache and settings.ADVISOR_CACHE_ENABLED
+
+    def _recommend_prompt(self, user_fund_details: List[Any], candidates: Optional[List[Any]] = None) -> str:
+        if candidates:
+            # Compact rows; every character here is paid for on each call
+            return load_prompt(
+                SHORTLIST_PROMPT,
+                user_fund_details_json=json.dumps(user_fund_details, default=str, separators=(",", ":")),
+                candidates_json=json.dumps(candidates, default=str, separators=(",", ":"))
+            )
+        return load_prompt(
+            RECOMMEND_PROMPT,
             user_fund_details_json=json.dumps(user_fund_details, default=str)
         )
+
+    def recommend_prompt_chars(self, user_fund_details: List[Any], candidates: Optional[List[Any]] = None) -> int:
+        """Length of the recommendation prompt these inputs produce."""
+        return len(self._recommend_prompt(user_fund_details, candidates))
+
+    def _recommend_cache_key(self, details: List[Any], candidates: Optional[List[Any]]) -> str:
+        if candidates:
+            return self._cache_key(SHORTLIST_PROMPT, {"user_fund_details": details, "candidates": candidates})
+        return self._cache_key(RECOMMEND_PROMPT, details)
+
+    def _enrich_prompt(self, payload: Dict[str, Any]) -> str:
+        return load_prompt(
+            ENRICH_PROMPT,
+            payload_json=json.dumps(payload, default=str)
+        )
+
+    def recommend_fund_names(
+        self, user_fund_details: List[Any], use_cache: bool = True, candidates: Optional[List[Any]] = None
+    ) -> Dict[str, List[str]]:
+        """
+        Given user fund details, recommend 5 fund NAMES only; with
+        `candidates` (the local shortlist as compact rows), Gemini chooses
+        among those.
+        Identical portfolios are answered from the response cache.
+        """
+        details = _sorted_funds(user_fund_details)
+        if self._cache_enabled(use_cache):
+            key = self._recommend_cache_key(details, candidates)
+            clean = self.cache.get_or_load(key, lambda: self._generate_recommendation(details, candidates))
+        else:
+            clean = self._generate_recommendation(details, candidates)
+        # Callers mutate results, so never hand out the cached object itself
+        return copy.deepcopy(clean) if clean else {"recommended_fund_names": []}
+
+    async def recommend_fund_names_async(
+        self, user_fund_details: List[Any], use_cache: bool = True, candidates: Optional[List[Any]] = None
+    ) -> Dict[str, List[str]]:
+        """
+        Async variant of `recommend_fund_names` using the non-blocking Gemini client.
+        """
+        details = _sorted_funds(user_fund_details)
+        if self._cache_enabled(use_cache):
+            key = self._recommend_cache_key(details, candidates)
+            clean = await self.cache.aget_or_load(key, lambda: self._generate_recommendation_async(details, candidates))
+        else:
+            clean = await self._generate_recommendation_async(details, candidates)
+        return copy.deepcopy(clean) if clean else {"recommended_fund_names": []}
+
+    def enrich_recommendations(self, payload: Dict[str, Any], use_cache: bool = True) -> Dict[str, Any]:
+        """
+        Adds pros, cons, and ranking to final funds.
+        """
+        payload = {key: _sorted_funds(funds) for key, funds in payload.items()}
+        if self._cache_enabled(use_cache):
+            key = self._cache_key(ENRICH_PROMPT, payload)
+            clean = self.cache.get_or_load(key, lambda: self._generate_enrichment(payload))
+        else:
+            clean = self._generate_enrichment(payload)
+        return copy.deepcopy(clean)
+
+    async def enrich_recommendations_async(self, payload: Dict[str, Any], use_cache: bool = True) -> Dict[str, Any]:
+        """
+        Async variant of `enrich_recommendations`.
+        """
+        payload = {key: _sorted_funds(funds) for key, funds in payload.items()}
+        if self._cache_enabled(use_cache):
+            key = self._cache_key(ENRICH_PROMPT, payload)
+            clean = await self.cache.aget_or_load(key, lambda: self._generate_enrichment_async(payload))
+        else:
+            clean = await self._generate_enrichment_async(payload)
+        return copy.deepcopy(clean)
+
+    @gemini_retry
+    def _generate_recommendation(self, user_fund_details: List[Any], candidates: Optional[List[Any]] = None) -> Optional[Dict[str, List[str]]]:
+        prompt = self._recommend_prompt(user_fund_details, candidates)
         try:
-            resp = self.client.models.generate_content(
-                model=self.model,
-                contents=prompt,
-                config=types.GenerateContentConfig(temperature=0.2)
-            )
-            clean = extract_json(resp.text.strip())
-            return clean if clean else {"recommended_fund_names": []}
+            with self.limiter.limit(), external_call("gemini", "recommend"):
+                resp = self.client.models.generate_content(
+                    model=self.model,
+                    contents=prompt,
+                    config=self.config
+                )
+            _record_usage(resp, "recommend")
+            return _checked(extract_json(resp.text.strip()), _valid_recommendation, "recommend")
         except Exception as e:
             logger.error(f"Gemini recommendation ERROR: {e}")
             raise e  # Reraise to trigger retry
 
-    @retry(
-        stop=stop_after_attempt(3),
-        wait=wait_exponential(multiplier=1, min=2, max=10),
-        retry=retry_if_exception_type(Exception),
-        reraise=True,
-        before_sleep=before_sleep_log(logger, logging.WARNING)
-    )
-    def enrich_recommendations(self, payload: Dict[str, Any]) -> Dict[str, Any]:
-        """
-        Adds pros, cons, and ranking to final funds.
-        """
-        prompt = load_prompt(
-            "fund_enrichment.txt",
-            payload_json=json.dumps(payload, default=str)
-        )
+    @gemini_retry
+    async def _generate_recommendation_async(self, user_fund_details: List[Any], candidates: Optional[List[Any]] = None) -> Optional[Dict[str, List[str]]]:
+        prompt = self._recommend_prompt(user_fund_details, candidates)
         try:
-            resp = self.client.models.generate_content(
-                model=self.model,
-                contents=prompt,
-                config=types.GenerateContentConfig(temperature=0.2)
-            )
-            clean = extract_json(resp.text.strip())
-            return clean
+            async with self.limiter.limit_async():
+                with external_call("gemini", "recommend"):
+                    resp = await self.client.aio.models.generate_content(
+                        model=self.model,
+                        contents=prompt,
+                        config=self.config
+                    )
+            _record_usage(resp, "recommend")
+            return _checked(extract_json(resp.text.strip()), _valid_recommendation, "recommend")
+        except Exception as e:
+            logger.error(f"Gemini recommendation ERROR: {e}")
+            raise e
+
+    @gemini_retry
+    def _generate_enrichment(self, payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        prompt = self._enrich_prompt(payload)
+        try:
+            with self.limiter.limit(), external_call("gemini", "enrich"):
+                resp = self.client.models.generate_content(
+                    model=self.model,
+                    contents=prompt,
+                    config=self.config
+                )
+            _record_usage(resp, "enrich")
+            return _checked(extract_json(resp.text.strip()), _valid_enrichment, "enrich")
+        except Exception as e:
+            logger.error(f"Gemini enrichment ERROR: {e}")
+            raise e
+
+    @gemini_retry
+    async def _generate_enrichment_async(self, payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        prompt = self._enrich_prompt(payload)
+        try:
+            async with self.limiter.limit_async():
+                with external_call("gemini", "enrich"):
+                    resp = await self.client.aio.models.generate_content(
+                        model=self.model,
+                        contents=prompt,
+                        config=self.config
+                    )
+            _record_usage(resp, "enrich")
+            return _checked(extract_json(resp.text.strip()), _valid_enrichment, "enrich")
         except Exception as e:
             logger.error(f"Gemini enrichment ERROR: {e}")
             raise e
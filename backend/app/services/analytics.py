@@ -0,0 +1,346 @@
+import logging
+from datetime import date
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.models.mutual_funds import SIPTransaction, SIPInstallments, SIPSchedule
+from app.schemas.fund import FundDetails
+from app.services.fund_metrics import CATEGORY_LABELS, RISK_LABELS, fund_metrics_store
+from app.services.portfolio import paid_installments
+from app.utils.cache import LRUTTLCache
+
+logger = logging.getLogger(__name__)
+
+# Fund returns derived from the NAV history, as {label: months back}
+RETURN_PERIODS = {"1Y": 12, "3Y": 36, "5Y": 60}
+XIRR_MAX_ITERATIONS = 50
+XIRR_TOLERANCE = 1e-7
+
+
+def _percent(value: float) -> Optional[str]:
+    return f"{value * 100:.2f}%" if np.isfinite(value) else None
+
+
+def _runs(keys: np.ndarray):
+    """(starts, counts, position within run) of the runs of equal values in `keys`."""
+    starts = np.r_[0, np.flatnonzero(keys[1:] != keys[:-1]) + 1]
+    counts = np.diff(np.r_[starts, len(keys)])
+    return starts, counts, np.arange(len(keys)) - np.repeat(starts, counts)
+
+
+def _placed_months(starts: np.ndarray, counts: np.ndarray, position: np.ndarray, due_dates: List[Optional[date]]) -> np.ndarray:
+    """
+    Month (as months since 1970) of each installment: installment k of a SIP
+    with n installments is placed n - k months before its next_due_date.
+    Installments of SIPs without a next due date (stopped) get -1.
+    """
+    due_month = np.array(
+        [np.datetime64(due_dates[s], "M").astype(np.int64) if due_dates[s] else -1 for s in starts], dtype=np.int64
+    )
+    month = np.repeat(due_month, counts) - (np.repeat(counts, counts) - position)
+    return np.where(np.repeat(due_month, counts) >= 0, month, -1)
+
+
+class InstallmentAnalyticsService:
+    """
+    Analytics computed locally from SIPInstallments, in vectorised passes:
+
+    * fund level, once per scheme: NAV, NAV month and NAV-based 1Y/3Y/5Y
+      returns, from the installments of up to LOCAL_ANALYTICS_SAMPLE_SIPS
+      active SIPs of the scheme, averaged per month. Every user holding the
+      scheme sees the same figures, so their pipeline inputs (and Gemini
+      cache keys) match. Cached for FUND_CACHE_TTL_SECONDS.
+    * holding level, per (user, scheme), on request (`compute`): invested,
+      units, value at the fund NAV, gain and XIRR. These never go into a
+      prompt, so the pipelines only use the fund level.
+
+    Only paid installments count. Installments carry no date, so installment k of a SIP with n installments
+    is placed n - k months before the SIP's next_due_date. SIPs without one
+    (stopped) cannot be placed and are left out of NAV histories and XIRR.
+    """
+
+    def __init__(self):
+        self._funds = LRUTTLCache(maxsize=settings.FUND_CACHE_MAX_ENTRIES, ttl_seconds=settings.FUND_CACHE_TTL_SECONDS)
+
+    def _load_rows(self, db: Session, user_ids: List[str]):
+        schedules = self._schedules(db)
+        return (
+            db.query(
+                SIPTransaction.user_id,
+                SIPTransaction.scheme_code,
+                SIPInstallments.sip_id,
+                SIPInstallments.amount,
+                SIPInstallments.nav,
+                SIPInstallments.units,
+                schedules.c.next_due_date,
+            )
+            .join(SIPInstallments, SIPInstallments.sip_id == SIPTransaction.id)
+            .outerjoin(schedules, schedules.c.sip_id == SIPTransaction.id)
+            .filter(SIPTransaction.user_id.in_(user_ids))
+            .filter(SIPInstallments.units.isnot(None), SIPInstallments.nav > 0, paid_installments())
+            .order_by(SIPInstallments.sip_id, SIPInstallments.id)
+            .all()
+        )
+
+    @staticmethod
+    def _schedules(db: Session):
+        return (
+            db.query(
+                SIPSchedule.sip_id.label("sip_id"),
+                func.max(SIPSchedule.next_due_date).label("next_due_date"),
+                func.max(func.coalesce(SIPSchedule.completed_installments, 0)).label("completed"),
+            )
+            .group_by(SIPSchedule.sip_id)
+            .subquery()
+        )
+
+    def _load_fund_rows(self, db: Session, scheme_codes: List[str]):
+        """
+        Installment NAVs of the sample SIPs of each scheme: active SIPs (next
+        due date not older than LOCAL_ANALYTICS_MAX_NAV_AGE_MONTHS), longest
+        histories first. The sample depends on the data only, not on which
+        users asked.
+        """
+        schedules = self._schedules(db)
+        this_month = np.datetime64(date.today(), "M")
+        active_since = (this_month - settings.LOCAL_ANALYTICS_MAX_NAV_AGE_MONTHS).astype(date)
+        sips = (
+            db.query(
+                SIPTransaction.id.label("sip_id"),
+                SIPTransaction.scheme_code.label("scheme_code"),
+                schedules.c.next_due_date.label("next_due_date"),
+                func.row_number().over(
+                    partition_by=SIPTransaction.scheme_code,
+                    order_by=(schedules.c.completed.desc(), schedules.c.next_due_date.desc(), SIPTransaction.id),
+                ).label("rank"),
+            )
+            .join(schedules, schedules.c.sip_id == SIPTransaction.id)
+            .filter(SIPTransaction.scheme_code.in_(scheme_codes), schedules.c.next_due_date >= active_since)
+            .subquery()
+        )
+        return (
+            db.query(sips.c.scheme_code, SIPInstallments.sip_id, SIPInstallments.nav, sips.c.next_due_date)
+            .join(sips, sips.c.sip_id == SIPInstallments.sip_id)
+            .filter(sips.c.rank <= max(settings.LOCAL_ANALYTICS_SAMPLE_SIPS, 1))
+            .filter(SIPInstallments.units.isnot(None), SIPInstallments.nav > 0, paid_installments())
+            .order_by(SIPInstallments.sip_id, SIPInstallments.id)
+            .all()
+        )
+
+    def fund_analytics(self, db: Session, scheme_codes: Iterable[str]) -> Dict[str, Optional[Dict[str, Any]]]:
+        """
+        Fund-level analytics per scheme code (None where the scheme has no
+        active SIP to derive them from), computed once per scheme.
+        """
+        result: Dict[str, Optional[Dict[str, Any]]] = {}
+        missing = []
+        for code in dict.fromkeys(scheme_codes):
+            cached = self._funds.get(code)
+            if cached is None:
+                missing.append(code)
+            else:
+                result[code] = cached or None
+        if missing:
+            computed = self._compute_funds(self._load_fund_rows(db, missing))
+            for code in missing:
+                result[code] = computed.get(code)
+                self._funds.set(code, result[code] or False)
+        return result
+
+    def _compute_funds(self, rows) -> Dict[str, Dict[str, Any]]:
+        if not rows:
+            return {}
+        schemes, sip_ids, navs, due_dates = zip(*rows)
+        sip = np.asarray(sip_ids)
+        starts, counts, position = _runs(sip)
+        month = _placed_months(starts, counts, position, due_dates)
+
+        scheme_ids: Dict[str, int] = {}
+        g = np.repeat([scheme_ids.setdefault(schemes[s], len(scheme_ids)) for s in starts], counts)
+
+        # Average NAV per (scheme, month); np.unique sorts by scheme, then month
+        span = int(month.max() - month.min()) + 1
+        keys, inverse = np.unique(g * span + (month - month.min()), return_inverse=True)
+        monthly_nav = np.bincount(inverse, weights=np.asarray(navs, dtype=float)) / np.bincount(inverse)
+        group, monthly = keys // span, keys % span + month.min()
+
+        last = np.r_[np.flatnonzero(group[1:] != group[:-1]), len(keys) - 1]
+        first = np.r_[0, last[:-1] + 1]
+        latest_nav, latest_month, first_month = monthly_nav[last], monthly[last], monthly[first]
+        returns = {label: self._nav_returns(group, monthly, monthly_nav, latest_nav, latest_month, first_month, months)
+                   for label, months in RETURN_PERIODS.items()}
+
+        oldest_current = np.datetime64(date.today(), "M").astype(np.int64) - settings.LOCAL_ANALYTICS_MAX_NAV_AGE_MONTHS
+        result = {}
+        for code, i in scheme_ids.items():
+            history_months = int(latest_month[i] - first_month[i]) + 1
+            result[code] = {
+                "scheme_code": code,
+                "nav": f"{latest_nav[i]:.4f}",
+                "nav_date": str(np.datetime64(int(latest_month[i]), "M")),
+                "returns": {label: _percent(r[i]) for label, r in returns.items() if np.isfinite(r[i])},
+                "months_of_history": history_months,
+                "sufficient": history_months > settings.LOCAL_ANALYTICS_MIN_HISTORY_MONTHS
+                and latest_month[i] >= oldest_current,
+            }
+        return result
+
+    def compute(self, db: Session, user_ids: Iterable[str]) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """
+        Analytics for every holding of `user_ids`:
+        {user_id: {scheme_code: {"scheme_code", "fund", "holding"}}}, where
+        "fund" is the scheme's fund-level analytics (None if unavailable).
+        The pipelines need only the fund level; use `portfolio_fund_analytics`
+        there rather than paying for the per-installment holding pass.
+        """
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        rows = self._load_rows(db, user_ids)
+        if not rows:
+            return {}
+
+        users, schemes, sip_ids, amounts, navs, units, due_dates = zip(*rows)
+        funds = self.fund_analytics(db, schemes)
+        sip = np.asarray(sip_ids)
+        amount = np.asarray(amounts, dtype=float)
+        unit = np.asarray(units, dtype=float)
+        starts, counts, position = _runs(sip)
+        month = _placed_months(starts, counts, position, due_dates)
+
+        # One group per (user, scheme); a user may hold several SIPs of a scheme
+        group_ids: Dict[tuple, int] = {}
+        sip_group = np.array([group_ids.setdefault((users[s], schemes[s]), len(group_ids)) for s in starts])
+        g = np.repeat(sip_group, counts)
+        groups = len(group_ids)
+
+        invested = np.bincount(g, weights=amount, minlength=groups)
+        total_units = np.bincount(g, weights=unit, minlength=groups)
+        installments = np.bincount(g, minlength=groups)
+
+        # Holdings are valued at the fund's NAV, not at the user's last installment NAV
+        fund_nav = np.full(groups, np.nan)
+        fund_month = np.full(groups, -1, dtype=np.int64)
+        for (_, scheme_code), i in group_ids.items():
+            fund = funds.get(scheme_code)
+            if fund:
+                fund_nav[i] = float(fund["nav"])
+                fund_month[i] = np.datetime64(fund["nav_date"], "M").astype(np.int64)
+        value = total_units * fund_nav
+
+        # XIRR needs every installment placed in time and a fund NAV to value them at
+        placed = np.bincount(g, weights=(month >= 0), minlength=groups) == installments
+        xirr = self._xirr(g, amount, (fund_month[g] - month) / 12.0, np.nan_to_num(value), invested)
+        xirr = np.where(placed & np.isfinite(value), xirr, np.nan)
+
+        result: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        for (user_id, scheme_code), i in group_ids.items():
+            result.setdefault(user_id, {})[scheme_code] = {
+                "scheme_code": scheme_code,
+                "fund": funds.get(scheme_code),
+                "holding": {
+                    "invested": round(float(invested[i]), 2),
+                    "units": round(float(total_units[i]), 4),
+                    "current_value": round(float(value[i]), 2) if np.isfinite(value[i]) else None,
+                    "gain": round(float(value[i] - invested[i]), 2) if np.isfinite(value[i]) else None,
+                    "xirr": _percent(xirr[i]),
+                    "installments": int(installments[i]),
+                },
+            }
+        return result
+
+    def _nav_returns(self, group, month, nav, latest_nav, latest_month, first_month, months: int) -> np.ndarray:
+        """
+        Return over the last `months` (annualised beyond a year) from the NAV
+        history; NaN where the history is too short or has a gap there.
+        """
+        span = int(month.max() - month.min()) + months + 2
+        keys = group * span + (month - month.min())
+        target = latest_month - months
+        target_keys = np.arange(len(latest_nav)) * span + (target - month.min())
+
+        idx = np.searchsorted(keys, target_keys, side="right") - 1
+        idx = np.clip(idx, 0, len(keys) - 1)
+        found = (group[idx] == np.arange(len(latest_nav))) & (target >= first_month) & (month[idx] >= target - 1)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            growth = latest_nav / nav[idx]
+            result = growth ** (12.0 / max(months, 12)) - 1
+        return np.where(found, result, np.nan)
+
+    def _xirr(self, group, amount, years_before, value, invested) -> np.ndarray:
+        """
+        Annualised return r with sum(amount * (1 + r) ** years_before) == value,
+        solved by Newton's method for all groups at once. NaN if it does not converge.
+        """
+        groups = len(value)
+        rate = np.full(groups, 0.1)
+        for _ in range(XIRR_MAX_ITERATIONS):
+            base = 1 + rate[group]
+            growth = base ** years_before
+            f = value - np.bincount(group, weights=amount * growth, minlength=groups)
+            df = -np.bincount(group, weights=amount * years_before * growth / base, minlength=groups)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                step = np.where(df != 0, f / df, 0.0)
+            new_rate = np.maximum(rate - step, -0.99)
+            done = np.all(np.abs(new_rate - rate) < XIRR_TOLERANCE)
+            rate = new_rate
+            if done:
+                break
+
+        growth = (1 + rate[group]) ** years_before
+        residual = np.abs(value - np.bincount(group, weights=amount * growth, minlength=groups))
+        # Holdings with all installments in the valuation month have no defined rate
+        has_history = np.bincount(group, weights=years_before, minlength=groups) > 0
+        return np.where((residual <= 1e-6 * np.maximum(invested, 1)) & has_history, rate, np.nan)
+
+    def portfolio_fund_analytics(self, db: Session, portfolios: Iterable[List[Dict[str, Any]]]) -> Dict[str, Optional[Dict[str, Any]]]:
+        """Fund-level analytics for every scheme held in `portfolios`, as `fund_analytics`."""
+        return self.fund_analytics(db, (entry["scheme_code"] for portfolio in portfolios for entry in portfolio))
+
+    def fund_details(self, portfolio: List[Dict[str, Any]], funds: Optional[Dict[str, Optional[Dict[str, Any]]]]) -> Dict[str, Dict[str, Any]]:
+        """
+        Pipeline-ready fund details ({scheme_name: details}) for the held
+        funds with a recent, long enough NAV history whose category and risk
+        level are known from the fund metrics store. Only fund-level fields
+        are included, so users holding the same funds send the same details.
+        """
+        if not settings.FUND_METRICS_ENABLED:
+            return {}
+        snapshot = fund_metrics_store.snapshot()
+        details = {}
+        for entry in portfolio:
+            fund = (funds or {}).get(entry["scheme_code"])
+            if not fund or not fund["sufficient"]:
+                continue
+            metrics = snapshot.get(entry["scheme_code"])
+            if metrics is None or not metrics.category or not metrics.risk_level:
+                continue
+            data = FundDetails(
+                name=entry["scheme_name"],
+                scheme_code=entry["scheme_code"],
+                category=CATEGORY_LABELS[metrics.category],
+                nav=fund["nav"],
+                aum=f"₹{metrics.aum_crore:,.0f} Cr" if metrics.aum_crore is not None else None,
+                returns=fund["returns"],
+                risk_level=RISK_LABELS[metrics.risk_level],
+            ).dict()
+            data.update(nav_date=fund["nav_date"], source="local")
+            details[entry["scheme_name"]] = data
+        return details
+
+    def fund_details_for_user(self, db: Session, user_id: str, portfolio: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        if not settings.LOCAL_ANALYTICS_ENABLED or not portfolio:
+            return {}
+        try:
+            return self.fund_details(portfolio, self.portfolio_fund_analytics(db, [portfolio]))
+        except Exception as e:
+            logger.warning(f"Local analytics failed for user {user_id}, fetching all held funds: {e}")
+            return {}
+
+
+installment_analytics = InstallmentAnalyticsService()
@@ -0,0 +1,524 @@
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Set, Tuple
+
+from pymongo import UpdateOne
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.db.bulk_writer import BulkUpsertWriter
+from app.db.mongo import mongo_db
+from app.services.analytics import installment_analytics
+from app.services.fund_metrics import fund_metrics_store
+from app.services.fund_universe import fund_universe
+from app.services.portfolio import portfolio_service
+from app.services.recommendation import recommendation_service
+from app.utils.common import normalize_fund_name
+from app.utils.timer import Timer
+
+logger = logging.getLogger(__name__)
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """
+    Parse a shard spec like "2/8" into (index, count) with 0 <= index < count.
+    """
+    try:
+        index_str, count_str = value.split("/", 1)
+        index, count = int(index_str), int(count_str)
+    except ValueError:
+        raise ValueError(f"Invalid shard '{value}', expected the form i/N (e.g. 0/4)")
+
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard '{value}', index must be in [0, N)")
+    return index, count
+
+
+def in_shard(user_id: str, index: int, count: int) -> bool:
+    """
+    Stable user -> shard assignment that does not depend on the order or
+    size of the user list, so every machine agrees on the split.
+    """
+    if count == 1:
+        return True
+    digest = hashlib.md5(str(user_id).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count == index
+
+
+class BatchCheckpoint:
+    """
+    Per-run progress persisted in MongoDB so a crashed run can resume.
+    Every finished user is recorded individually because workers complete
+    out of order.
+    """
+    RUNS_COLLECTION = "batch_runs"
+    USERS_COLLECTION = "batch_checkpoints"
+
+    def __init__(self, run_id: str, shard: Tuple[int, int]):
+        self.run_id = run_id
+        self.shard = shard
+
+    @property
+    def _runs(self):
+        return mongo_db.get_collection(self.RUNS_COLLECTION)
+
+    @property
+    def _users(self):
+        return mongo_db.get_collection(self.USERS_COLLECTION)
+
+    @classmethod
+    def latest_unfinished_run(cls, shard: Tuple[int, int]) -> Optional[str]:
+        runs = mongo_db.get_collection(cls.RUNS_COLLECTION)
+        doc = runs.find_one(
+            {"shard": f"{shard[0]}/{shard[1]}", "status": "running"},
+            sort=[("started_at", -1)],
+        )
+        return doc["_id"] if doc else None
+
+    def start(self) -> None:
+        self._users.create_index("run_id")
+        now = datetime.now(timezone.utc)
+        self._runs.update_one(
+            {"_id": self.run_id},
+            {
+                "$set": {"status": "running", "updated_at": now},
+                "$setOnInsert": {"shard": f"{self.shard[0]}/{self.shard[1]}", "started_at": now},
+            },
+            upsert=True,
+        )
+
+    def completed_user_ids(self) -> Set[str]:
+        cursor = self._users.find({"run_id": self.run_id, "status": "done"}, {"user_id": 1, "_id": 0})
+        return {doc["user_id"] for doc in cursor}
+
+    def _mark_op(self, user_id: str, status: str, error: Optional[str], now: datetime) -> UpdateOne:
+        return UpdateOne(
+            {"_id": f"{self.run_id}:{user_id}"},
+            {"$set": {
+                "run_id": self.run_id,
+                "user_id": user_id,
+                "status": status,
+                "error": error,
+                "finished_at": now,
+            }},
+            upsert=True,
+        )
+
+    def mark(self, user_id: str, status: str, error: Optional[str] = None) -> None:
+        self.mark_many([user_id], status, {user_id: error} if error else None)
+
+    def mark_many(self, user_ids: List[str], status: str, errors: Optional[Dict[str, str]] = None) -> None:
+        """Record several users in one round-trip."""
+        if not user_ids:
+            return
+        now = datetime.now(timezone.utc)
+        errors = errors or {}
+        self._users.bulk_write(
+            [self._mark_op(u, status, errors.get(u), now) for u in user_ids],
+            ordered=False,
+        )
+
+    def finish(self, summary: dict) -> None:
+        self._runs.update_one(
+            {"_id": self.run_id},
+            {"$set": {"status": "finished", "updated_at": datetime.now(timezone.utc), "summary": summary}},
+        )
+
+
+class BatchProgress:
+    """
+    Thread-safe progress counters with throughput and ETA reporting.
+    """
+
+    def __init__(self, total: int, interval_seconds: float):
+        self.total = total
+        self.interval_seconds = interval_seconds
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+        self.unchanged = 0
+        self._start = time.monotonic()
+        self._last_report = self._start
+        self._lock = threading.Lock()
+
+    @property
+    def processed(self) -> int:
+        return self.succeeded + self.failed + self.skipped + self.unchanged
+
+    def record(self, outcome: str) -> None:
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            now = time.monotonic()
+            if now - self._last_report >= self.interval_seconds:
+                self._last_report = now
+                self.report()
+
+    def summary(self) -> dict:
+        elapsed = time.monotonic() - self._start
+        rate = self.processed / elapsed * 60 if elapsed > 0 else 0.0
+        remaining = self.total - self.processed
+        eta = remaining / rate * 60 if rate > 0 else None
+        return {
+            "total": self.total,
+            "processed": self.processed,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "unchanged": self.unchanged,
+            "elapsed_seconds": round(elapsed, 1),
+            "users_per_minute": round(rate, 2),
+            "eta_seconds": round(eta) if eta is not None else None,
+        }
+
+    def report(self) -> None:
+        s = self.summary()
+        pct = s["processed"] / s["total"] * 100 if s["total"] else 100.0
+        eta = time.strftime("%H:%M:%S", time.gmtime(s["eta_seconds"])) if s["eta_seconds"] is not None else "n/a"
+        logger.info(
+            f"Progress: {s['processed']}/{s['total']} users ({pct:.1f}%) | "
+            f"{s['users_per_minute']} users/min | errors={s['failed']} skipped={s['skipped']} unchanged={s['unchanged']} | ETA {eta}"
+        )
+
+
+class FundPrefetch:
+    """
+    Fetches the distinct held funds of a run once, before the users holding
+    them are processed. Each chunk of work only fetches funds no earlier
+    chunk has seen, and funds covered by local analytics are skipped.
+    Pipelines receive per-user copies taken from the snapshot, so their
+    step 1 is a lookup; funds whose prefetch failed are fetched by the
+    pipeline as before.
+    """
+
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self._details: Dict[str, Dict[str, Any]] = {}
+        self._attempted: Set[str] = set()
+        self.references = 0
+        self.local_references = 0
+        self.failed = 0
+        self.seconds = 0.0
+
+    @property
+    def snapshot(self) -> Mapping[str, Dict[str, Any]]:
+        """Read-only view of the prefetched details, keyed by normalized fund name."""
+        return MappingProxyType(self._details)
+
+    @staticmethod
+    def _remote_names(portfolio: List[dict], local_details: Dict[str, dict]) -> Tuple[List[str], int]:
+        """Canonical held fund names not covered by local analytics, plus the held fund count."""
+        names = fund_universe.canonicalize([p["scheme_name"] for p in portfolio])
+        local = {normalize_fund_name(name) for name in local_details}
+        return [n for n in names if normalize_fund_name(n) not in local], len(names)
+
+    def prepare(self, work: List[Tuple[str, List[dict], Dict[str, dict]]]) -> None:
+        """Fetch the funds of `work` (user_id, portfolio, local details) that are not known yet."""
+        missing: Dict[str, str] = {}
+        for _, portfolio, local_details in work:
+            remote, held = self._remote_names(portfolio, local_details)
+            self.references += held
+            self.local_references += held - len(remote)
+            for name in remote:
+                key = normalize_fund_name(name)
+                if key not in self._attempted:
+                    missing.setdefault(key, name)
+        if not missing:
+            return
+
+        with Timer() as t:
+            found = recommendation_service.fetch_details_by_name(list(missing.values()), self.concurrency)
+        self.seconds += t.elapsed
+        failed = 0
+        for key, name in missing.items():
+            self._attempted.add(key)
+            if found.get(name):
+                self._details[key] = found[name]
+            else:
+                failed += 1
+        self.failed += failed
+        logger.info(f"Prefetched {len(missing) - failed}/{len(missing)} new funds in {t.elapsed:.1f}s")
+
+    def details_for(self, portfolio: List[dict], local_details: Dict[str, dict]) -> Dict[str, dict]:
+        """Per-user details: prefetched funds plus local analytics (which take precedence)."""
+        remote, _ = self._remote_names(portfolio, local_details)
+        details = {name: dict(self._details[normalize_fund_name(name)]) for name in remote if normalize_fund_name(name) in self._details}
+        details.update(local_details)
+        return details
+
+    def stats(self) -> Dict[str, Any]:
+        remote_references = self.references - self.local_references
+        return {
+            "fund_references": self.references,
+            "served_locally": self.local_references,
+            "remote_references": remote_references,
+            "distinct_funds": len(self._attempted),
+            "prefetched": len(self._details),
+            "failed": self.failed,
+            "fetches_saved": max(remote_references - len(self._attempted), 0),
+            "seconds": round(self.seconds, 1),
+        }
+
+
+class BatchProcessor:
+    """
+    Runs the recommendation pipeline for many users on a worker pool.
+    Results are saved through a BulkUpsertWriter; a user only counts as
+    done (progress and checkpoint) once its document has been written.
+
+    Unless `force` is set, users whose portfolio fingerprint and pipeline
+    version match their stored recommendation, and whose recommendation is
+    younger than RECOMMENDATION_MAX_AGE_DAYS, are not recomputed.
+    """
+    STATE_FIELDS = {"_id": 0, "user_id": 1, "portfolio_fingerprint": 1, "model": 1, "prompt_versions": 1, "generated_at": 1}
+    STATE_QUERY_CHUNK = 1000
+
+    def __init__(self, run_id: str, workers: int = None, shard: Tuple[int, int] = (0, 1), force: bool = False):
+        self.workers = max(workers or settings.BATCH_WORKERS, 1)
+        self.shard = shard
+        self.force = force
+        self.checkpoint = BatchCheckpoint(run_id, shard)
+        self._stored: Dict[str, Dict[str, Any]] = {}
+        self._version: Dict[str, Any] = {}
+        self.prefetch = FundPrefetch(settings.BATCH_PREFETCH_CONCURRENCY) if settings.BATCH_PREFETCH_FUNDS else None
+
+    def _load_stored_states(self, user_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Fingerprint/version/age of the stored recommendation of each user,
+        fetched in indexed chunks.
+        """
+        states = {}
+        for i in range(0, len(user_ids), self.STATE_QUERY_CHUNK):
+            chunk = user_ids[i:i + self.STATE_QUERY_CHUNK]
+            for doc in mongo_db.collection.find({"user_id": {"$in": chunk}}, self.STATE_FIELDS):
+                states[doc["user_id"]] = doc
+        return states
+
+    def _is_current(self, user_id: str, portfolio: List[dict]) -> bool:
+        """True if the stored recommendation can be kept as is."""
+        state = self._stored.get(user_id)
+        if not state or state.get("portfolio_fingerprint") != portfolio_service.portfolio_fingerprint(portfolio):
+            return False
+        if any(state.get(key) != value for key, value in self._version.items()):
+            return False
+
+        generated_at = state.get("generated_at")
+        if generated_at is None:
+            return False
+        if generated_at.tzinfo is None:
+            # pymongo returns naive datetimes in UTC
+            generated_at = generated_at.replace(tzinfo=timezone.utc)
+        max_age = timedelta(days=settings.RECOMMENDATION_MAX_AGE_DAYS)
+        return datetime.now(timezone.utc) - generated_at < max_age
+
+    def _writer(self, progress: "BatchProgress") -> BulkUpsertWriter:
+        return BulkUpsertWriter(
+            collection_getter=lambda: mongo_db.collection,
+            key_field="user_id",
+            batch_size=settings.RESULT_WRITE_BATCH_SIZE,
+            flush_interval=settings.RESULT_WRITE_FLUSH_SECONDS,
+            on_flush=lambda written, failed: self._record_flush(progress, written, failed),
+        )
+
+    def _record_flush(self, progress: "BatchProgress", written: List[str], failed: Dict[str, str]) -> None:
+        try:
+            self.checkpoint.mark_many(written, "done")
+            self.checkpoint.mark_many(list(failed), "failed", failed)
+        except Exception as e:
+            logger.warning(f"Could not checkpoint {len(written) + len(failed)} users: {e}")
+
+        for _ in written:
+            progress.record("succeeded")
+        for user_id, error in failed.items():
+            logger.error(f"Error saving user {user_id}: {error}")
+            progress.record("failed")
+        if written:
+            logger.info(f"Saved {len(written)} users")
+
+    def _process_user(self, user_id: str, portfolio: List[dict], local_details: Dict[str, dict], writer: BulkUpsertWriter) -> None:
+        """
+        Run the pipeline for one user and queue the result for writing.
+        """
+        document = recommendation_service.recommend_for_portfolio(user_id, portfolio, local_details)
+        writer.add(document)
+
+    def _record_failure(self, user_id: str, error: Exception, progress: "BatchProgress") -> None:
+        logger.error(f"Error processing user {user_id}: {error}")
+        progress.record("failed")
+        try:
+            self.checkpoint.mark(user_id, "failed", error=str(error))
+        except Exception as ce:
+            logger.warning(f"Could not checkpoint failure for user {user_id}: {ce}")
+
+    def _run_task(self, user_id: str, portfolio: List[dict], local_details: Dict[str, dict], progress: "BatchProgress", writer: BulkUpsertWriter) -> None:
+        try:
+            self._process_user(user_id, portfolio, local_details, writer)
+        except Exception as e:
+            self._record_failure(user_id, e, progress)
+
+    async def _process_user_async(self, user_id: str, portfolio: List[dict], local_details: Dict[str, dict], writer: BulkUpsertWriter) -> None:
+        document = await recommendation_service.recommend_for_portfolio_async(user_id, portfolio, local_details)
+        # add() may flush a full batch, which blocks on MongoDB
+        await asyncio.to_thread(writer.add, document)
+
+    async def _run_task_async(self, user_id: str, portfolio: List[dict], local_details: Dict[str, dict], progress: "BatchProgress", writer: BulkUpsertWriter) -> None:
+        try:
+            await self._process_user_async(user_id, portfolio, local_details, writer)
+        except Exception as e:
+            logger.error(f"Error processing user {user_id}: {e}")
+            progress.record("failed")
+            try:
+                await asyncio.to_thread(self.checkpoint.mark, user_id, "failed", str(e))
+            except Exception as ce:
+                logger.warning(f"Could not checkpoint failure for user {user_id}: {ce}")
+
+    def _plan(self, user_ids: Iterable[str]) -> List[str]:
+        """
+        Start the checkpointed run and return this shard's users not yet done.
+        """
+        self.checkpoint.start()
+
+        shard_users = sorted(u for u in user_ids if in_shard(u, *self.shard))
+        completed = self.checkpoint.completed_user_ids()
+        pending: List[str] = [u for u in shard_users if u not in completed]
+
+        self._version = recommendation_service.pipeline_version()
+        self._stored = {} if self.force else self._load_stored_states(pending)
+
+        logger.info(
+            f"Run {self.checkpoint.run_id} shard {self.shard[0]}/{self.shard[1]}: "
+            f"{len(shard_users)} users in shard, {len(completed)} already done, "
+            f"{len(pending)} to process with {self.workers} workers"
+            f"{' (forced recompute)' if self.force else f', {len(self._stored)} with a stored recommendation'}."
+        )
+        return pending
+
+    def _skip_unchanged(self, user_id: str, portfolio: List[dict], unchanged: List[str], progress: "BatchProgress") -> bool:
+        if self.force or not self._is_current(user_id, portfolio):
+            return False
+        unchanged.append(user_id)
+        progress.record("unchanged")
+        return True
+
+    def _iter_work(self, db: Session, pending: List[str], seen: Set[str], unchanged: List[str], progress: "BatchProgress"):
+        """
+        Yield (user_id, portfolio, local fund details) for users that need
+        recomputing. Portfolios are aggregated a chunk at a time, followed by
+        one vectorised fund-analytics pass over the chunk's held schemes and,
+        unless disabled, a prefetch of the chunk's not yet seen held funds.
+        """
+        size = max(settings.PORTFOLIO_BULK_CHUNK_SIZE, 1)
+        for i in range(0, len(pending), size):
+            # Drain the stream first: the analytics query uses the same connection
+            portfolios = list(portfolio_service.iter_aggregated_portfolios(db, pending[i:i + size]))
+            todo = []
+            for user_id, portfolio in portfolios:
+                seen.add(user_id)
+                if not self._skip_unchanged(user_id, portfolio, unchanged, progress):
+                    todo.append((user_id, portfolio))
+
+            funds = {}
+            if settings.LOCAL_ANALYTICS_ENABLED and todo:
+                try:
+                    funds = installment_analytics.portfolio_fund_analytics(db, [portfolio for _, portfolio in todo])
+                except Exception as e:
+                    logger.warning(f"Local analytics failed for {len(todo)} users, fetching all held funds: {e}")
+
+            work = [(user_id, portfolio, installment_analytics.fund_details(portfolio, funds))
+                    for user_id, portfolio in todo]
+            if self.prefetch is None:
+                yield from work
+                continue
+
+            try:
+                self.prefetch.prepare(work)
+            except Exception as e:
+                logger.warning(f"Fund prefetch failed for {len(work)} users, pipelines will fetch themselves: {e}")
+            for user_id, portfolio, local_details in work:
+                yield user_id, portfolio, self.prefetch.details_for(portfolio, local_details)
+
+    def _flush_fund_metrics(self) -> dict:
+        """Publish the numeric metrics of every fund fetched during the run."""
+        try:
+            fund_metrics_store.flush()
+        except Exception as e:
+            # The recommendations are already written; the next run publishes these metrics
+            logger.error(f"Failed to write fund metrics: {e}")
+        return fund_metrics_store.stats()
+
+    def _finish(self, pending: List[str], seen: Set[str], unchanged: List[str], progress: "BatchProgress") -> dict:
+        missing = [u for u in pending if u not in seen]
+        for user_id in missing:
+            logger.warning(f"No portfolio found for user {user_id}, skipping.")
+            progress.record("skipped")
+        self.checkpoint.mark_many(missing + unchanged, "done")
+
+        progress.report()
+        summary = progress.summary()
+        if self.prefetch is not None:
+            summary["fund_prefetch"] = self.prefetch.stats()
+        if settings.FUND_METRICS_ENABLED:
+            summary["fund_metrics"] = self._flush_fund_metrics()
+        self.checkpoint.finish(summary)
+        return summary
+
+    def run(self, db: Session, user_ids: Iterable[str]) -> dict:
+        """
+        Process `user_ids` (restricted to this shard, minus users already done in
+        this run). Portfolios are streamed in bulk from `db` and handed to the
+        worker pool with a bounded number of users in flight.
+        """
+        pending = self._plan(user_ids)
+        progress = BatchProgress(len(pending), settings.BATCH_PROGRESS_INTERVAL_SECONDS)
+        in_flight = threading.BoundedSemaphore(self.workers * 2)
+        seen: Set[str] = set()
+        unchanged: List[str] = []
+
+        # Leaving the writer block flushes the remaining results, also on errors/interrupts
+        with self._writer(progress) as writer, \
+                ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="batch-user") as executor:
+            for user_id, portfolio, local_details in self._iter_work(db, pending, seen, unchanged, progress):
+                in_flight.acquire()
+                future = executor.submit(self._run_task, user_id, portfolio, local_details, progress, writer)
+                future.add_done_callback(lambda _: in_flight.release())
+
+        logger.info(f"Result writer stats: {writer.stats()}")
+        return self._finish(pending, seen, unchanged, progress)
+
+    async def run_async(self, db: Session, user_ids: Iterable[str]) -> dict:
+        """
+        Same as `run`, but drives `workers` pipelines concurrently on one event
+        loop via the async pipeline instead of a thread per user.
+        """
+        pending = await asyncio.to_thread(self._plan, user_ids)
+        progress = BatchProgress(len(pending), settings.BATCH_PROGRESS_INTERVAL_SECONDS)
+        in_flight = asyncio.Semaphore(self.workers)
+        seen: Set[str] = set()
+        unchanged: List[str] = []
+        tasks = set()
+
+        writer = self._writer(progress).start()
+        try:
+            work = self._iter_work(db, pending, seen, unchanged, progress)
+            while True:
+                # The SQL queries are blocking, so pull from the stream off the event loop
+                item = await asyncio.to_thread(next, work, None)
+                if item is None:
+                    break
+                user_id, portfolio, local_details = item
+                await in_flight.acquire()
+                task = asyncio.create_task(self._run_task_async(user_id, portfolio, local_details, progress, writer))
+                tasks.add(task)
+                task.add_done_callback(lambda t: (tasks.discard(t), in_flight.release()))
+
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            await asyncio.to_thread(writer.close)
+            logger.info(f"Result writer stats: {writer.stats()}")
+        return await asyncio.to_thread(self._finish, pending, seen, unchanged, progress)
@@ -0,0 +1,242 @@
+import logging
+import threading
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from app.core.config import settings
+from app.services.fund_metrics import FUND_CATEGORIES, FundMetricsSnapshot, fund_metrics_store, parse_category, parse_risk_level
+from app.services.fund_universe import fund_universe
+
+logger = logging.getLogger(__name__)
+
+# Reference allocation across category buckets; a bucket the user holds less
+# of than this is a gap worth filling
+TARGET_ALLOCATION = {
+    "large_cap": 0.25, "flexi_cap": 0.20, "large_mid_cap": 0.10, "mid_cap": 0.15,
+    "small_cap": 0.10, "index": 0.05, "hybrid": 0.10, "debt": 0.05,
+}
+# Blend of 1Y/3Y/5Y returns; longer periods say more about the fund than the market
+RETURN_WEIGHTS = np.array([0.2, 0.3, 0.5])
+# Weights of the category gap, risk fit and return scores (each in [0, 1])
+SCORE_WEIGHTS = {"gap": 1.0, "risk": 0.5, "returns": 0.75}
+# Riskometer level assumed for users whose holdings have no known risk (Moderately High)
+DEFAULT_RISK_LEVEL = 4.0
+
+
+class Candidate(NamedTuple):
+    scheme_code: str
+    name: str
+    category: str
+    risk_level: int
+    returns: Dict[str, Optional[float]]
+    blended_return: float
+    score: float
+
+    def prompt_row(self) -> List[Any]:
+        """[name, category, risk level, blended return %], the compact form used in the prompt."""
+        return [self.name, self.category, self.risk_level, self.blended_return]
+
+
+class _Holdings(NamedTuple):
+    codes: List[str]
+    names: List[Optional[str]]
+    rows: np.ndarray  # Row in the ranked universe, -1 if not ranked
+    category: np.ndarray
+    risk: np.ndarray
+    weights: np.ndarray
+
+
+class _RankedUniverse:
+    """
+    Per-version precomputation over the whole fund metrics store: scheme
+    names, category and risk codes and a within-category return percentile,
+    so scoring a user is a handful of vector operations.
+    """
+
+    def __init__(self, snapshot: FundMetricsSnapshot):
+        self.snapshot = snapshot
+        self.codes = np.asarray(snapshot["scheme_code"], dtype=str)
+        self.names = np.array(fund_universe.names_for(self.codes.tolist()), dtype=object)
+        self.category = np.asarray(snapshot["category"], dtype=np.int64)
+        self.risk = np.asarray(snapshot["risk_level"], dtype=np.float64)
+        self.returns = np.column_stack([np.asarray(snapshot[c], dtype=np.float64) for c in ("return_1y", "return_3y", "return_5y")]) \
+            if len(self.codes) else np.empty((0, 3))
+
+        known = np.isfinite(self.returns)
+        weights = known * RETURN_WEIGHTS
+        self.blended = np.where(known, self.returns, 0.0) @ RETURN_WEIGHTS / np.maximum(weights.sum(axis=1), 1e-9)
+        # Only funds we can name and judge by returns are candidates
+        self.eligible = known.any(axis=1) & np.array([n is not None for n in self.names], dtype=bool)
+        self.return_score = self._category_percentile(self.blended, self.eligible)
+
+        self.target = np.zeros(len(FUND_CATEGORIES))
+        for bucket, share in TARGET_ALLOCATION.items():
+            self.target[FUND_CATEGORIES.index(bucket)] = share
+
+    def _category_percentile(self, blended: np.ndarray, eligible: np.ndarray) -> np.ndarray:
+        """Rank of each fund's blended return within its category, scaled to [0, 1]."""
+        score = np.zeros(len(blended))
+        rows = np.flatnonzero(eligible)
+        if not len(rows):
+            return score
+        # Sort by (category, blended return); position within the category run is the rank
+        order = rows[np.lexsort((blended[rows], self.category[rows]))]
+        cats = self.category[order]
+        starts = np.r_[0, np.flatnonzero(np.diff(cats)) + 1]
+        counts = np.diff(np.r_[starts, len(order)])
+        rank = np.arange(len(order)) - np.repeat(starts, counts)
+        size = np.repeat(counts, counts)
+        score[order] = np.where(size > 1, rank / np.maximum(size - 1, 1), 0.5)
+        return score
+
+    def __len__(self) -> int:
+        return int(self.eligible.sum())
+
+
+class CandidateRanker:
+    """
+    Local pre-ranking of the whole fund universe for one user, in a single
+    vectorised pass over the fund metrics store:
+
+    * category gap: how far the user's invested share of the fund's category
+      is below TARGET_ALLOCATION,
+    * risk fit: closeness of the fund's riskometer level to the user's
+      invested-weighted risk level,
+    * returns: the fund's blended 1Y/3Y/5Y return percentile within its category.
+
+    The top PRERANK_SHORTLIST_SIZE funds (at most PRERANK_MAX_PER_CATEGORY
+    per category, none the user already holds) are the shortlist Gemini
+    chooses from, and the fallback when Gemini fails.
+    """
+
+    def __init__(self):
+        self._universe: Optional[_RankedUniverse] = None
+        self._key: Optional[Tuple[Optional[str], int]] = None
+        self._lock = threading.Lock()
+
+    def _current(self) -> _RankedUniverse:
+        snapshot = fund_metrics_store.snapshot()
+        key = (snapshot.version, fund_universe.generation)
+        with self._lock:
+            if self._key != key:
+                self._universe = _RankedUniverse(snapshot)
+                self._key = key
+                logger.info(f"Candidate ranking universe rebuilt: {len(self._universe)} eligible funds")
+            return self._universe
+
+    def _holdings(
+        self, universe: _RankedUniverse, user_fund_details: List[Dict[str, Any]], portfolio: Optional[List[Dict[str, Any]]]
+    ) -> _Holdings:
+        """The user's funds with their category, risk level and invested weight."""
+        held = {str(p["scheme_code"]): p for p in portfolio or []}
+        details = {str(d["scheme_code"]): d for d in user_fund_details if d.get("scheme_code")}
+        codes = list(dict.fromkeys([*held, *details]))
+        funds = [details.get(code, {}) for code in codes]
+        rows = universe.snapshot.index_of(codes)
+
+        # The store knows most held funds; details fill in the ones it does not
+        known = rows >= 0
+        category = np.where(known, universe.category[np.maximum(rows, 0)], [parse_category(d.get("category")) for d in funds])
+        risk = np.where(known, universe.risk[np.maximum(rows, 0)], [parse_risk_level(d.get("risk_level")) for d in funds])
+        weights = np.array([held.get(code, {}).get("total_invested_amount") or 0.0 for code in codes], dtype=np.float64)
+        if not weights.sum():
+            weights = np.ones(len(codes))
+        names = [details.get(code, {}).get("name") or held.get(code, {}).get("scheme_name") for code in codes]
+        return _Holdings(codes, names, rows, category.astype(np.int64), risk.astype(np.float64), weights)
+
+    def score(
+        self, universe: _RankedUniverse, user_fund_details: List[Dict[str, Any]], portfolio: Optional[List[Dict[str, Any]]] = None
+    ) -> np.ndarray:
+        """Score of every fund in `universe` for this user; -inf for funds that cannot be recommended."""
+        holdings = self._holdings(universe, user_fund_details, portfolio)
+        rows, category, risk, weights = holdings.rows, holdings.category, holdings.risk, holdings.weights
+
+        held_share = np.bincount(category, weights=weights, minlength=len(FUND_CATEGORIES)) / weights.sum() \
+            if len(weights) else np.zeros(len(FUND_CATEGORIES))
+        gap = np.maximum(universe.target - held_share, 0.0)
+        gap_score = gap[universe.category] / gap.max() if gap.max() > 0 else np.zeros(len(universe.category))
+
+        rated = risk > 0
+        user_risk = np.average(risk[rated], weights=weights[rated]) if rated.any() and weights[rated].sum() else DEFAULT_RISK_LEVEL
+        risk_fit = np.where(universe.risk > 0, 1.0 - np.abs(universe.risk - user_risk) / 5.0, 0.5)
+
+        score = (
+            SCORE_WEIGHTS["gap"] * gap_score
+            + SCORE_WEIGHTS["risk"] * risk_fit
+            + SCORE_WEIGHTS["returns"] * universe.return_score
+        )
+        score[~universe.eligible] = -np.inf
+        score[rows[rows >= 0]] = -np.inf
+        return score
+
+    def shortlist(
+        self,
+        user_fund_details: List[Dict[str, Any]],
+        portfolio: Optional[List[Dict[str, Any]]] = None,
+        size: Optional[int] = None,
+    ) -> List[Candidate]:
+        """
+        Best candidates for the user, best first. Empty when the store ranks
+        fewer than PRERANK_MIN_UNIVERSE funds (e.g. before the first batch run).
+        """
+        universe = self._current()
+        if len(universe) < max(settings.PRERANK_MIN_UNIVERSE, 1):
+            return []
+        size = size or settings.PRERANK_SHORTLIST_SIZE
+        per_category = max(settings.PRERANK_MAX_PER_CATEGORY, 1)
+
+        score = self.score(universe, user_fund_details, portfolio)
+        # Only the best size * categories funds are sorted, which keeps the cost per user linear
+        pool = min(size * len(FUND_CATEGORIES), len(score))
+        top = np.argpartition(-score, pool - 1)[:pool]
+        top = top[np.argsort(-score[top], kind="stable")]
+
+        picked: List[int] = []
+        taken = np.zeros(len(FUND_CATEGORIES), dtype=np.int64)
+        for row in top:
+            if not np.isfinite(score[row]) or len(picked) == size:
+                break
+            if taken[universe.category[row]] < per_category:
+                taken[universe.category[row]] += 1
+                picked.append(int(row))
+        return [self._candidate(universe, row, score[row]) for row in picked]
+
+    @staticmethod
+    def _candidate(universe: _RankedUniverse, row: int, score: float) -> Candidate:
+        returns = {
+            label: (round(float(value), 1) if np.isfinite(value) else None)
+            for label, value in zip(("1Y", "3Y", "5Y"), universe.returns[row])
+        }
+        return Candidate(
+            scheme_code=str(universe.codes[row]),
+            name=universe.names[row],
+            category=FUND_CATEGORIES[universe.category[row]],
+            risk_level=int(universe.risk[row]),
+            returns=returns,
+            blended_return=round(float(universe.blended[row]), 1),
+            score=round(float(score), 4),
+        )
+
+    def prompt_holdings(
+        self, user_fund_details: List[Dict[str, Any]], portfolio: Optional[List[Dict[str, Any]]] = None
+    ) -> List[List[Any]]:
+        """
+        [category, risk level, share of the amount invested] per held fund, for
+        the shortlist prompt. Names are left out: candidates never include held
+        funds, and scoring only looks at these fields.
+        """
+        holdings = self._holdings(self._current(), user_fund_details, portfolio)
+        shares = holdings.weights / holdings.weights.sum() if len(holdings.weights) else holdings.weights
+        return [
+            [FUND_CATEGORIES[category], int(risk), round(float(share), 2)]
+            for category, risk, share in zip(holdings.category, holdings.risk, shares)
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            universe = self._universe
+        return {"eligible_funds": len(universe) if universe else 0, "version": self._key[0] if self._key else None}
+
+
+candidate_ranker = CandidateRanker()
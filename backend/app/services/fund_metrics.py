@@ -0,0 +1,450 @@
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, Iterator, Optional, Sequence
+
+import numpy as np
+
+from app.core.config import settings
+from app.schemas.fund import FundMetrics
+
+# Writers serialise on a lock file: flock on POSIX, msvcrt on Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+logger = logging.getLogger(__name__)
+
+# backend/app/services/fund_metrics.py -> backend, so every process finds the same store whatever its cwd
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Float columns (NaN when unknown) and int8 code columns (0 when unknown), named after FundMetrics fields
+FLOAT_COLUMNS = ("nav", "aum_crore", "return_1y", "return_3y", "return_5y", "fetched_at")
+CODE_COLUMNS = ("risk_level", "category")
+COLUMNS = ("scheme_code",) + FLOAT_COLUMNS + CODE_COLUMNS
+
+# "1Y", "1 Yr", "OneY", "1 year" ... -> return column
+RETURN_KEYS = {
+    "1Y": "return_1y", "1YR": "return_1y", "1YEAR": "return_1y", "ONEY": "return_1y",
+    "3Y": "return_3y", "3YR": "return_3y", "3YEAR": "return_3y", "THREEY": "return_3y",
+    "5Y": "return_5y", "5YR": "return_5y", "5YEAR": "return_5y", "FIVEY": "return_5y",
+}
+
+# SEBI riskometer; longer labels first, so "low to moderate" is not read as "moderate"
+RISK_LEVELS = (
+    ("very high", 6),
+    ("moderately high", 4),
+    ("low to moderate", 2),
+    ("high", 5),
+    ("moderate", 3),
+    ("low", 1),
+)
+RISK_LABELS = {1: "Low", 2: "Low to Moderate", 3: "Moderate", 4: "Moderately High", 5: "High", 6: "Very High"}
+
+# Category buckets; the `category` column holds the index (0 = unknown)
+FUND_CATEGORIES = (
+    "unknown", "large_cap", "large_mid_cap", "mid_cap", "small_cap", "flexi_cap", "value_focused",
+    "elss", "index", "sectoral", "hybrid", "debt", "liquid", "other",
+)
+# Display label per bucket, for fund details rebuilt from the store
+CATEGORY_LABELS = (
+    None, "Equity: Large Cap", "Equity: Large & Mid Cap", "Equity: Mid Cap", "Equity: Small Cap",
+    "Equity: Flexi Cap", "Equity: Value/Focused", "Equity: ELSS", "Index Fund", "Equity: Sectoral/Thematic",
+    "Hybrid", "Debt", "Debt: Liquid", "Other",
+)
+# First match wins: "Large & Mid Cap" before "Large Cap", index and hybrid funds before the segments they mention
+CATEGORY_RULES = tuple((re.compile(pattern, re.I), FUND_CATEGORIES.index(bucket)) for pattern, bucket in (
+    (r"liquid|overnight|money market", "liquid"),
+    (r"elss|tax sav", "elss"),
+    (r"index|etf|\bfof\b|fund of funds", "index"),
+    (r"hybrid|balanced|arbitrage|asset allocation|equity savings", "hybrid"),
+    (r"debt|bond|gilt|credit|duration|income|corporate|banking and psu", "debt"),
+    (r"large\s*(?:&|and)?\s*mid", "large_mid_cap"),
+    (r"large", "large_cap"),
+    (r"mid", "mid_cap"),
+    (r"small", "small_cap"),
+    (r"flexi|multi", "flexi_cap"),
+    (r"value|contra|focused|dividend yield", "value_focused"),
+    (r"sector|thematic", "sectoral"),
+    (r".", "other"),
+))
+
+# AUM units in crore; LLM answers mostly say "Cr" but not always
+AUM_UNITS = (
+    (re.compile(r"lakh\s*(?:crore|cr)|lac\s*(?:crore|cr)|(?<![a-z])l\s*cr\b", re.I), 1e5),
+    (re.compile(r"(?:thousand|k)\s*(?:crore|cr)", re.I), 1e3),
+    (re.compile(r"crore|cr\b", re.I), 1.0),
+    (re.compile(r"lakh|lac\b", re.I), 1e-2),
+    (re.compile(r"billion|bn\b", re.I), 1e2),
+    (re.compile(r"million|mn\b", re.I), 1e-1),
+)
+RUPEES_PER_CRORE = 1e7
+
+NUMBER_PATTERN = re.compile(r"[-+−]?\d+(?:\.\d+)?")
+
+
+def parse_number(value: Any) -> Optional[float]:
+    """First number in a free-form value: "₹1,234.5" -> 1234.5, "N/A" -> None."""
+    if isinstance(value, (int, float)):
+        return float(value) if np.isfinite(value) else None
+    if not isinstance(value, str):
+        return None
+    match = NUMBER_PATTERN.search(value.replace(",", ""))
+    if not match:
+        return None
+    return float(match.group().replace("−", "-"))
+
+
+def parse_percent(value: Any) -> Optional[float]:
+    """"12.5%" -> 12.5 (percent units, like the source)."""
+    return parse_number(value)
+
+
+def parse_aum_crore(value: Any) -> Optional[float]:
+    """"₹1,234 Cr" -> 1234.0, "1.2 lakh crore" -> 120000.0; plain amounts are taken as crore unless they look like rupees."""
+    amount = parse_number(value)
+    if amount is None:
+        return None
+    if isinstance(value, str):
+        for pattern, crore in AUM_UNITS:
+            if pattern.search(value):
+                return amount * crore
+    return amount / RUPEES_PER_CRORE if amount >= RUPEES_PER_CRORE else amount
+
+
+def parse_risk_level(value: Any) -> int:
+    """Riskometer label -> 1 (Low) .. 6 (Very High), 0 if unknown."""
+    if not isinstance(value, str):
+        return 0
+    text = " ".join(value.lower().replace("-", " ").split())
+    return next((level for label, level in RISK_LEVELS if label in text), 0)
+
+
+def parse_category(value: Any) -> int:
+    """Category label ("Equity: Mid Cap") -> index into FUND_CATEGORIES, 0 if unknown."""
+    if not isinstance(value, str) or not value.strip():
+        return 0
+    return next(code for pattern, code in CATEGORY_RULES if pattern.search(value))
+
+
+def parse_timestamp(value: Any) -> Optional[datetime]:
+    """Fetch time as stored with cached details (ISO text or datetime) -> aware UTC datetime, None if unknown."""
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if not isinstance(value, datetime):
+        return None
+    # MongoDB hands back naive UTC datetimes
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+def normalize_fund_metrics(details: Dict[str, Any], fetched_at: Optional[datetime] = None) -> Optional[FundMetrics]:
+    """
+    Numeric fields of one FundDetails dict. Returns None when the fund has
+    no scheme code (it cannot be stored) or carries no numbers at all.
+    The dict's own `fetched_at` wins over the `fetched_at` argument; now is
+    used only when neither is known.
+    """
+    code = details.get("scheme_code")
+    if not code:
+        return None
+    metrics = FundMetrics(
+        scheme_code=str(code),
+        nav=parse_number(details.get("nav")),
+        aum_crore=parse_aum_crore(details.get("aum")),
+        risk_level=parse_risk_level(details.get("risk_level")),
+        category=parse_category(details.get("category")),
+        fetched_at=parse_timestamp(details.get("fetched_at")) or fetched_at or datetime.now(timezone.utc),
+    )
+    for key, value in (details.get("returns") or {}).items():
+        column = RETURN_KEYS.get(re.sub(r"[^0-9A-Z]", "", str(key).upper()))
+        if column:
+            setattr(metrics, column, parse_percent(value))
+
+    if all(getattr(metrics, c) is None for c in FLOAT_COLUMNS if c != "fetched_at") \
+            and not any(getattr(metrics, c) for c in CODE_COLUMNS):
+        return None
+    return metrics
+
+
+@contextmanager
+def _exclusive_lock(path: str) -> Iterator[None]:
+    """Hold an exclusive lock on the file at `path`, waiting for other processes to release it."""
+    with open(path, "a+") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+            return
+        if msvcrt is None:
+            # Neither is available: a single writer process is assumed
+            yield
+            return
+        lock_file.seek(0)
+        while True:
+            try:
+                # LK_LOCK gives up after about 10 seconds; keep waiting, like flock
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                break
+            except OSError:
+                continue
+        try:
+            yield
+        finally:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class FundMetricsSnapshot:
+    """
+    One version of the store: a column array per field, rows sorted by
+    scheme code. Loaded with mmap, so every process maps the same pages
+    and nothing is copied until a column is actually read.
+    """
+
+    def __init__(self, columns: Dict[str, np.ndarray], version: Optional[str] = None):
+        self.columns = columns
+        self.version = version
+
+    @classmethod
+    def empty(cls) -> "FundMetricsSnapshot":
+        columns = {c: np.empty(0, dtype=np.float64) for c in FLOAT_COLUMNS}
+        columns.update({c: np.empty(0, dtype=np.int8) for c in CODE_COLUMNS})
+        columns["scheme_code"] = np.empty(0, dtype="U1")
+        return cls(columns)
+
+    @classmethod
+    def load(cls, path: str, version: str) -> "FundMetricsSnapshot":
+        folder = os.path.join(path, version)
+        columns = {}
+        for column in COLUMNS:
+            file = os.path.join(folder, f"{column}.npy")
+            if os.path.exists(file):
+                columns[column] = np.load(file, mmap_mode="r")
+        # Versions written before a column existed read it as unknown
+        size = len(columns["scheme_code"])
+        for column in FLOAT_COLUMNS + CODE_COLUMNS:
+            if column not in columns:
+                columns[column] = np.full(size, np.nan) if column in FLOAT_COLUMNS else np.zeros(size, dtype=np.int8)
+        return cls(columns, version)
+
+    def __len__(self) -> int:
+        return len(self.columns["scheme_code"])
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        return self.columns[column]
+
+    def index_of(self, scheme_codes: Sequence[str]) -> np.ndarray:
+        """Row of each scheme code, -1 where the store has none."""
+        codes = self.columns["scheme_code"]
+        query = np.asarray(scheme_codes, dtype=str)
+        if not len(codes) or not len(query):
+            return np.full(len(query), -1, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(codes, query), len(codes) - 1)
+        return np.where(codes[rows] == query, rows, -1)
+
+    def get(self, scheme_code: str) -> Optional[FundMetrics]:
+        row = int(self.index_of([scheme_code])[0])
+        if row < 0:
+            return None
+        values = {c: float(self.columns[c][row]) for c in FLOAT_COLUMNS}
+        fetched_at = values.pop("fetched_at")
+        return FundMetrics(
+            scheme_code=scheme_code,
+            **{c: int(self.columns[c][row]) for c in CODE_COLUMNS},
+            fetched_at=datetime.fromtimestamp(fetched_at, timezone.utc) if np.isfinite(fetched_at) else None,
+            **{c: (v if np.isfinite(v) else None) for c, v in values.items()},
+        )
+
+    def merge(self, updates: Dict[str, FundMetrics]) -> Dict[str, np.ndarray]:
+        """
+        Columns with `updates` applied. A field an update leaves empty keeps
+        the stored value, so a partial answer never erases a known number.
+        Updates fetched before the stored row are dropped, so a cached answer
+        never replaces a newer one.
+        """
+        updated = list(updates)
+        rows = self.index_of(updated)
+        stored_at = np.full(len(updated), np.nan)
+        stored_at[rows >= 0] = self.columns["fetched_at"][rows[rows >= 0]]
+        fetched_at = np.array([self._value(updates[code], "fetched_at") for code in updated])
+        updates = {code: updates[code] for code, stale in zip(updated, fetched_at < stored_at) if not stale}
+
+        new_codes = np.array(sorted(updates), dtype=str)
+        codes = np.union1d(np.asarray(self.columns["scheme_code"], dtype=str), new_codes)
+        old_rows = np.searchsorted(codes, self.columns["scheme_code"])
+        new_rows = np.searchsorted(codes, new_codes)
+
+        merged = {"scheme_code": codes}
+        for column in FLOAT_COLUMNS + CODE_COLUMNS:
+            is_code = column in CODE_COLUMNS
+            values = np.zeros(len(codes), dtype=np.int8) if is_code else np.full(len(codes), np.nan)
+            values[old_rows] = self.columns[column]
+            incoming = np.array([self._value(updates[code], column) for code in new_codes], dtype=values.dtype)
+            known = incoming > 0 if is_code else np.isfinite(incoming)
+            values[new_rows[known]] = incoming[known]
+            merged[column] = values
+        return merged
+
+    @staticmethod
+    def _value(metrics: FundMetrics, column: str) -> float:
+        value = getattr(metrics, column)
+        if column == "fetched_at":
+            return value.timestamp() if value else np.nan
+        if column in CODE_COLUMNS:
+            return value
+        return np.nan if value is None else value
+
+
+class FundMetricsStore:
+    """
+    Numeric NAV, AUM, 1Y/3Y/5Y returns, risk level, category bucket and fetch
+    time per scheme code, stored as one .npy file per column under FUND_METRICS_DIR:
+
+        <dir>/CURRENT        name of the live version
+        <dir>/v<ns>/<column>.npy
+
+    Pipelines `record()` the details they fetch; `flush()` merges them into
+    the latest version and writes a new one, then swaps CURRENT atomically.
+    Writers (batch runs, API processes) serialise on a lock file and merge
+    whatever is current at that moment, so none loses another's updates.
+    Readers `snapshot()` the live version memory-mapped, in milliseconds, and
+    pick up newer ones every FUND_METRICS_RELOAD_SECONDS. Older versions are
+    removed after a swap; processes still mapping them keep their pages.
+    """
+    KEEP_VERSIONS = 2
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = os.path.join(BASE_DIR, path or settings.FUND_METRICS_DIR)
+        self._snapshot: Optional[FundMetricsSnapshot] = None
+        self._checked_at = 0.0
+        self._pending: Dict[str, FundMetrics] = {}
+        self._lock = threading.Lock()
+        self.recorded = 0
+        self.flushes = 0
+        self.last_written: Optional[str] = None
+        self.load_seconds = 0.0
+
+    def _current_version(self) -> Optional[str]:
+        try:
+            with open(os.path.join(self.path, "CURRENT")) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _load(self, version: Optional[str]) -> FundMetricsSnapshot:
+        if version is None:
+            return FundMetricsSnapshot.empty()
+        start = time.perf_counter()
+        snapshot = FundMetricsSnapshot.load(self.path, version)
+        self.load_seconds = time.perf_counter() - start
+        logger.info(f"Loaded fund metrics {version}: {len(snapshot)} funds in {self.load_seconds * 1000:.1f} ms")
+        return snapshot
+
+    def snapshot(self) -> FundMetricsSnapshot:
+        """The live version (empty until the first flush anywhere)."""
+        now = time.monotonic()
+        with self._lock:
+            if self._snapshot is None or now - self._checked_at >= settings.FUND_METRICS_RELOAD_SECONDS:
+                self._checked_at = now
+                version = self._current_version()
+                if self._snapshot is None or version != self._snapshot.version:
+                    self._snapshot = self._load(version)
+            return self._snapshot
+
+    def record(self, details: Iterable[Optional[Dict[str, Any]]]) -> int:
+        """
+        Normalise fetched FundDetails dicts and queue them for the next flush.
+        Each keeps the time Perplexity answered (its `fetched_at`), so details
+        served from the cache are not recorded as fresh.
+        """
+        if not settings.FUND_METRICS_ENABLED:
+            return 0
+        now = datetime.now(timezone.utc)
+        return self.record_metrics(m for m in (normalize_fund_metrics(d, now) for d in details if d) if m is not None)
+
+    def record_metrics(self, metrics: Iterable[FundMetrics]) -> int:
+        """Queue already normalised metrics; per scheme, the most recently fetched entry is kept."""
+        metrics = list(metrics)
+        with self._lock:
+            for m in metrics:
+                queued = self._pending.get(m.scheme_code)
+                if queued is None or not (m.fetched_at and queued.fetched_at and m.fetched_at < queued.fetched_at):
+                    self._pending[m.scheme_code] = m
+            self.recorded += len(metrics)
+        return len(metrics)
+
+    def flush(self) -> Optional[str]:
+        """Write recorded metrics as a new version. Returns its name, or None if nothing was recorded."""
+        with self._lock:
+            updates, self._pending = self._pending, {}
+        if not updates:
+            return None
+
+        os.makedirs(self.path, exist_ok=True)
+        try:
+            with _exclusive_lock(os.path.join(self.path, ".lock")):
+                current = self._current_version()
+                merged = self._load(current).merge(updates)
+                version = self._write(merged)
+        except Exception:
+            # Keep the updates for the next flush, unless newer ones arrived meanwhile
+            with self._lock:
+                self._pending = {**updates, **self._pending}
+            raise
+
+        self._remove_old_versions()
+        with self._lock:
+            self.flushes += 1
+            self.last_written = version
+            self._checked_at = 0.0  # Map the new version on the next snapshot()
+        logger.info(f"Fund metrics {version} written: {len(merged['scheme_code'])} funds, {len(updates)} updated")
+        return version
+
+    def _write(self, columns: Dict[str, np.ndarray]) -> str:
+        version = f"v{time.time_ns()}"
+        staging = os.path.join(self.path, f".{version}")
+        os.makedirs(staging)
+        for column, values in columns.items():
+            np.save(os.path.join(staging, f"{column}.npy"), values)
+        os.rename(staging, os.path.join(self.path, version))
+
+        pointer = os.path.join(self.path, ".CURRENT.tmp")
+        with open(pointer, "w") as f:
+            f.write(version)
+        os.replace(pointer, os.path.join(self.path, "CURRENT"))
+        return version
+
+    def _remove_old_versions(self) -> None:
+        versions = sorted(
+            (v for v in os.listdir(self.path) if re.fullmatch(r"v\d+", v)), key=lambda v: int(v[1:])
+        )
+        for version in versions[:-self.KEEP_VERSIONS]:
+            shutil.rmtree(os.path.join(self.path, version), ignore_errors=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            snapshot = self._snapshot
+            return {
+                "version": snapshot.version if snapshot else None,
+                "funds": len(snapshot) if snapshot else 0,
+                "recorded": self.recorded,
+                "pending": len(self._pending),
+                "flushes": self.flushes,
+                "last_written": self.last_written,
+                "load_ms": round(self.load_seconds * 1000, 2),
+            }
+
+
+fund_metrics_store = FundMetricsStore()
@@ -0,0 +1,291 @@
+import asyncio
+import logging
+import re
+import threading
+from collections import Counter
+from typing import Any, Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.db.session import SessionLocal
+from app.models.mutual_funds import MutualFundSchemes
+from app.utils.cache import LRUTTLCache
+from app.utils.common import normalize_fund_name
+
+logger = logging.getLogger(__name__)
+
+# Trigrams shared by more than this share of schemes ("fun", "und", ...) are
+# not used to find candidates, only to score them
+COMMON_TRIGRAM_RATIO = 0.05
+# Candidates (by shared rare trigrams) that get a full similarity score
+MAX_CANDIDATES = 32
+# Tokens that tell otherwise near-identical schemes apart (Small vs Mid Cap,
+# Direct vs Regular, Growth vs IDCW)
+KEY_TOKEN_GROUPS = (
+    frozenset({"large", "mid", "small", "flexi", "multi", "micro", "focused", "value", "contra", "index", "elss"}),
+    frozenset({"direct", "regular"}),
+    frozenset({"growth", "idcw", "bonus"}),
+)
+TOKEN_ALIASES = {"dividend": "idcw"}
+NUMBER_PATTERN = re.compile(r"\d+")
+
+KeyTokens = Tuple[Any, ...]
+
+
+def trigrams(normalized: str) -> FrozenSet[str]:
+    padded = f"  {normalized} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def key_tokens(normalized: str) -> KeyTokens:
+    """
+    What a fuzzy match must not get wrong: the fund house (first token),
+    the name's tokens from each of KEY_TOKEN_GROUPS and its numbers
+    (series, index). A scheme only matches a query with the same key tokens,
+    so a misspelt "Mdi Cap" or a name without plan and option matches nothing.
+    """
+    words = normalized.split()
+    tokens = {TOKEN_ALIASES.get(t, t) for t in words}
+    return (words[0], *(frozenset(tokens & group) for group in KEY_TOKEN_GROUPS), tuple(NUMBER_PATTERN.findall(normalized)))
+
+
+class FundMatch(NamedTuple):
+    scheme_code: str
+    scheme_name: str
+    score: float
+
+
+class _Snapshot:
+    """
+    Immutable view of the index. Refreshes build a new snapshot and swap it
+    in, so lookups never lock and never see a half-applied refresh.
+    """
+
+    def __init__(self):
+        self.codes: List[str] = []
+        self.names: List[str] = []
+        self.grams: List[FrozenSet[str]] = []
+        self.keys: List[KeyTokens] = []
+        self.id_by_code: Dict[str, int] = {}
+        self.exact: Dict[str, int] = {}
+        self.postings: Dict[str, FrozenSet[int]] = {}
+        self.max_row_id = 0
+
+    def extend(self, rows) -> "_Snapshot":
+        """Copy of this snapshot with (row id, scheme_code, scheme_name) rows added or renamed."""
+        new = _Snapshot()
+        new.codes, new.names, new.grams = list(self.codes), list(self.names), list(self.grams)
+        new.keys = list(self.keys)
+        new.id_by_code, new.exact = dict(self.id_by_code), dict(self.exact)
+        new.max_row_id = self.max_row_id
+        added: Dict[str, Set[int]] = {}
+        removed: Dict[str, Set[int]] = {}
+
+        for row_id, code, name in rows:
+            new.max_row_id = max(new.max_row_id, row_id)
+            normalized = normalize_fund_name(name or "")
+            if not code or not normalized:
+                continue
+            grams = trigrams(normalized)
+
+            idx = new.id_by_code.get(code)
+            if idx is None:
+                idx = len(new.codes)
+                new.id_by_code[code] = idx
+                new.codes.append(code)
+                new.names.append(name)
+                new.grams.append(grams)
+                new.keys.append(key_tokens(normalized))
+            else:
+                # Renamed scheme: retire the old name's postings
+                old_normalized = normalize_fund_name(new.names[idx])
+                if new.exact.get(old_normalized) == idx:
+                    del new.exact[old_normalized]
+                for gram in new.grams[idx] - grams:
+                    removed.setdefault(gram, set()).add(idx)
+                new.names[idx] = name
+                new.grams[idx] = grams
+                new.keys[idx] = key_tokens(normalized)
+
+            new.exact[normalized] = idx
+            for gram in grams:
+                added.setdefault(gram, set()).add(idx)
+
+        new.postings = dict(self.postings)
+        for gram in added.keys() | removed.keys():
+            ids = (set(new.postings.get(gram, ())) | added.get(gram, set())) - removed.get(gram, set())
+            if ids:
+                new.postings[gram] = frozenset(ids)
+            else:
+                new.postings.pop(gram, None)
+        return new
+
+
+class FundUniverseIndex:
+    """
+    In-memory index of all schemes in MutualFundSchemes for resolving
+    free-text fund names (from Gemini or users) to scheme codes.
+    Exact matches on the normalized name are a dict lookup; everything else
+    goes through a trigram inverted index scored by Dice similarity, among
+    schemes with the same key tokens (fund house, category, plan, option,
+    numbers).
+    """
+
+    def __init__(self, min_score: float = None, min_margin: float = None, lookup_cache_size: int = 20000):
+        self.min_score = settings.FUND_UNIVERSE_MIN_SCORE if min_score is None else min_score
+        self.min_margin = settings.FUND_UNIVERSE_MIN_MARGIN if min_margin is None else min_margin
+        self._snapshot = _Snapshot()
+        self._lookups = LRUTTLCache(maxsize=lookup_cache_size, ttl_seconds=float("inf"))
+        self._refresh_lock = threading.Lock()
+        self._refresher: Optional[asyncio.Task] = None
+        # Bumped on every load, so derived data (e.g. candidate ranking) knows when to rebuild
+        self.generation = 0
+
+    @property
+    def loaded(self) -> bool:
+        return bool(self._snapshot.codes)
+
+    def __len__(self) -> int:
+        return len(self._snapshot.codes)
+
+    def load_rows(self, rows) -> int:
+        """Add or update (row id, scheme_code, scheme_name) rows. Returns how many were applied."""
+        rows = list(rows)
+        if not rows:
+            return 0
+        with self._refresh_lock:
+            self._snapshot = self._snapshot.extend(rows)
+            self._lookups.clear()
+            self.generation += 1
+        return len(rows)
+
+    def refresh(self, db: Session) -> int:
+        """
+        Load schemes added since the last refresh (by row id); the first call
+        loads the whole table.
+        """
+        rows = (
+            db.query(MutualFundSchemes.id, MutualFundSchemes.scheme_code, MutualFundSchemes.scheme_name)
+            .filter(MutualFundSchemes.id > self._snapshot.max_row_id)
+            .order_by(MutualFundSchemes.id)
+            .all()
+        )
+        count = self.load_rows(rows)
+        if count:
+            logger.info(f"Fund universe index: {count} schemes loaded, {len(self)} total.")
+        return count
+
+    def refresh_from_db(self) -> int:
+        """`refresh` with its own session; failures are logged and leave the index as is."""
+        db = SessionLocal()
+        try:
+            return self.refresh(db)
+        except Exception as e:
+            logger.warning(f"Fund universe refresh failed, keeping {len(self)} schemes: {e}")
+            return 0
+        finally:
+            db.close()
+
+    async def _refresh_periodically(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            await asyncio.to_thread(self.refresh_from_db)
+
+    def start_periodic_refresh(self) -> None:
+        interval = settings.FUND_UNIVERSE_REFRESH_SECONDS
+        if interval > 0 and self._refresher is None:
+            self._refresher = asyncio.create_task(self._refresh_periodically(interval))
+
+    async def stop_periodic_refresh(self) -> None:
+        if self._refresher is not None:
+            self._refresher.cancel()
+            await asyncio.gather(self._refresher, return_exceptions=True)
+            self._refresher = None
+
+    def resolve(self, name: str) -> Optional[FundMatch]:
+        """
+        Best matching scheme for a free-text fund name, or None if nothing
+        scores at least `min_score` or the runner-up is within `min_margin`
+        (e.g. a name without plan or option matches every variant equally).
+        """
+        normalized = normalize_fund_name(name or "")
+        if not normalized:
+            return None
+        cached = self._lookups.get(normalized)
+        if cached is not None:
+            return cached or None
+
+        snapshot = self._snapshot
+        match = self._search(snapshot, normalized)
+        # Cache misses too (as False), LLMs repeat the same unknown names
+        self._lookups.set(normalized, match or False)
+        return match
+
+    def _search(self, snapshot: _Snapshot, normalized: str) -> Optional[FundMatch]:
+        idx = snapshot.exact.get(normalized)
+        if idx is not None:
+            return FundMatch(snapshot.codes[idx], snapshot.names[idx], 1.0)
+
+        query = trigrams(normalized)
+        postings = [snapshot.postings[g] for g in query if g in snapshot.postings]
+        if not postings:
+            return None
+        common = max(int(len(snapshot.codes) * COMMON_TRIGRAM_RATIO), MAX_CANDIDATES)
+        rare = [p for p in postings if len(p) <= common] or postings
+
+        overlap = Counter()
+        for ids in rare:
+            overlap.update(ids)
+
+        keys = key_tokens(normalized)
+        best_idx, best_score, runner_up = None, 0.0, 0.0
+        for idx, _ in overlap.most_common(MAX_CANDIDATES):
+            if snapshot.keys[idx] != keys:
+                continue
+            grams = snapshot.grams[idx]
+            score = 2 * len(query & grams) / (len(query) + len(grams))
+            if score > best_score:
+                best_idx, best_score, runner_up = idx, score, best_score
+            elif score > runner_up:
+                runner_up = score
+
+        if best_idx is None or best_score < self.min_score or best_score - runner_up < self.min_margin:
+            return None
+        return FundMatch(snapshot.codes[best_idx], snapshot.names[best_idx], round(best_score, 3))
+
+    def code_for(self, name: str) -> Optional[str]:
+        """Scheme code for an exact (normalized) scheme name, without fuzzy matching."""
+        snapshot = self._snapshot
+        idx = snapshot.exact.get(normalize_fund_name(name or ""))
+        return snapshot.codes[idx] if idx is not None else None
+
+    def names_for(self, codes: Iterable[str]) -> List[Optional[str]]:
+        """Canonical scheme name for each scheme code (None if unknown)."""
+        snapshot = self._snapshot
+        return [
+            snapshot.names[snapshot.id_by_code[code]] if code in snapshot.id_by_code else None
+            for code in codes
+        ]
+
+    def canonicalize(self, names: List[str]) -> List[str]:
+        """
+        Replace each name with its scheme's canonical name (unmatched names
+        are kept as given) and drop duplicates, preserving order.
+        """
+        canonical = []
+        for name in names:
+            match = self.resolve(name) if self.loaded else None
+            if match is None:
+                if self.loaded:
+                    logger.info(f"No scheme found for fund name '{name}', using it as given.")
+                canonical.append(name)
+            else:
+                canonical.append(match.scheme_name)
+        return list(dict.fromkeys(canonical))
+
+    def stats(self) -> Dict[str, int]:
+        return {"schemes": len(self), "trigrams": len(self._snapshot.postings), **self._lookups.stats()}
+
+
+fund_universe = FundUniverseIndex()
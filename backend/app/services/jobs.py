@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, Tuple
+
+from app.core.config import settings
+from app.db.mongo import mongo_db
+from app.services.recommendation_store import recommendation_store
+from app.utils.metrics import stage
+
+logger = logging.getLogger(__name__)
+
+
+class RecommendationJob:
+    """
+    One on-demand pipeline run for a user.
+    """
+
+    def __init__(self, user_id: str):
+        self.job_id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.status = "pending"
+        self.created_at = datetime.now(timezone.utc)
+        self.finished_at: Optional[datetime] = None
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.done = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self._finished_monotonic: Optional[float] = None
+
+    def finish(self, status: str, result: Optional[Dict[str, Any]] = None, error: Optional[str] = None) -> None:
+        self.status = status
+        self.result = result
+        self.error = error
+        self.finished_at = datetime.now(timezone.utc)
+        self._finished_monotonic = time.monotonic()
+        self.done.set()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.job_id,
+            "user_id": self.user_id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class RecommendationJobManager:
+    """
+    In-process registry of on-demand recommendation jobs with single-flight
+    coalescing: while a job for a user is pending/running, further refresh
+    requests for that user attach to it instead of starting a new pipeline.
+
+    The pipeline (LLM clients, SQLAlchemy, fund universe) is imported and
+    warmed up by the first job, or by `warm_up()` at startup when
+    API_PRELOAD_PIPELINE is set, so the read API starts without it.
+    """
+
+    def __init__(self):
+        self.jobs: Dict[str, RecommendationJob] = {}
+        self.active_by_user: Dict[str, RecommendationJob] = {}
+        self.coalesced = 0
+        self.pipeline_loaded = False
+        self._warm_up_lock: Optional[asyncio.Lock] = None
+
+    def _load_pipeline(self) -> None:
+        from app.services.advisor import advisor_service
+        from app.services.fund_universe import fund_universe
+        from app.services import recommendation  # noqa: F401
+
+        # Builds the Gemini request config, which pulls in google-genai
+        advisor_service.config
+        fund_universe.refresh_from_db()
+
+    async def warm_up(self) -> None:
+        """Import the pipeline, load the fund universe and start its periodic refresh (once)."""
+        if self.pipeline_loaded:
+            return
+        if self._warm_up_lock is None:
+            self._warm_up_lock = asyncio.Lock()
+        async with self._warm_up_lock:
+            if self.pipeline_loaded:
+                return
+            with stage("pipeline_warm_up"):
+                # Imports run in a thread so the event loop keeps serving reads meanwhile
+                await asyncio.to_thread(self._load_pipeline)
+            from app.services.fund_universe import fund_universe
+            fund_universe.start_periodic_refresh()
+            self.pipeline_loaded = True
+            logger.info("Recommendation pipeline loaded")
+
+    def _prune(self) -> None:
+        """Forget finished jobs older than JOB_RESULT_TTL_SECONDS."""
+        cutoff = time.monotonic() - settings.JOB_RESULT_TTL_SECONDS
+        expired = [
+            job_id for job_id, job in self.jobs.items()
+            if job._finished_monotonic is not None and job._finished_monotonic < cutoff
+        ]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    def submit(self, user_id: str) -> Tuple[RecommendationJob, bool]:
+        """
+        Start (or join) the refresh job for `user_id`.
+        Returns the job and whether it was coalesced into an existing one.
+        """
+        # No await between lookup and insert, so this is race-free on the event loop
+        active = self.active_by_user.get(user_id)
+        if active is not None:
+            self.coalesced += 1
+            return active, True
+
+        self._prune()
+        job = RecommendationJob(user_id)
+        self.jobs[job.job_id] = job
+        self.active_by_user[user_id] = job
+        job.task = asyncio.create_task(self._run(job))
+        return job, False
+
+    def get(self, job_id: str) -> Optional[RecommendationJob]:
+        return self.jobs.get(job_id)
+
+    async def wait(self, job: RecommendationJob, timeout: float) -> RecommendationJob:
+        """
+        Long-poll: wait up to `timeout` seconds for the job to finish.
+        """
+        if timeout > 0 and not job.done.is_set():
+            try:
+                await asyncio.wait_for(job.done.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+        return job
+
+    def _load_portfolio(self, user_id: str):
+        # Pipeline modules are imported on first use (see warm_up); later imports are dict lookups
+        from app.db.session import SessionLocal
+        from app.services.analytics import installment_analytics
+        from app.services.portfolio import portfolio_service
+
+        db = SessionLocal()
+        try:
+            portfolio = portfolio_service.get_aggregated_portfolio(db, user_id)
+            return portfolio, installment_analytics.fund_details_for_user(db, user_id, portfolio)
+        finally:
+            db.close()
+
+    async def _run(self, job: RecommendationJob) -> None:
+        job.status = "running"
+        try:
+            await self.warm_up()
+            from app.services.recommendation import recommendation_service
+
+            portfolio, local_details = await asyncio.to_thread(self._load_portfolio, job.user_id)
+            if not portfolio:
+                job.finish("failed", error="No portfolio found for user")
+                return
+
+            document = await recommendation_service.recommend_for_portfolio_async(job.user_id, portfolio, local_details)
+            with stage("mongo_write"):
+                await asyncio.to_thread(
+                    mongo_db.collection.update_one, {"user_id": job.user_id}, {"$set": document}, upsert=True
+                )
+            recommendation_store.invalidate(job.user_id)
+            job.finish("completed", result=document)
+            await self._flush_fund_metrics()
+            logger.info(f"On-demand recommendation job {job.job_id} completed for user {job.user_id}")
+
+        except asyncio.CancelledError:
+            job.finish("failed", error="Job cancelled")
+            raise
+        except Exception as e:
+            logger.error(f"On-demand recommendation job {job.job_id} failed for user {job.user_id}: {e}")
+            job.finish("failed", error=str(e))
+        finally:
+            self.active_by_user.pop(job.user_id, None)
+
+    async def _flush_fund_metrics(self) -> None:
+        """Publish the numeric metrics of the funds this job fetched, for every process."""
+        from app.services.fund_metrics import fund_metrics_store
+
+        try:
+            await asyncio.to_thread(fund_metrics_store.flush)
+        except Exception as e:
+            logger.warning(f"Failed to write fund metrics: {e}")
+
+    async def shutdown(self) -> None:
+        tasks = [job.task for job in self.active_by_user.values() if job.task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        if self.pipeline_loaded:
+            from app.services.fund_universe import fund_universe
+            from app.services.market_data import market_data_service
+
+            await fund_universe.stop_periodic_refresh()
+            await market_data_service.aclose()
+            market_data_service.close()
+
+
+job_manager = RecommendationJobManager()
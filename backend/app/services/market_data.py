@@ -1,60 +1,485 @@
+import asyncio
+import json
+import threading
+import time
+from datetime import datetime, timezone
+import httpx
 import requests
-from typing import Optional
+from requests.adapters import HTTPAdapter
+from typing import Dict, List, Optional, Tuple
 from app.core.config import settings
+from app.core.exceptions import ConfigurationError
+from app.db.mongo import mongo_db
 from app.schemas.fund import FundDetails
-from app.utils.common import extract_json
+from app.utils.cache import TieredCache
+from app.utils.common import extract_json, normalize_fund_name
+from app.utils.metrics import external_call, record_tokens
 from app.utils.prompt_loader import load_prompt
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type, before_sleep_log
+from app.utils.rate_limiter import RATE_LIMIT_COLLECTION, build_provider_limiter
+from app.utils.retry import external_retry
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Shared retry policy; tenacity awaits between attempts for the async methods
+perplexity_retry = external_retry(logger, "perplexity")
+
 class MarketDataService:
     BASE_URL = "https://api.perplexity.ai/chat/completions"
-    
-    @retry(
-        stop=stop_after_attempt(3),
-        wait=wait_exponential(multiplier=1, min=2, max=10),
-        retry=retry_if_exception_type(Exception),
-        reraise=True,
-        before_sleep=before_sleep_log(logger, logging.WARNING)
-    )
+    CACHE_COLLECTION = "fund_details_cache"
+
+    def __init__(self):
+        self.cache = TieredCache(
+            name="fund_details",
+            maxsize=settings.FUND_CACHE_MAX_ENTRIES,
+            ttl_seconds=settings.FUND_CACHE_TTL_SECONDS,
+            collection_getter=self._cache_collection if settings.FUND_CACHE_PERSIST else None,
+        )
+        self._session: Optional[requests.Session] = None
+        self._session_lock = threading.Lock()
+        # One pooled client per event loop; a client cannot be used or closed from another loop
+        self._async_clients: Dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
+        self._async_requests = 0
+        self._async_new_connections = 0
+        self._metrics = {path: self._empty_metrics() for path in ("single", "batch")}
+        self.limiter = build_provider_limiter(
+            "perplexity",
+            rate_per_second=settings.PERPLEXITY_RATE_PER_SECOND,
+            burst=settings.PERPLEXITY_BURST,
+            collection_getter=lambda: mongo_db.get_collection(RATE_LIMIT_COLLECTION),
+        )
+        self._metrics_lock = threading.Lock()
+
+    def _cache_collection(self):
+        return mongo_db.get_collection(self.CACHE_COLLECTION)
+
     def fetch_fund_details(self, fund_name: str) -> Optional[FundDetails]:
         """
-        Fetch accurate, real fund details for ONE fund using Perplexity.
+        Fetch fund details for ONE fund, served from the shared cache when possible.
         """
-        prompt = load_prompt(
-            "market_data_fetch.txt",
-            fund_name=fund_name
+        key = normalize_fund_name(fund_name)
+        if not key:
+            return None
+
+        data = self.cache.get_or_load(key, lambda: self._fetch_from_api(fund_name))
+        return FundDetails(**data) if data else None
+
+    async def fetch_fund_details_async(self, fund_name: str) -> Optional[FundDetails]:
+        """
+        Async variant of `fetch_fund_details`.
+        """
+        key = normalize_fund_name(fund_name)
+        if not key:
+            return None
+
+        data = await self.cache.aget_or_load(key, lambda: self._fetch_from_api_async(fund_name))
+        return FundDetails(**data) if data else None
+
+    def fetch_fund_details_batch(self, fund_names: List[str]) -> Dict[str, Optional[FundDetails]]:
+        """
+        Fetch details for several funds with one Perplexity request per
+        MARKET_DATA_BATCH_SIZE cache misses. Misses another caller is already
+        fetching are shared, not fetched again. Entries the batch response did
+        not return validly are retried with per-fund calls.
+
+        Returns a mapping of each requested name to its details (None if not found).
+        """
+        results, names_by_key = self._split_keys(fund_names)
+        loaded = self.cache.get_or_load_many(list(names_by_key), lambda keys: self._load_batch(keys, names_by_key))
+        self._collect(loaded, names_by_key, results)
+
+        # Per-fund fallback only for entries that failed in the batch
+        for name in [n for n in fund_names if n not in results]:
+            try:
+                results[name] = self.fetch_fund_details(name)
+            except Exception as e:
+                logger.warning(f"Failed to fetch details for {name} after retries: {e}")
+                results[name] = None
+        return results
+
+    async def fetch_fund_details_batch_async(self, fund_names: List[str]) -> Dict[str, Optional[FundDetails]]:
+        """
+        Async variant of `fetch_fund_details_batch`; chunks are fetched concurrently.
+        """
+        results, names_by_key = self._split_keys(fund_names)
+        loaded = await self.cache.aget_or_load_many(
+            list(names_by_key), lambda keys: self._load_batch_async(keys, names_by_key)
         )
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {settings.PERPLEXITY_API_KEY}",
-        }
+        self._collect(loaded, names_by_key, results)
+
+        async def fallback(name: str) -> Optional[FundDetails]:
+            try:
+                return await self.fetch_fund_details_async(name)
+            except Exception as e:
+                logger.warning(f"Failed to fetch details for {name} after retries: {e}")
+                return None
 
-        payload = {
+        missing = [n for n in fund_names if n not in results]
+        for name, details in zip(missing, await asyncio.gather(*(fallback(n) for n in missing))):
+            results[name] = details
+        return results
+
+    @staticmethod
+    def _split_keys(fund_names: List[str]) -> Tuple[Dict[str, Optional[FundDetails]], Dict[str, List[str]]]:
+        """
+        Group the requested names by cache key; return (results for names
+        without a key, {cache key: [requested names]}).
+        """
+        results: Dict[str, Optional[FundDetails]] = {}
+        names_by_key: Dict[str, List[str]] = {}
+        for name in fund_names:
+            key = normalize_fund_name(name)
+            if key:
+                names_by_key.setdefault(key, []).append(name)
+            else:
+                results[name] = None
+        return results, names_by_key
+
+    @staticmethod
+    def _collect(
+        loaded: Dict[str, Optional[dict]],
+        names_by_key: Dict[str, List[str]],
+        results: Dict[str, Optional[FundDetails]],
+    ) -> None:
+        for key, data in loaded.items():
+            for name in names_by_key[key]:
+                results[name] = FundDetails(**data) if data else None
+
+    def _chunks(self, keys: List[str]) -> List[List[str]]:
+        size = max(settings.MARKET_DATA_BATCH_SIZE, 1)
+        return [keys[i:i + size] for i in range(0, len(keys), size)]
+
+    def _load_batch(self, keys: List[str], names_by_key: Dict[str, List[str]]) -> Dict[str, Optional[dict]]:
+        """Batch-fetch the cache misses this caller claimed; failed chunks are left out."""
+        loaded: Dict[str, Optional[dict]] = {}
+        for chunk in self._chunks(keys):
+            try:
+                loaded.update(self._fetch_batch_from_api([names_by_key[key][0] for key in chunk]))
+            except Exception as e:
+                logger.warning(f"Perplexity batch fetch failed, falling back to per-fund calls: {e}")
+        return loaded
+
+    async def _load_batch_async(self, keys: List[str], names_by_key: Dict[str, List[str]]) -> Dict[str, Optional[dict]]:
+        chunks = self._chunks(keys)
+        fetched_chunks = await asyncio.gather(
+            *(self._fetch_batch_from_api_async([names_by_key[key][0] for key in chunk]) for chunk in chunks),
+            return_exceptions=True
+        )
+        loaded: Dict[str, Optional[dict]] = {}
+        for fetched in fetched_chunks:
+            if isinstance(fetched, Exception):
+                logger.warning(f"Perplexity batch fetch failed, falling back to per-fund calls: {fetched}")
+                continue
+            loaded.update(fetched)
+        return loaded
+
+    def _build_payload(self, prompt: str, max_tokens: int = 800) -> dict:
+        return {
             "model": "sonar-pro",
             "messages": [
                 {"role": "system", "content": "Return ONLY JSON."},
                 {"role": "user", "content": prompt}
             ],
             "temperature": 0.2,
-            "max_tokens": 800
+            "max_tokens": max_tokens
+        }
+
+    def _single_payload(self, fund_name: str) -> dict:
+        prompt = load_prompt(
+            "market_data_fetch.txt",
+            fund_name=fund_name
+        )
+        return self._build_payload(prompt)
+
+    def _batch_payload(self, fund_names: List[str]) -> dict:
+        prompt = load_prompt(
+            "market_data_fetch_batch.txt",
+            fund_names_json=json.dumps(fund_names, ensure_ascii=False)
+        )
+        return self._build_payload(prompt, max_tokens=100 + 700 * len(fund_names))
+
+    def _headers(self) -> dict:
+        if not settings.PERPLEXITY_API_KEY:
+            raise ConfigurationError("PERPLEXITY_API_KEY")
+        return {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {settings.PERPLEXITY_API_KEY}",
         }
 
+    def _parse_response(self, body: dict) -> Optional[dict]:
+        content = body["choices"][0]["message"]["content"].strip()
+        data = extract_json(content)
+
+        if data:
+            # Validate before the result is cached
+            return self._stamp(FundDetails(**data).dict(), datetime.now(timezone.utc))
+        return None
+
+    def _parse_batch_response(self, body: dict, keys: List[str]) -> Dict[str, Optional[dict]]:
+        """
+        Map batch entries back to the requested cache keys. Funds reported as
+        not found map to None; entries that are missing or fail validation are
+        omitted so the caller can retry them individually.
+        """
+        content = body["choices"][0]["message"]["content"].strip()
+        data = extract_json(content)
+        entries = data.get("funds") if isinstance(data, dict) else data
+        if not isinstance(entries, list):
+            return {}
+
+        fetched_at = datetime.now(timezone.utc)
+        parsed: Dict[str, Optional[dict]] = {}
+        for index, entry in enumerate(entries):
+            if not isinstance(entry, dict):
+                continue
+            key = normalize_fund_name(entry.get("requested_name") or "")
+            if key not in keys:
+                # Fall back to positional matching when the echo is missing or altered
+                if len(entries) != len(keys):
+                    continue
+                key = keys[index]
+            if entry.get("found") is False:
+                parsed[key] = None
+                continue
+            try:
+                parsed[key] = self._stamp(FundDetails(**entry).dict(), fetched_at)
+            except Exception as e:
+                logger.warning(f"Invalid batch entry for {key}: {e}")
+        return parsed
+
+    @staticmethod
+    def _stamp(details: dict, fetched_at: datetime) -> dict:
+        """Keep the answer's fetch time with the cached entry, for the fund metrics store."""
+        details["fetched_at"] = fetched_at.isoformat()
+        return details
+
+    @staticmethod
+    def _empty_metrics() -> Dict[str, float]:
+        return {"calls": 0, "funds": 0, "seconds": 0.0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    def _record(self, path: str, funds: int, seconds: float, body: Optional[dict]) -> None:
+        usage = (body or {}).get("usage") or {}
+        with self._metrics_lock:
+            m = self._metrics[path]
+            m["calls"] += 1
+            m["funds"] += funds
+            m["seconds"] += seconds
+            m["prompt_tokens"] += usage.get("prompt_tokens", 0)
+            m["completion_tokens"] += usage.get("completion_tokens", 0)
+        record_tokens("perplexity", path, usage.get("prompt_tokens"), usage.get("completion_tokens"))
+
+    def api_metrics(self) -> Dict[str, Dict[str, float]]:
+        """
+        Calls, time and tokens spent per fetch path, with per-fund averages so
+        the single and batch paths can be compared directly.
+        """
+        with self._metrics_lock:
+            metrics = {path: dict(m) for path, m in self._metrics.items()}
+        for m in metrics.values():
+            funds = m["funds"] or 1
+            m["seconds"] = round(m["seconds"], 3)
+            m["seconds_per_fund"] = round(m["seconds"] / funds, 3)
+            m["tokens_per_fund"] = round((m["prompt_tokens"] + m["completion_tokens"]) / funds, 1)
+        return metrics
+
+    def _post(self, payload: dict, path: str, funds: int) -> dict:
+        start = time.perf_counter()
+        body = None
         try:
-            res = requests.post(self.BASE_URL, headers=headers, json=payload, timeout=40)
-            res.raise_for_status()
-            
-            content = res.json()["choices"][0]["message"]["content"].strip()
-            data = extract_json(content)
-            
-            if data:
-                return FundDetails(**data)
-            return None
+            with self.limiter.limit(), external_call("perplexity", path):
+                res = self._get_session().post(
+                    self.BASE_URL,
+                    json=payload,
+                    timeout=(settings.PERPLEXITY_CONNECT_TIMEOUT, settings.PERPLEXITY_READ_TIMEOUT),
+                )
+                res.raise_for_status()
+            body = res.json()
+            return body
+        finally:
+            self._record(path, funds, time.perf_counter() - start, body)
+
+    async def _post_async(self, payload: dict, path: str, funds: int) -> dict:
+        start = time.perf_counter()
+        body = None
+        try:
+            async with self.limiter.limit_async():
+                self._async_requests += 1
+                with external_call("perplexity", path):
+                    res = await self._get_async_client().post(
+                        self.BASE_URL, json=payload, extensions={"trace": self._trace_connection}
+                    )
+                    res.raise_for_status()
+            body = res.json()
+            return body
+        finally:
+            self._record(path, funds, time.perf_counter() - start, body)
+
+    def _get_session(self) -> requests.Session:
+        """
+        Keep-alive session shared by all threads, so repeated fetches reuse
+        pooled connections instead of paying a TCP+TLS handshake each time.
+        """
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    session.headers.update(self._headers())
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.PERPLEXITY_POOL_SIZE)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._session = session
+        return self._session
+
+    def _get_async_client(self) -> httpx.AsyncClient:
+        """
+        Pooled async client of the running event loop. A new loop (e.g. a
+        separate asyncio.run() call) gets its own client; clients of loops
+        that are gone are closed first, so their connections do not leak.
+        """
+        loop = asyncio.get_running_loop()
+        with self._session_lock:
+            client = self._async_clients.get(loop)
+            if client is not None:
+                return client
+            stale = {l: c for l, c in self._async_clients.items() if not l.is_running()}
+            for old_loop in stale:
+                del self._async_clients[old_loop]
+            client = self._async_clients[loop] = httpx.AsyncClient(
+                headers=self._headers(),
+                timeout=httpx.Timeout(
+                    settings.PERPLEXITY_READ_TIMEOUT,
+                    connect=settings.PERPLEXITY_CONNECT_TIMEOUT,
+                ),
+                limits=httpx.Limits(
+                    max_connections=settings.PERPLEXITY_POOL_SIZE,
+                    max_keepalive_connections=settings.PERPLEXITY_POOL_SIZE,
+                    keepalive_expiry=settings.PERPLEXITY_KEEPALIVE_SECONDS,
+                ),
+            )
+        for old_loop, old_client in stale.items():
+            self._close_stale_client(old_loop, old_client)
+        return client
+
+    @staticmethod
+    def _close_stale_client(loop: asyncio.AbstractEventLoop, client: httpx.AsyncClient) -> None:
+        """Close a client whose loop is not running, on that loop while it still exists."""
+        if loop.is_closed():
+            # Its transports died with the loop; aclose() must be awaited before asyncio.run() returns
+            logger.warning("Perplexity async client outlived its event loop; call aclose() before the loop ends")
+            return
+
+        def close():
+            try:
+                loop.run_until_complete(client.aclose())
+            except Exception as e:
+                logger.warning(f"Failed to close a stale Perplexity async client: {e}")
+
+        # This thread may be running another loop, which rules out run_until_complete here
+        closer = threading.Thread(target=close, name="perplexity-client-close", daemon=True)
+        closer.start()
+        closer.join()
+
+    async def _trace_connection(self, event_name: str, info: dict) -> None:
+        # httpcore trace hook: fires only when a brand new connection is opened
+        if event_name == "connection.connect_tcp.complete":
+            self._async_new_connections += 1
+
+    def connection_stats(self) -> Dict[str, int]:
+        """
+        Requests sent vs new connections opened; the difference was served
+        over reused keep-alive connections.
+        """
+        sync_requests = sync_connections = 0
+        if self._session is not None:
+            pools = self._session.get_adapter(self.BASE_URL).poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                sync_requests += pool.num_requests
+                sync_connections += pool.num_connections
+
+        return {
+            "sync_requests": sync_requests,
+            "sync_new_connections": sync_connections,
+            "sync_reused": max(sync_requests - sync_connections, 0),
+            "async_requests": self._async_requests,
+            "async_new_connections": self._async_new_connections,
+            "async_reused": max(self._async_requests - self._async_new_connections, 0),
+        }
+
+    def close(self) -> None:
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    async def aclose(self) -> None:
+        """Close the async clients of every event loop; call before the running loop ends."""
+        current = asyncio.get_running_loop()
+        with self._session_lock:
+            clients, self._async_clients = self._async_clients, {}
+        for loop, client in clients.items():
+            if loop is current:
+                await client.aclose()
+            elif loop.is_running():
+                await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(client.aclose(), loop))
+            else:
+                self._close_stale_client(loop, client)
+
+    @perplexity_retry
+    def _fetch_from_api(self, fund_name: str) -> Optional[dict]:
+        """
+        Fetch accurate, real fund details for ONE fund using Perplexity.
+        """
+        payload = self._single_payload(fund_name)
+
+        try:
+            return self._parse_response(self._post(payload, "single", 1))
+
+        except Exception as e:
+            logger.error(f"Perplexity ERROR for {fund_name}: {e}")
+            raise e
+
+    @perplexity_retry
+    async def _fetch_from_api_async(self, fund_name: str) -> Optional[dict]:
+        """
+        Async variant of `_fetch_from_api` over the pooled httpx client.
+        """
+        payload = self._single_payload(fund_name)
+
+        try:
+            return self._parse_response(await self._post_async(payload, "single", 1))
 
         except Exception as e:
             logger.error(f"Perplexity ERROR for {fund_name}: {e}")
             raise e
 
+    @perplexity_retry
+    def _fetch_batch_from_api(self, fund_names: List[str]) -> Dict[str, Optional[dict]]:
+        """
+        Fetch details for several funds in ONE Perplexity request, keyed by cache key.
+        """
+        payload = self._batch_payload(fund_names)
+        keys = [normalize_fund_name(name) for name in fund_names]
+
+        try:
+            return self._parse_batch_response(self._post(payload, "batch", len(keys)), keys)
+
+        except Exception as e:
+            logger.error(f"Perplexity batch ERROR for {fund_names}: {e}")
+            raise e
+
+    @perplexity_retry
+    async def _fetch_batch_from_api_async(self, fund_names: List[str]) -> Dict[str, Optional[dict]]:
+        """
+        Async variant of `_fetch_batch_from_api`.
+        """
+        payload = self._batch_payload(fund_names)
+        keys = [normalize_fund_name(name) for name in fund_names]
+
+        try:
+            return self._parse_batch_response(await self._post_async(payload, "batch", len(keys)), keys)
+
+        except Exception as e:
+            logger.error(f"Perplexity batch ERROR for {fund_names}: {e}")
+            raise e
+
 market_data_service = MarketDataService()
@@ -1,80 +1,149 @@
+from itertools import groupby
+from sqlalchemy import func, desc, select
 from sqlalchemy.orm import Session
+from app.core.config import settings
 from app.models.mutual_funds import SIPTransaction, SIPInstallments, SIPSchedule, MutualFundSchemes
-from typing import List, Dict, Any, Optional
+from app.utils.common import fingerprint
+from typing import List, Dict, Any, Optional, Iterable, Iterator, Tuple
+
+TOP_FUNDS_PER_USER = 3
+
+def paid_installments():
+    """Filter for installments that were paid; failed or pending ones carry no money or units."""
+    return func.upper(SIPInstallments.status).in_([status.upper() for status in settings.INSTALLMENT_PAID_STATUSES])
 
 class PortfolioService:
-    def get_aggregated_portfolio(self, db: Session, user_id: str) -> List[Dict[str, Any]]:
+    def _installment_totals(self, db: Session, user_ids: Optional[List[str]] = None):
         """
-        Fetch & aggregate user's mutual fund portfolio.
+        Installment totals collapsed to one row per SIP, so joining them can
+        never multiply the SIP row. Only paid installments count. Restricted
+        to the given users' SIPs.
         """
-        # Fetch raw MF rows
-        rows = (
+        query = (
             db.query(
+                SIPInstallments.sip_id.label("sip_id"),
+                func.sum(SIPInstallments.amount).label("amount"),
+                func.sum(SIPInstallments.units).label("units"),
+            )
+            .filter(SIPInstallments.units.isnot(None), paid_installments())
+            .group_by(SIPInstallments.sip_id)
+        )
+        if user_ids is not None:
+            user_sips = select(SIPTransaction.id).where(SIPTransaction.user_id.in_(user_ids))
+            query = query.filter(SIPInstallments.sip_id.in_(user_sips))
+        return query.subquery()
+
+    def _aggregation_query(self, db: Session, user_ids: Optional[List[str]] = None):
+        """
+        Per (user_id, scheme_code) aggregation, grouped server-side and ordered
+        so that each user's schemes arrive together, largest investment first.
+
+        Schedule totals are used as-is; when they are missing (and
+        PORTFOLIO_INSTALLMENT_FALLBACK is on) the SIP's installments are summed instead.
+        """
+        invested = SIPSchedule.total_invested_amount
+        units = SIPSchedule.total_units_allocated
+        installments = None
+
+        if settings.PORTFOLIO_INSTALLMENT_FALLBACK:
+            installments = self._installment_totals(db, user_ids)
+            invested = func.coalesce(invested, installments.c.amount)
+            units = func.coalesce(units, installments.c.units)
+
+        query = (
+            db.query(
+                SIPTransaction.user_id,
                 SIPTransaction.scheme_code,
-                MutualFundSchemes.scheme_name,
-                SIPTransaction.amount.label("sip_amount"),
-                SIPSchedule.total_invested_amount,
-                SIPSchedule.total_units_allocated, 
+                func.max(MutualFundSchemes.scheme_name).label("scheme_name"),
+                func.sum(invested).label("total_invested_amount"),
+                func.sum(units).label("total_units"),
+                # Zero SIP amounts are ignored, as before
+                func.avg(func.nullif(SIPTransaction.amount, 0)).label("avg_sip_amount"),
             )
             .join(SIPSchedule, SIPSchedule.sip_id == SIPTransaction.id)
-            .outerjoin(SIPInstallments, SIPInstallments.sip_id == SIPTransaction.id)
             .join(MutualFundSchemes, MutualFundSchemes.scheme_code == SIPTransaction.scheme_code)
-            .filter(SIPTransaction.user_id == user_id)
-            .filter(SIPSchedule.total_invested_amount.isnot(None))
-            .all()
         )
+        if installments is not None:
+            query = query.outerjoin(installments, installments.c.sip_id == SIPTransaction.id)
+        if user_ids is not None:
+            query = query.filter(SIPTransaction.user_id.in_(user_ids))
 
-        if not rows:
-            return []
-
-        # Aggregate by scheme_code
-        portfolio = {}
-
-        for row in rows:
-            sc = row.scheme_code
-
-            if sc not in portfolio:
-                portfolio[sc] = {
-                    "scheme_code": sc,
-                    "scheme_name": row.scheme_name,
-                    "total_invested_amount": 0.0,
-                    "total_units": 0.0,
-                    "sip_amounts": [],
-                }
-
-            # Aggregation
-            portfolio[sc]["total_invested_amount"] += float(row.total_invested_amount or 0)
-            portfolio[sc]["total_units"] += float(row.total_units_allocated or 0)
-
-            # SIP collection
-            if row.sip_amount:
-                portfolio[sc]["sip_amounts"].append(float(row.sip_amount))
-
-        # Build final aggregated list
-        final_list = []
-        for sc, data in portfolio.items():
-            avg_sip = (
-                sum(data["sip_amounts"]) / len(data["sip_amounts"])
-                if data["sip_amounts"] else None
-            )
+        return (
+            query
+            .filter(invested.isnot(None))
+            .group_by(SIPTransaction.user_id, SIPTransaction.scheme_code)
+            .order_by(SIPTransaction.user_id, desc("total_invested_amount"))
+        )
+
+    def _to_portfolio_entry(self, row) -> Dict[str, Any]:
+        avg_sip = float(row.avg_sip_amount) if row.avg_sip_amount else None
+        return {
+            "scheme_code": row.scheme_code,
+            "scheme_name": row.scheme_name,
+            "total_invested_amount": round(float(row.total_invested_amount or 0), 2),
+            "total_units": round(float(row.total_units or 0), 4),
+            "avg_sip_amount": round(avg_sip, 2) if avg_sip else None,
+        }
+
+    def portfolio_fingerprint(self, portfolio: List[Dict[str, Any]]) -> str:
+        """
+        Hash of an aggregated portfolio; it only changes when the user's
+        holdings (or amounts invested) change.
+        """
+        return fingerprint(portfolio)
+
+    def _group_rows(self, rows) -> Iterator[Tuple[str, List[Dict[str, Any]]]]:
+        for user_id, user_rows in groupby(rows, key=lambda r: r.user_id):
+            # Rows are already ordered by invested amount, keep only the top funds
+            top = [self._to_portfolio_entry(r) for _, r in zip(range(TOP_FUNDS_PER_USER), user_rows)]
+            yield user_id, top
+
+    def iter_aggregated_portfolios(
+        self,
+        db: Session,
+        user_ids: Optional[Iterable[str]] = None,
+        chunk_size: Optional[int] = None,
+    ) -> Iterator[Tuple[str, List[Dict[str, Any]]]]:
+        """
+        Stream (user_id, top-3 portfolio) pairs for many users.
+
+        With `user_ids`, users are queried in chunks of `chunk_size` (one query per
+        chunk); without, all users are streamed from a single query. Users with
+        no aggregated holdings are not yielded.
+        """
+        chunk_size = chunk_size or settings.PORTFOLIO_BULK_CHUNK_SIZE
+
+        if user_ids is None:
+            rows = self._aggregation_query(db).yield_per(chunk_size)
+            yield from self._group_rows(rows)
+            return
+
+        user_ids = list(user_ids)
+        for i in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[i:i + chunk_size]
+            rows = self._aggregation_query(db, chunk).yield_per(chunk_size)
+            yield from self._group_rows(rows)
+
+    def get_aggregated_portfolio(self, db: Session, user_id: str) -> List[Dict[str, Any]]:
+        """
+        Fetch & aggregate user's mutual fund portfolio.
+        """
+        # Drain the stream so no server-side cursor is left open on the session
+        portfolios = dict(self.iter_aggregated_portfolios(db, [user_id]))
+        return portfolios.get(user_id, [])
+
+    def calculate_budget(self, portfolio: List[Dict[str, Any]]) -> int:
+        """
+        Monthly budget: average SIP amount, falling back to average invested amount.
+        """
+        sip_amounts = [p.get("avg_sip_amount") for p in portfolio if p.get("avg_sip_amount")]
+        invested_amounts = [p.get("total_invested_amount") for p in portfolio if p.get("total_invested_amount")]
 
-            final_list.append({
-                "scheme_code": sc,
-                "scheme_name": data["scheme_name"],
-                "total_invested_amount": round(data["total_invested_amount"], 2),
-                "total_units": round(data["total_units"], 4),
-                "avg_sip_amount": round(avg_sip, 2) if avg_sip else None,
-            })
-
-        # Select only top 3 if more than 3 funds
-        if len(final_list) > 3:
-            final_list = sorted(
-                final_list,
-                key=lambda x: x["total_invested_amount"],
-                reverse=True
-            )[:3]
-
-        return final_list
+        if sip_amounts:
+            return round(sum(sip_amounts) / len(sip_amounts))
+        if invested_amounts:
+            return round(sum(invested_amounts) / len(invested_amounts))
+        return 0
 
     def get_all_user_ids(self, db: Session) -> List[str]:
         """
@@ -1,60 +1,332 @@
-from typing import List, Dict, Any, Tuple
-from datetime import datetime
+import asyncio
+import time
+from typing import List, Dict, Any, Tuple, Optional
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from app.core.config import settings
 from app.services.market_data import market_data_service
 from app.services.advisor import advisor_service
-from app.utils.timer import Timer
+from app.services.candidate_ranking import Candidate, candidate_ranker
+from app.services.fund_metrics import fund_metrics_store
+from app.services.fund_universe import fund_universe
+from app.services.portfolio import portfolio_service
+from app.utils.common import normalize_fund_name
+from app.utils.prompt_loader import prompt_registry
+from app.utils.metrics import observe_stage, stage
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Funds recommended per user (the prompts ask Gemini for exactly this many)
+RECOMMENDATION_COUNT = 5
+
 class RecommendationService:
-    def run_pipeline(self, fund_names: List[str]) -> Dict[str, Any]:
+    def _fund_groups(self, fund_names: List[str]) -> List[List[str]]:
+        """Split names into groups of MARKET_DATA_BATCH_SIZE (one request per group)."""
+        size = max(settings.MARKET_DATA_BATCH_SIZE, 1)
+        return [fund_names[i:i + size] for i in range(0, len(fund_names), size)]
+
+    def _fetch_group(self, names: List[str], label: str) -> List[Optional[Dict[str, Any]]]:
+        """
+        Fetch details for one group of funds, isolating failures so one bad
+        fund never aborts the pipeline.
+        """
+        try:
+            if len(names) == 1:
+                found = {names[0]: market_data_service.fetch_fund_details(names[0])}
+            else:
+                found = market_data_service.fetch_fund_details_batch(names)
+        except Exception as e:
+            logger.warning(f"Failed to fetch details for {label}s {names} after retries: {e}")
+            return []
+        details = [self._to_detail(name, found.get(name)) for name in names]
+        self._record_metrics(names, found, details)
+        return details
+
+    @staticmethod
+    def _record_metrics(names: List[str], found: Dict[str, Any], details: List[Optional[Dict[str, Any]]]) -> None:
+        # Detail dicts leave out the fetch time; the store needs it so cached answers are not taken as fresh
+        fund_metrics_store.record(
+            dict(detail, fetched_at=found[name].fetched_at) for name, detail in zip(names, details) if detail
+        )
+
+    def _to_detail(self, name: str, details) -> Optional[Dict[str, Any]]:
+        if not details:
+            return None
+        # Convert Pydantic models to dicts for JSON serialization later
+        data = details.dict()
+        data["scheme_code"] = data.get("scheme_code") or fund_universe.code_for(name)
+        return data
+
+    def _fetch_many(self, fund_names: List[str], label: str) -> List[Dict[str, Any]]:
+        """
+        Fetch details for several funds, batching up to MARKET_DATA_BATCH_SIZE
+        funds per request and running requests with bounded concurrency.
+        Results keep the order of `fund_names`; failed funds are dropped.
+        """
+        if not fund_names:
+            return []
+
+        groups = self._fund_groups(fund_names)
+        workers = min(max(settings.PIPELINE_FETCH_CONCURRENCY, 1), len(groups))
+        if workers == 1:
+            results = [self._fetch_group(group, label) for group in groups]
+        else:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fund-fetch") as executor:
+                results = list(executor.map(lambda group: self._fetch_group(group, label), groups))
+
+        return [r for group in results for r in group if r]
+
+    def fetch_details_by_name(self, fund_names: List[str], concurrency: int) -> Dict[str, Optional[Dict[str, Any]]]:
+        """
+        Details for each name ({name: details or None}), fetched in groups of
+        MARKET_DATA_BATCH_SIZE with up to `concurrency` requests in flight.
+        """
+        groups = self._fund_groups(fund_names)
+        if not groups:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(max(concurrency, 1), len(groups)), thread_name_prefix="fund-prefetch") as executor:
+            results = list(executor.map(lambda group: self._fetch_group(group, "prefetched fund"), groups))
+        return {
+            name: details
+            for group, found in zip(groups, results)
+            # _fetch_group returns [] when the whole group failed
+            for name, details in zip(group, found or [None] * len(group))
+        }
+
+    async def _fetch_group_async(
+        self, names: List[str], label: str, semaphore: asyncio.Semaphore
+    ) -> List[Optional[Dict[str, Any]]]:
+        async with semaphore:
+            try:
+                if len(names) == 1:
+                    found = {names[0]: await market_data_service.fetch_fund_details_async(names[0])}
+                else:
+                    found = await market_data_service.fetch_fund_details_batch_async(names)
+            except Exception as e:
+                logger.warning(f"Failed to fetch details for {label}s {names} after retries: {e}")
+                return []
+        details = [self._to_detail(name, found.get(name)) for name in names]
+        self._record_metrics(names, found, details)
+        return details
+
+    async def _fetch_many_async(self, fund_names: List[str], label: str) -> List[Dict[str, Any]]:
+        """
+        Async counterpart of `_fetch_many`, bounded by the same concurrency limit.
+        """
+        if not fund_names:
+            return []
+
+        semaphore = asyncio.Semaphore(max(settings.PIPELINE_FETCH_CONCURRENCY, 1))
+        results = await asyncio.gather(
+            *(self._fetch_group_async(group, label, semaphore) for group in self._fund_groups(fund_names))
+        )
+        return [r for group in results for r in group if r]
+
+    def _split_local(self, fund_names: List[str], local_details: Optional[Dict[str, Dict[str, Any]]]) -> Tuple[List[Dict[str, Any]], List[str]]:
+        """
+        Separate held funds with precomputed details (local analytics or the
+        batch prefetch) from those that still need an external fetch.
+        Returns (precomputed details, names to fetch).
+        """
+        fund_names = fund_universe.canonicalize(fund_names)
+        if not local_details:
+            return [], fund_names
+
+        by_name = {normalize_fund_name(name): details for name, details in local_details.items()}
+        local = [by_name[normalize_fund_name(n)] for n in fund_names if normalize_fund_name(n) in by_name]
+        remote = [n for n in fund_names if normalize_fund_name(n) not in by_name]
+        logger.info(f"Using precomputed details for {len(local)}/{len(fund_names)} held funds")
+        return local, remote
+
+    def finish_pipeline(
+        self, final_result: Any, timing: Dict[str, float], start_time: float, busy_seconds: Optional[float] = None
+    ) -> Any:
+        """
+        Log timings (start_time is a perf_counter value) and strip timing
+        metadata from the result. Callers that queue a user between stages
+        pass the time spent in the stages as `busy_seconds`: that is the
+        total, and the rest is recorded as `queue_wait`, so `total` means
+        the same in every batch mode.
+        """
+        end_time = datetime.now()
+        total_duration = time.perf_counter() - start_time
+        if busy_seconds is not None:
+            queue_wait = max(total_duration - busy_seconds, 0.0)
+            timing["queue_wait_seconds"] = round(queue_wait, 3)
+            observe_stage("queue_wait", queue_wait)
+            total_duration = busy_seconds
+        timing["total_seconds"] = round(total_duration, 3)
+        observe_stage("total", total_duration)
+
+        logger.info(f"Recommendation pipeline completed at {end_time.isoformat()}")
+        logger.info(f"Pipeline Execution Timing: {timing}")
+
+        # Sanitize result to ensure no timing metadata leaks into the DB
+        if final_result and isinstance(final_result, dict):
+            # Explicitly remove typical timing keys if they somehow appeared
+            for key in ["timestamp", "generated_at", "execution_time", "timing"]:
+                final_result.pop(key, None)
+
+        return final_result
+
+    def fetch_user_funds(self, fund_names: List[str], local_details: Optional[Dict[str, Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+        """Stage 1: details of the user's funds, from local analytics where available, else Perplexity."""
+        local, remote = self._split_local(fund_names, local_details)
+        return local + self._fetch_many(remote, "fund")
+
+    def _shortlist(self, user_fund_details: List[Dict[str, Any]], portfolio: Optional[List[Dict[str, Any]]]) -> List[Candidate]:
+        """Local pre-ranking of the fund universe; [] when disabled or the metrics store is still too small."""
+        if not settings.PRERANK_ENABLED:
+            return []
+        try:
+            with stage("prerank"):
+                return candidate_ranker.shortlist(user_fund_details, portfolio)
+        except Exception as e:
+            logger.warning(f"Candidate pre-ranking failed, asking Gemini without a shortlist: {e}")
+            return []
+
+    def _recommend_request(
+        self, user_fund_details: List[Dict[str, Any]], portfolio: Optional[List[Dict[str, Any]]]
+    ) -> Tuple[List[Any], Optional[List[List[Any]]], List[Candidate]]:
+        """(holdings, candidates) for the Gemini prompt, plus the shortlist kept as fallback."""
+        shortlist = self._shortlist(user_fund_details, portfolio)
+        if not shortlist:
+            return user_fund_details, None, []
+        # With a shortlist, Gemini only needs each holding's category, risk and weight, as compact rows
+        holdings = candidate_ranker.prompt_holdings(user_fund_details, portfolio)
+        candidates = [c.prompt_row() for c in shortlist]
+        # The shortlist is there to shrink the prompt; when it would not, ask as before and keep it as fallback
+        if advisor_service.recommend_prompt_chars(holdings, candidates) >= advisor_service.recommend_prompt_chars(user_fund_details):
+            return user_fund_details, None, shortlist
+        return holdings, candidates, shortlist
+
+    def _names_or_fallback(self, names: List[str], shortlist: List[Candidate]) -> List[str]:
+        if names or not shortlist:
+            return names
+        logger.info("Gemini returned no recommendations, using the local shortlist")
+        return [c.name for c in shortlist[:RECOMMENDATION_COUNT]]
+
+    def recommend_names(self, user_fund_details: List[Dict[str, Any]], portfolio: Optional[List[Dict[str, Any]]] = None) -> List[str]:
+        """
+        Stage 2: recommended fund names from Gemini, choosing from the local
+        shortlist when there is one. If Gemini fails, the shortlist's top
+        funds are used instead ([] without a shortlist).
+        """
+        holdings, candidates, shortlist = self._recommend_request(user_fund_details, portfolio)
+        try:
+            name_response = advisor_service.recommend_fund_names(holdings, candidates=candidates)
+            names = name_response.get("recommended_fund_names", [])
+        except Exception as e:
+            logger.error(f"Gemini recommendation failed after retries: {e}")
+            names = []
+        return self._names_or_fallback(names, shortlist)
+
+    async def recommend_names_async(
+        self, user_fund_details: List[Dict[str, Any]], portfolio: Optional[List[Dict[str, Any]]] = None
+    ) -> List[str]:
+        """Async variant of `recommend_names`."""
+        holdings, candidates, shortlist = self._recommend_request(user_fund_details, portfolio)
+        try:
+            name_response = await advisor_service.recommend_fund_names_async(holdings, candidates=candidates)
+            names = name_response.get("recommended_fund_names", [])
+        except Exception as e:
+            logger.error(f"Gemini recommendation failed after retries: {e}")
+            names = []
+        return self._names_or_fallback(names, shortlist)
+
+    def fetch_recommended_funds(self, recommended_names: List[str]) -> List[Dict[str, Any]]:
+        """Stage 3: details of the recommended funds."""
+        # Gemini's free-text names -> canonical scheme names, so fetches and caches line up
+        recommended_names = fund_universe.canonicalize(recommended_names)
+        return self._fetch_many(recommended_names, "recommended fund")
+
+    def enrich(self, user_fund_details: List[Dict[str, Any]], recommended_full: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Stage 4: pros, cons and ranking from Gemini (None if it fails)."""
+        payload = {
+            "user_fund_details": user_fund_details,
+            "recommended_funds": recommended_full
+        }
+        try:
+            return advisor_service.enrich_recommendations(payload)
+        except Exception as e:
+            logger.error(f"Gemini enrichment failed after retries: {e}")
+            return None
+
+    def run_pipeline(
+        self,
+        fund_names: List[str],
+        local_details: Optional[Dict[str, Dict[str, Any]]] = None,
+        portfolio: Optional[List[Dict[str, Any]]] = None,
+    ) -> Dict[str, Any]:
         """
         Orchestrates the recommendation flow:
         1. Fetch details of user's current funds from Perplexity.
-        2. Get recommendations from Gemini (Funds names).
+        2. Get recommendations from Gemini (Funds names), from the local shortlist if available.
         3. Fetch details of recommended funds from Perplexity.
         4. Enrich and Rank with Gemini.
+
+        Held funds found in `local_details` ({scheme_name: details}, computed
+        from installment data or prefetched by the batch job) skip step 1's
+        external fetch. With the aggregated `portfolio`, step 2 offers Gemini a
+        local shortlist weighted by the amounts invested. The batch job's
+        staged mode runs the same four stage methods on separate worker pools.
         """
         timing = {}
-        start_time = datetime.now()
-        logger.info(f"Recommendation pipeline started at {start_time.isoformat()}")
+        start_time = time.perf_counter()
+        logger.info(f"Recommendation pipeline started at {datetime.now().isoformat()}")
         
+        # 1. Fetch user fund details (concurrently, continue even if one fund fails)
+        with stage("fetch_user") as t1:
+            user_fund_details = self.fetch_user_funds(fund_names, local_details)
+        timing["fetch_user_fund_seconds"] = round(t1.elapsed, 3)
+
+        # 2. Get Recommended Names
+        with stage("recommend") as t2:
+            recommended_names = self.recommend_names(user_fund_details, portfolio)
+        timing["gemini_recommend_seconds"] = round(t2.elapsed, 3)
+
+        # 3. Fetch details for recommended funds
+        with stage("fetch_recommended") as t3:
+            recommended_full = self.fetch_recommended_funds(recommended_names)
+        timing["fetch_recommended_details_seconds"] = round(t3.elapsed, 3)
+
+        # 4. Enrich and Rank
+        with stage("enrich") as t4:
+            final_result = self.enrich(user_fund_details, recommended_full)
+        timing["gemini_enrich_seconds"] = round(t4.elapsed, 3)
+
+        return self.finish_pipeline(final_result, timing, start_time)
+
+    async def run_pipeline_async(
+        self,
+        fund_names: List[str],
+        local_details: Optional[Dict[str, Dict[str, Any]]] = None,
+        portfolio: Optional[List[Dict[str, Any]]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Non-blocking variant of `run_pipeline` with the same steps and timing,
+        so many pipelines can be in flight on one event loop.
+        """
+        timing = {}
+        start_time = time.perf_counter()
+        logger.info(f"Recommendation pipeline started at {datetime.now().isoformat()}")
+
         # 1. Fetch user fund details
-        with Timer() as t1:
-            user_fund_details = []
-            for name in fund_names:
-                try:
-                    details = market_data_service.fetch_fund_details(name)
-                    if details:
-                        # Convert Pydantic model to dict for JSON serialization later
-                        user_fund_details.append(details.dict())
-                except Exception as e:
-                    logger.warning(f"Failed to fetch details for {name} after retries: {e}")
-                    # Continue pipeline even if one fund fails
+        with stage("fetch_user") as t1:
+            local, remote = self._split_local(fund_names, local_details)
+            user_fund_details = local + await self._fetch_many_async(remote, "fund")
         timing["fetch_user_fund_seconds"] = round(t1.elapsed, 3)
 
         # 2. Get Recommended Names
-        with Timer() as t2:
-            try:
-                name_response = advisor_service.recommend_fund_names(user_fund_details)
-                recommended_names = name_response.get("recommended_fund_names", [])
-            except Exception as e:
-                logger.error(f"Gemini recommendation failed after retries: {e}")
-                recommended_names = []
-                # You might want to raise an ExternalServiceError here if this is critical
+        with stage("recommend") as t2:
+            recommended_names = await self.recommend_names_async(user_fund_details, portfolio)
         timing["gemini_recommend_seconds"] = round(t2.elapsed, 3)
 
         # 3. Fetch details for recommended funds
-        with Timer() as t3:
-            recommended_full = []
-            for name in recommended_names:
-                try:
-                    details = market_data_service.fetch_fund_details(name)
-                    if details:
-                        recommended_full.append(details.dict())
-                except Exception as e:
-                     logger.warning(f"Failed to fetch details for recommended fund {name}: {e}")
+        with stage("fetch_recommended") as t3:
+            recommended_names = fund_universe.canonicalize(recommended_names)
+            recommended_full = await self._fetch_many_async(recommended_names, "recommended fund")
         timing["fetch_recommended_details_seconds"] = round(t3.elapsed, 3)
 
         # 4. Enrich and Rank
@@ -63,28 +335,52 @@ class RecommendationService:
             "recommended_funds": recommended_full
         }
 
-        with Timer() as t4:
+        with stage("enrich") as t4:
             try:
-                final_result = advisor_service.enrich_recommendations(payload)
+                final_result = await advisor_service.enrich_recommendations_async(payload)
             except Exception as e:
                 logger.error(f"Gemini enrichment failed after retries: {e}")
                 final_result = None
         timing["gemini_enrich_seconds"] = round(t4.elapsed, 3)
-        
-        
-        end_time = datetime.now()
-        total_duration = (end_time - start_time).total_seconds()
-        timing["total_seconds"] = round(total_duration, 3)
-        
-        logger.info(f"Recommendation pipeline completed at {end_time.isoformat()}")
-        logger.info(f"Pipeline Execution Timing: {timing}")
-        
-        # Sanitize result to ensure no timing metadata leaks into the DB
-        if final_result and isinstance(final_result, dict):
-            # Explicitly remove typical timing keys if they somehow appeared
-            for key in ["timestamp", "generated_at", "execution_time", "timing"]:
-                final_result.pop(key, None)
 
-        return final_result
+        return self.finish_pipeline(final_result, timing, start_time)
+
+    def pipeline_version(self) -> Dict[str, Any]:
+        """
+        Model and prompt versions a recommendation was generated with; a
+        stored recommendation is stale once these no longer match.
+        """
+        return {
+            "model": advisor_service.model,
+            "prompt_versions": prompt_registry.versions(),
+        }
+
+    def build_document(self, user_id: str, portfolio: List[Dict[str, Any]], recommendation: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "user_id": user_id,
+            "budget": portfolio_service.calculate_budget(portfolio),
+            "recommendation": recommendation,
+            "portfolio_fingerprint": portfolio_service.portfolio_fingerprint(portfolio),
+            **self.pipeline_version(),
+            "generated_at": datetime.now(timezone.utc),
+        }
+
+    def recommend_for_portfolio(
+        self, user_id: str, portfolio: List[Dict[str, Any]], local_details: Optional[Dict[str, Dict[str, Any]]] = None
+    ) -> Dict[str, Any]:
+        """
+        Run the pipeline for an aggregated portfolio and build the document stored in MongoDB.
+        """
+        fund_names = [p["scheme_name"] for p in portfolio]
+        return self.build_document(user_id, portfolio, self.run_pipeline(fund_names, local_details, portfolio))
+
+    async def recommend_for_portfolio_async(
+        self, user_id: str, portfolio: List[Dict[str, Any]], local_details: Optional[Dict[str, Dict[str, Any]]] = None
+    ) -> Dict[str, Any]:
+        """
+        Async variant of `recommend_for_portfolio`.
+        """
+        fund_names = [p["scheme_name"] for p in portfolio]
+        return self.build_document(user_id, portfolio, await self.run_pipeline_async(fund_names, local_details, portfolio))
 
 recommendation_service = RecommendationService()
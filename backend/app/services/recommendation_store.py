@@ -0,0 +1,111 @@
+import asyncio
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+from app.core.config import settings
+from app.db.mongo import mongo_db
+from app.utils.cache import LRUTTLCache
+from app.utils.common import fingerprint
+from app.utils.metrics import register_cache
+
+logger = logging.getLogger(__name__)
+
+
+class RecommendationStore:
+    """
+    Read path for stored recommendations: non-blocking MongoDB reads behind
+    a small LRU+TTL cache of recently read documents, each with an ETag.
+
+    On-demand jobs in this process call `invalidate`. Writes from other
+    processes (the batch job) are picked up when the TTL expires, or
+    immediately when the change-stream watcher is enabled
+    (RECOMMENDATION_CACHE_WATCH, requires a replica set).
+    """
+
+    def __init__(self):
+        self.cache = LRUTTLCache(
+            maxsize=settings.RECOMMENDATION_CACHE_MAX_ENTRIES,
+            ttl_seconds=settings.RECOMMENDATION_CACHE_TTL_SECONDS,
+        )
+        register_cache("recommendation_reads", self.cache.stats)
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        # Bumped on every invalidation so a read that started earlier is not cached
+        self._generation = 0
+        self._watcher: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def etag(document: Dict[str, Any]) -> str:
+        return f'"{fingerprint(document)[:32]}"'
+
+    async def _find(self, user_id: str) -> Optional[Dict[str, Any]]:
+        query, projection = {"user_id": user_id}, {"_id": 0}
+        if mongo_db.async_collection is not None:
+            return await mongo_db.async_collection.find_one(query, projection)
+        return await asyncio.to_thread(mongo_db.collection.find_one, query, projection)
+
+    async def get(self, user_id: str) -> Optional[Tuple[Dict[str, Any], str]]:
+        """
+        Return (document, etag) for a user, or None if there is no recommendation.
+        Concurrent misses for the same user share one query.
+        """
+        cached = self.cache.get(user_id)
+        if cached is not None:
+            return cached
+
+        future = self._in_flight.get(user_id)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[user_id] = future
+        generation = self._generation
+        try:
+            document = await self._find(user_id)
+            entry = (document, self.etag(document)) if document else None
+            if entry and generation == self._generation:
+                self.cache.set(user_id, entry)
+            future.set_result(entry)
+            return entry
+        except BaseException as e:
+            future.set_exception(e)
+            # Waiters re-raise it; mark retrieved so an unawaited future doesn't warn
+            future.exception()
+            raise
+        finally:
+            self._in_flight.pop(user_id, None)
+
+    def invalidate(self, user_id: str) -> None:
+        self._generation += 1
+        self.cache.delete(user_id)
+
+    async def _watch(self) -> None:
+        pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}}]
+        while True:
+            try:
+                async with await mongo_db.async_collection.watch(pipeline, full_document="updateLookup") as stream:
+                    async for change in stream:
+                        user_id = (change.get("fullDocument") or {}).get("user_id")
+                        if user_id is not None:
+                            self.invalidate(user_id)
+                        else:
+                            # Deletes carry only the _id, so drop everything
+                            self._generation += 1
+                            self.cache.clear()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Recommendation change stream interrupted, retrying in 5s: {e}")
+                await asyncio.sleep(5)
+
+    def start_watching(self) -> None:
+        if settings.RECOMMENDATION_CACHE_WATCH and self._watcher is None and mongo_db.async_collection is not None:
+            self._watcher = asyncio.create_task(self._watch())
+            logger.info("Watching user_recommendations for changes to invalidate the read cache.")
+
+    async def stop_watching(self) -> None:
+        if self._watcher is not None:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
+            self._watcher = None
+
+recommendation_store = RecommendationStore()
@@ -0,0 +1,289 @@
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.db.bulk_writer import BulkUpsertWriter
+from app.services.batch import BatchProcessor, BatchProgress
+from app.services.recommendation import recommendation_service
+from app.utils.metrics import stage
+from app.utils.timer import Timer
+
+logger = logging.getLogger(__name__)
+
+# Tells a stage worker that no more users will arrive
+_DONE = object()
+
+
+class UserWork:
+    """One user travelling through the stages, collecting each stage's output."""
+    __slots__ = ("user_id", "portfolio", "local_details", "started", "busy_seconds", "timing",
+                 "user_fund_details", "recommended_names", "recommended_full", "result")
+
+    def __init__(self, user_id: str, portfolio: List[dict], local_details: Dict[str, dict]):
+        self.user_id = user_id
+        self.portfolio = portfolio
+        self.local_details = local_details
+        self.started = time.perf_counter()
+        # Time spent in stage handlers; the rest since `started` is queue wait
+        self.busy_seconds = 0.0
+        self.timing: Dict[str, float] = {}
+        self.user_fund_details: List[dict] = []
+        self.recommended_names: List[str] = []
+        self.recommended_full: List[dict] = []
+        self.result: Optional[dict] = None
+
+
+class PipelineStage:
+    """
+    A bounded input queue drained by `workers` threads that apply `handler`
+    to each user and pass it on to `downstream`. A full downstream queue
+    blocks the workers, so backpressure travels up to the portfolio loader.
+
+    Tracks busy time (for utilisation) and queue depth, sampled at each put.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        workers: int,
+        handler: Callable[[UserWork], None],
+        on_error: Callable[[UserWork, Exception], None],
+        queue_size: int,
+        timing_key: Optional[str] = None,
+    ):
+        self.name = name
+        self.workers = max(workers, 1)
+        self.handler = handler
+        self.on_error = on_error
+        self.timing_key = timing_key
+        self.queue: "queue.Queue" = queue.Queue(maxsize=max(queue_size, 1))
+        self.downstream: Optional["PipelineStage"] = None
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._running = 0
+        self.processed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self.max_depth = 0
+        self._depth_total = 0
+        self._depth_samples = 0
+
+    def start(self) -> None:
+        self._running = self.workers
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"stage-{self.name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def put(self, item: UserWork) -> None:
+        depth = self.queue.qsize()
+        with self._lock:
+            self.max_depth = max(self.max_depth, depth)
+            self._depth_total += depth
+            self._depth_samples += 1
+        self.queue.put(item)
+
+    def close(self) -> None:
+        """No more input: workers exit once the queue is drained."""
+        for _ in range(self.workers):
+            self.queue.put(_DONE)
+
+    def join(self) -> None:
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is _DONE:
+                break
+            self._handle(item)
+
+        with self._lock:
+            self._running -= 1
+            last = self._running == 0
+        # The last worker out closes the next stage, after everything was handed on
+        if last and self.downstream is not None:
+            self.downstream.close()
+
+    def _handle(self, item: UserWork) -> None:
+        timer = Timer()
+        try:
+            if self.timing_key:
+                # Pipeline stages land in the same stage metrics as run_pipeline
+                with stage(self.name) as timer:
+                    self.handler(item)
+                item.timing[self.timing_key] = round(timer.elapsed, 3)
+            else:
+                with timer:
+                    self.handler(item)
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+                self.busy_seconds += timer.elapsed
+            self.on_error(item, e)
+            return
+
+        item.busy_seconds += timer.elapsed
+        with self._lock:
+            self.processed += 1
+            self.busy_seconds += timer.elapsed
+        if self.downstream is not None:
+            self.downstream.put(item)
+
+    def stats(self, elapsed: float) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "processed": self.processed,
+                "failed": self.failed,
+                "queue_depth": self.queue.qsize(),
+                "max_queue_depth": self.max_depth,
+                "avg_queue_depth": round(self._depth_total / self._depth_samples, 1) if self._depth_samples else 0.0,
+                "utilisation": round(self.busy_seconds / (self.workers * elapsed), 3) if elapsed > 0 else 0.0,
+            }
+
+
+def parse_stage_workers(value: str) -> Dict[str, int]:
+    """Parse "recommend=8,enrich=8" into {stage: workers}."""
+    result = {}
+    for part in filter(None, (p.strip() for p in value.split(","))):
+        name, _, count = part.partition("=")
+        if name not in StagedBatchProcessor.STAGE_WORKER_SETTINGS or not count.isdigit() or int(count) < 1:
+            raise ValueError(
+                f"Invalid stage workers '{part}', expected name=N with name in {list(StagedBatchProcessor.STAGE_WORKER_SETTINGS)}"
+            )
+        result[name] = int(count)
+    return result
+
+
+class StagedBatchProcessor(BatchProcessor):
+    """
+    Batch job as a producer/consumer pipeline across users:
+
+        portfolio load -> fetch_user -> recommend -> fetch_recommended -> enrich -> write
+
+    Each stage has its own worker pool (BATCH_*_WORKERS) and a bounded input
+    queue (BATCH_STAGE_QUEUE_SIZE), so Gemini and Perplexity are both busy
+    with different users at the same time instead of waiting for each
+    other, and at most a few queues' worth of users are held in memory.
+    Per-stage queue depth and utilisation are logged with the progress and
+    returned in the summary under "stages".
+
+    `stage_workers` ({stage name: workers}) overrides the configured pool sizes.
+    """
+    STAGE_WORKER_SETTINGS = {
+        "fetch_user": "BATCH_FETCH_USER_WORKERS",
+        "recommend": "BATCH_RECOMMEND_WORKERS",
+        "fetch_recommended": "BATCH_FETCH_RECOMMENDED_WORKERS",
+        "enrich": "BATCH_ENRICH_WORKERS",
+    }
+
+    def __init__(self, *args, stage_workers: Optional[Dict[str, int]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stage_workers = {
+            name: (stage_workers or {}).get(name, getattr(settings, key))
+            for name, key in self.STAGE_WORKER_SETTINGS.items()
+        }
+
+    def _build_stages(self, writer: BulkUpsertWriter, progress: BatchProgress) -> List[PipelineStage]:
+        rs = recommendation_service
+
+        def fetch_user(item: UserWork) -> None:
+            fund_names = [p["scheme_name"] for p in item.portfolio]
+            item.user_fund_details = rs.fetch_user_funds(fund_names, item.local_details)
+
+        def recommend(item: UserWork) -> None:
+            item.recommended_names = rs.recommend_names(item.user_fund_details, item.portfolio)
+
+        def fetch_recommended(item: UserWork) -> None:
+            item.recommended_full = rs.fetch_recommended_funds(item.recommended_names)
+
+        def enrich(item: UserWork) -> None:
+            with Timer() as t:
+                result = rs.enrich(item.user_fund_details, item.recommended_full)
+            # Total is the stage time, as in the other modes; waiting in queues is reported as queue_wait
+            item.result = rs.finish_pipeline(result, item.timing, item.started, item.busy_seconds + t.elapsed)
+
+        def write(item: UserWork) -> None:
+            # Progress and checkpoint are recorded when the writer flushes
+            writer.add(rs.build_document(item.user_id, item.portfolio, item.result))
+
+        on_error = lambda item, e: self._record_failure(item.user_id, e, progress)
+        size = settings.BATCH_STAGE_QUEUE_SIZE
+        workers = self.stage_workers
+        stages = [
+            PipelineStage("fetch_user", workers["fetch_user"], fetch_user, on_error, size, "fetch_user_fund_seconds"),
+            PipelineStage("recommend", workers["recommend"], recommend, on_error, size, "gemini_recommend_seconds"),
+            PipelineStage("fetch_recommended", workers["fetch_recommended"], fetch_recommended, on_error, size,
+                          "fetch_recommended_details_seconds"),
+            PipelineStage("enrich", workers["enrich"], enrich, on_error, size, "gemini_enrich_seconds"),
+            PipelineStage("write", 1, write, on_error, size),
+        ]
+        for upstream, downstream in zip(stages, stages[1:]):
+            upstream.downstream = downstream
+        return stages
+
+    def _stage_stats(self, stages: List[PipelineStage], load: Dict[str, Any], started: float) -> Dict[str, Dict[str, Any]]:
+        elapsed = time.perf_counter() - started
+        stats = {"load": {
+            "workers": 1,
+            "processed": load["processed"],
+            "utilisation": round(load["busy_seconds"] / elapsed, 3) if elapsed > 0 else 0.0,
+        }}
+        stats.update({s.name: s.stats(elapsed) for s in stages})
+        return stats
+
+    def _report_stages(self, stages: List[PipelineStage], load: Dict[str, Any], started: float, stop: threading.Event) -> None:
+        while not stop.wait(settings.BATCH_PROGRESS_INTERVAL_SECONDS):
+            stats = self._stage_stats(stages, load, started)
+            logger.info("Stages: " + " | ".join(
+                f"{name} q={s.get('queue_depth', 0)} util={s['utilisation']:.0%}" for name, s in stats.items()
+            ))
+
+    def run(self, db: Session, user_ids: Iterable[str]) -> dict:
+        pending = self._plan(user_ids)
+        progress = BatchProgress(len(pending), settings.BATCH_PROGRESS_INTERVAL_SECONDS)
+        seen: Set[str] = set()
+        unchanged: List[str] = []
+        load = {"processed": 0, "busy_seconds": 0.0}
+        started = time.perf_counter()
+        stop_reporting = threading.Event()
+
+        with self._writer(progress) as writer:
+            stages = self._build_stages(writer, progress)
+            for s in stages:
+                s.start()
+            reporter = threading.Thread(
+                target=self._report_stages, args=(stages, load, started, stop_reporting), name="stage-report", daemon=True
+            )
+            reporter.start()
+
+            try:
+                work = self._iter_work(db, pending, seen, unchanged, progress)
+                while True:
+                    # Loading is the producer stage; put() blocks while fetch_user is saturated
+                    with Timer() as t:
+                        item = next(work, None)
+                    load["busy_seconds"] += t.elapsed
+                    if item is None:
+                        break
+                    load["processed"] += 1
+                    stages[0].put(UserWork(*item))
+            finally:
+                stages[0].close()
+                for s in stages:
+                    s.join()
+                stop_reporting.set()
+
+        stage_stats = self._stage_stats(stages, load, started)
+        logger.info(f"Result writer stats: {writer.stats()}")
+        logger.info(f"Stage stats: {stage_stats}")
+        summary = self._finish(pending, seen, unchanged, progress)
+        summary["stages"] = stage_stats
+        return summary
@@ -0,0 +1,362 @@
+import asyncio
+import threading
+import time
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from app.utils.metrics import register_cache
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class LRUTTLCache:
+    """
+    Thread-safe, size-bounded in-memory cache with per-entry TTL.
+    The least recently used entry is evicted once `maxsize` is reached.
+    """
+
+    def __init__(self, maxsize: int, ttl_seconds: float):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key: str, default: Any = None) -> Any:
+        """Like `get`, but without touching LRU order or hit/miss counters."""
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING or entry[1] <= time.monotonic():
+                return default
+            return entry[0]
+
+    def set(self, key: str, value: Any, ttl_seconds: Optional[float] = None) -> None:
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class TieredCache:
+    """
+    Two-tier cache: a bounded in-memory LRU in front of an optional
+    persistent MongoDB collection, so a restart does not lose warm entries.
+
+    `collection_getter` is called lazily and may return None (e.g. Mongo not
+    connected), in which case only the memory tier is used.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        maxsize: int,
+        ttl_seconds: float,
+        collection_getter: Optional[Callable[[], Any]] = None,
+    ):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.memory = LRUTTLCache(maxsize=maxsize, ttl_seconds=ttl_seconds)
+        self._collection_getter = collection_getter
+        self._indexed = False
+        self._key_locks: Dict[str, threading.Lock] = {}
+        self._key_locks_guard = threading.Lock()
+        self._inflight: Dict[str, "asyncio.Future"] = {}
+        self.persistent_hits = 0
+        self.persistent_errors = 0
+        self.coalesced = 0
+        register_cache(name, self.stats)
+
+    def _collection(self):
+        if self._collection_getter is None:
+            return None
+        collection = self._collection_getter()
+        if collection is not None and not self._indexed:
+            try:
+                # Let MongoDB purge expired entries on its own
+                collection.create_index("expires_at", expireAfterSeconds=0)
+            except Exception as e:
+                logger.warning(f"Could not create TTL index for cache '{self.name}': {e}")
+            self._indexed = True
+        return collection
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self.memory.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        collection = self._collection()
+        if collection is None:
+            return None
+
+        try:
+            doc = collection.find_one(
+                {"_id": key, "expires_at": {"$gt": datetime.now(timezone.utc)}}
+            )
+        except Exception as e:
+            self.persistent_errors += 1
+            logger.warning(f"Cache '{self.name}' persistent read failed for {key}: {e}")
+            return None
+
+        if not doc:
+            return None
+
+        self.persistent_hits += 1
+        remaining = (doc["expires_at"].replace(tzinfo=timezone.utc) - datetime.now(timezone.utc)).total_seconds()
+        self.memory.set(key, doc["value"], ttl_seconds=max(remaining, 0))
+        return doc["value"]
+
+    def set(self, key: str, value: Any) -> None:
+        self.memory.set(key, value)
+
+        collection = self._collection()
+        if collection is None:
+            return
+
+        try:
+            collection.update_one(
+                {"_id": key},
+                {"$set": {
+                    "value": value,
+                    "expires_at": datetime.now(timezone.utc) + timedelta(seconds=self.ttl_seconds),
+                }},
+                upsert=True,
+            )
+        except Exception as e:
+            self.persistent_errors += 1
+            logger.warning(f"Cache '{self.name}' persistent write failed for {key}: {e}")
+
+    def get_or_load(self, key: str, loader: Callable[[], Any]) -> Optional[Any]:
+        """
+        Return the cached value for `key`, calling `loader` on a miss.
+        Concurrent misses on the same key share a single load; `None`
+        results are not cached.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self._key_locks_guard:
+            lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with lock:
+            try:
+                # Another thread may have loaded it while we waited
+                value = self.memory.peek(key)
+                if value is not None:
+                    self.coalesced += 1
+                    return value
+
+                value = loader()
+                if value is not None:
+                    self.set(key, value)
+                return value
+            finally:
+                with self._key_locks_guard:
+                    self._key_locks.pop(key, None)
+
+    def get_or_load_many(self, keys: List[str], loader: Callable[[List[str]], Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Multi-key `get_or_load`: the misses this caller claims are loaded with
+        one `loader(keys)` call, misses another caller is already loading are
+        waited for instead. `loader` returns {key: value}; keys it leaves out
+        (and keys another caller failed to load) are left out of the result,
+        so the caller can retry them. `None` results are not cached.
+        """
+        results: Dict[str, Any] = {}
+        owned: Dict[str, threading.Lock] = {}
+        waiting: Dict[str, threading.Lock] = {}
+        for key in dict.fromkeys(keys):
+            value = self.get(key)
+            if value is not None:
+                results[key] = value
+                continue
+            with self._key_locks_guard:
+                lock = self._key_locks.setdefault(key, threading.Lock())
+            # Non-blocking, so we never wait on a key while holding others
+            (owned if lock.acquire(blocking=False) else waiting)[key] = lock
+
+        try:
+            claimed = []
+            for key in owned:
+                # Another caller may have loaded it just before we claimed it
+                value = self.memory.peek(key)
+                if value is not None:
+                    self.coalesced += 1
+                    results[key] = value
+                else:
+                    claimed.append(key)
+            if claimed:
+                loaded = loader(claimed)
+                for key in claimed:
+                    if key in loaded:
+                        results[key] = loaded[key]
+                        if loaded[key] is not None:
+                            self.set(key, loaded[key])
+        finally:
+            with self._key_locks_guard:
+                for key, lock in owned.items():
+                    if self._key_locks.get(key) is lock:
+                        del self._key_locks[key]
+            for lock in owned.values():
+                lock.release()
+
+        for key, lock in waiting.items():
+            with lock:
+                value = self.memory.peek(key)
+            if value is not None:
+                self.coalesced += 1
+                results[key] = value
+        return results
+
+    async def aget_or_load(self, key: str, loader: Callable[[], Awaitable[Any]]) -> Optional[Any]:
+        """
+        Async counterpart of `get_or_load`: concurrent misses on the same key
+        await a single `loader()` call. Blocking Mongo I/O runs in a worker thread.
+        """
+        persistent = self._collection_getter is not None
+        value = await asyncio.to_thread(self.get, key) if persistent else self.get(key)
+        if value is not None:
+            return value
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._aload(key, loader, persistent))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+
+        # Shield so one cancelled caller does not cancel the shared load
+        value = await asyncio.shield(task)
+        if value is _MISSING:
+            # A batch load left this key out; load it ourselves
+            if self._inflight.get(key) is task:
+                del self._inflight[key]
+            return await self.aget_or_load(key, loader)
+        return value
+
+    async def _aload(self, key: str, loader: Callable[[], Awaitable[Any]], persistent: bool) -> Optional[Any]:
+        value = await loader()
+        if value is not None:
+            if persistent:
+                await asyncio.to_thread(self.set, key, value)
+            else:
+                self.set(key, value)
+        return value
+
+    async def aget_or_load_many(
+        self, keys: List[str], loader: Callable[[List[str]], Awaitable[Dict[str, Any]]]
+    ) -> Dict[str, Any]:
+        """
+        Async counterpart of `get_or_load_many`. Claimed keys are registered
+        as in-flight loads, so concurrent `aget_or_load` and
+        `aget_or_load_many` callers await this caller's batch.
+        """
+        persistent = self._collection_getter is not None
+        results: Dict[str, Any] = {}
+        misses = []
+        for key in dict.fromkeys(keys):
+            value = await asyncio.to_thread(self.get, key) if persistent else self.get(key)
+            if value is not None:
+                results[key] = value
+            else:
+                misses.append(key)
+
+        # No awaits from here until the claimed keys are registered
+        waiting = {key: self._inflight[key] for key in misses if key in self._inflight}
+        self.coalesced += len(waiting)
+        loop = asyncio.get_running_loop()
+        futures = {key: loop.create_future() for key in misses if key not in waiting}
+        for key, future in futures.items():
+            self._inflight[key] = future
+            future.add_done_callback(lambda _, key=key: self._inflight.pop(key, None))
+
+        if futures:
+            load = asyncio.ensure_future(self._aload_many(futures, loader, persistent))
+            await asyncio.shield(load)
+        values = await asyncio.gather(*(asyncio.shield(t) for t in waiting.values()), return_exceptions=True)
+        done = [*((key, f.result()) for key, f in futures.items()), *zip(waiting, values)]
+        for key, value in done:
+            if value is not _MISSING and not isinstance(value, BaseException):
+                results[key] = value
+        return results
+
+    async def _aload_many(
+        self,
+        futures: Dict[str, "asyncio.Future"],
+        loader: Callable[[List[str]], Awaitable[Dict[str, Any]]],
+        persistent: bool,
+    ) -> None:
+        try:
+            loaded = await loader(list(futures))
+            for key, value in loaded.items():
+                if key not in futures:
+                    continue
+                if value is not None:
+                    if persistent:
+                        await asyncio.to_thread(self.set, key, value)
+                    else:
+                        self.set(key, value)
+                futures[key].set_result(value)
+        finally:
+            # Keys left out (or a failed load) tell waiters to load them themselves
+            for future in futures.values():
+                if not future.done():
+                    future.set_result(_MISSING)
+
+    def stats(self) -> Dict[str, int]:
+        stats = self.memory.stats()
+        stats["persistent_hits"] = self.persistent_hits
+        stats["persistent_errors"] = self.persistent_errors
+        stats["coalesced"] = self.coalesced
+        # Every hit on either tier (or shared in-flight load) is an external call we did not pay for
+        stats["saved_calls"] = stats["hits"] + self.persistent_hits + self.coalesced
+        return stats
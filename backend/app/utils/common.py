@@ -1,38 +1,143 @@
 import re
 import json
-from typing import Optional, Dict, Any
+import hashlib
+import logging
+import unicodedata
+from typing import Optional, Dict, Any, Tuple
 
-def extract_json(text: str) -> Optional[Dict[str, Any]]:
+logger = logging.getLogger(__name__)
+
+# Perplexity-style citation markers like [1], [23]
+CITATION_PATTERN = re.compile(r"\[\d+\]")
+_OPENING = re.compile(r"[\[{]")
+# String literals (or an unterminated quote) and brackets, for finding where a value closes
+_STRUCTURE = re.compile(r'"(?:\\.|[^"\\])*"|"|[\[\]{}]')
+_decoder = json.JSONDecoder()
+
+def _decode_at(text: str, start: int) -> Tuple[Any, int, bool]:
     """
-    Robust JSON extractor from LLM text responses.
+    Decode the balanced JSON value starting at `start`, ignoring whatever
+    follows it. Where the parser trips over a citation marker (which can
+    only happen outside string literals) the marker is cut out and decoding
+    resumes. Returns (value, end index in the cleaned text, citations removed).
+    """
+    removed = False
+    while True:
+        try:
+            data, end = _decoder.raw_decode(text, start)
+            return data, end, removed
+        except json.JSONDecodeError as e:
+            citation = CITATION_PATTERN.match(text, e.pos)
+            if not citation:
+                raise
+            text = text[:e.pos] + text[citation.end():]
+            removed = True
+
+def _closing_end(text: str, start: int) -> int:
+    """
+    Index just past the bracket that closes the one at `start`, ignoring
+    brackets inside string literals; -1 if it never closes.
+    """
+    depth = 0
+    for token in _STRUCTURE.finditer(text, start):
+        char = token.group()
+        if char == '"':
+            return -1  # Unterminated string
+        if char in ("[", "{"):
+            depth += 1
+        elif char in ("]", "}"):
+            depth -= 1
+            if depth == 0:
+                return token.end()
+    return -1
+
+def extract_json_with_path(text: str) -> Tuple[Optional[Any], str]:
+    """
+    Robust JSON extractor from LLM text responses, also reporting how the
+    JSON was found:
+
+    - "direct": the whole response is JSON
+    - "embedded": first balanced object inside fences or prose, or the first
+      array when the text holds no object outside it
+    - "embedded_citations": as above, after dropping citations between values
+    - "truncated": the payload never closes (e.g. the response hit its token
+      limit); values nested inside it are fragments, so nothing is returned
+    - "empty" / "not_found": nothing parseable
+
+    An array in the prose (e.g. a list of picks before the full answer) does
+    not hide a later object; callers expect the object. Citations inside
+    string literals (fund names, URLs) are left untouched.
     """
     if not text:
-        return None
-        
-    # Remove markdown fences
-    text = text.replace("```json", "").replace("```", "").strip()
-
-    # Remove citations like [1], [23]
-    text = re.sub(r"\[\d+\]", "", text)
-
-    try:
-        return json.loads(text)
-    except json.JSONDecodeError:
-        pass
-
-    # Try to find JSON object with regex
-    match = re.search(r"\{(?:.|\n)*\}", text)
-    if match:
-        candidate = re.sub(r"\[\d+\]", "", match.group())
+        return None, "empty"
+
+    array: Optional[Tuple[Any, str]] = None
+    pos = 0
+    while True:
+        match = _OPENING.search(text, pos)
+        if not match:
+            return array or (None, "not_found")
+        start = match.start()
+
+        # A citation in the surrounding prose is not the start of the payload
+        citation = CITATION_PATTERN.match(text, start)
+        if citation:
+            pos = citation.end()
+            continue
+
         try:
-            return json.loads(candidate)
-        except json.JSONDecodeError:
-            return None
+            data, end, cleaned = _decode_at(text, start)
+        except ValueError:
+            if _closing_end(text, start) < 0:
+                return None, "truncated"
+            # Balanced but not JSON, e.g. "[see below]" in prose
+            pos = start + 1
+            continue
 
-    return None
+        if cleaned:
+            path = "embedded_citations"
+        elif not text[:start].strip() and not text[end:].strip():
+            path = "direct"
+        else:
+            path = "embedded"
+        if isinstance(data, dict):
+            return data, path
+
+        # Keep the first array, unless an object follows it
+        array = array or (data, path)
+        pos = _closing_end(text, start)
+        if pos < 0:
+            return array
+
+def extract_json(text: str) -> Optional[Dict[str, Any]]:
+    """
+    Robust JSON extractor from LLM text responses.
+    """
+    data, path = extract_json_with_path(text)
+    if path != "direct":
+        logger.debug(f"extract_json used fallback path '{path}'")
+    return data
 
 def strip_citations(text: str) -> str:
     """Remove Perplexity-style citation markers like [3], [12]."""
     if not isinstance(text, str):
         return text
-    return re.sub(r"\[\d+\]", "", text).strip()
+    return CITATION_PATTERN.sub("", text).strip()
+
+def normalize_fund_name(name: str) -> str:
+    """
+    Canonical form of a fund name for use as a cache key:
+    case, punctuation and whitespace differences are ignored.
+    """
+    text = unicodedata.normalize("NFKC", name or "").lower()
+    text = text.replace("&", " and ")
+    text = re.sub(r"[^a-z0-9]+", " ", text)
+    return " ".join(text.split())
+
+def canonical_json(data: Any) -> str:
+    """Deterministic JSON encoding (sorted keys, no whitespace) for hashing."""
+    return json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+
+def fingerprint(data: Any) -> str:
+    """SHA-256 hex digest of the canonical JSON encoding of `data`."""
+    return hashlib.sha256(canonical_json(data).encode("utf-8")).hexdigest()
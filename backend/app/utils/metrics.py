@@ -0,0 +1,180 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, REGISTRY
+
+from app.core.config import settings
+from app.utils.timer import Timer
+
+try:
+    from opentelemetry import trace
+except ImportError:  # OpenTelemetry is optional; spans are skipped without it
+    trace = None
+
+logger = logging.getLogger(__name__)
+
+# Stages of one recommendation: fetch_user, recommend, fetch_recommended, enrich, total
+# (plus mongo_write for the batch result writer)
+PIPELINE_STAGE_SECONDS = Histogram(
+    "pipeline_stage_seconds",
+    "Wall time of one recommendation pipeline stage.",
+    ["stage"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120),
+)
+
+EXTERNAL_CALL_SECONDS = Histogram(
+    "external_call_seconds",
+    "Latency of a single external API call (excluding rate limiter waits).",
+    ["provider", "operation", "outcome"],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60),
+)
+
+EXTERNAL_RETRIES = Counter(
+    "external_call_retries_total",
+    "Retries scheduled by the shared tenacity policy.",
+    ["provider"],
+)
+
+LLM_TOKENS = Counter(
+    "llm_tokens_total",
+    "Tokens reported by the provider's usage metadata.",
+    ["provider", "operation", "kind"],
+)
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+# Callbacks receiving every raw timing as (series, seconds), e.g. ("stage:enrich", 1.2)
+# or ("call:gemini.recommend", 0.8); histograms alone cannot give exact percentiles
+_timing_listeners: List[Callable[[str, float], None]] = []
+
+_tracer = trace.get_tracer("app.pipeline") if trace is not None and settings.OTEL_TRACING_ENABLED else None
+
+
+def add_timing_listener(listener: Callable[[str, float], None]) -> None:
+    """Receive every stage and external call timing (used by the benchmarks)."""
+    _timing_listeners.append(listener)
+
+
+def remove_timing_listener(listener: Callable[[str, float], None]) -> None:
+    if listener in _timing_listeners:
+        _timing_listeners.remove(listener)
+
+
+def _notify(series: str, seconds: float) -> None:
+    for listener in list(_timing_listeners):
+        listener(series, seconds)
+
+
+def observe_stage(name: str, seconds: float) -> None:
+    PIPELINE_STAGE_SECONDS.labels(stage=name).observe(seconds)
+    _notify(f"stage:{name}", seconds)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[Timer]:
+    """
+    Time one pipeline stage on a monotonic clock, record it in the stage
+    histogram and, when enabled, as an OpenTelemetry span. Yields the Timer
+    so callers can still report `elapsed` themselves.
+    """
+    timer = Timer()
+    try:
+        if _tracer is None:
+            with timer:
+                yield timer
+        else:
+            with _tracer.start_as_current_span(f"pipeline.{name}"), timer:
+                yield timer
+    finally:
+        observe_stage(name, timer.elapsed)
+
+
+@contextmanager
+def external_call(provider: str, operation: str) -> Iterator[None]:
+    """Record the latency and outcome (ok/error) of one external API call."""
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        seconds = time.perf_counter() - start
+        EXTERNAL_CALL_SECONDS.labels(provider=provider, operation=operation, outcome=outcome).observe(seconds)
+        _notify(f"call:{provider}.{operation}", seconds)
+
+
+def record_tokens(provider: str, operation: str, prompt_tokens: Optional[int], completion_tokens: Optional[int]) -> None:
+    if prompt_tokens:
+        LLM_TOKENS.labels(provider=provider, operation=operation, kind="prompt").inc(prompt_tokens)
+    if completion_tokens:
+        LLM_TOKENS.labels(provider=provider, operation=operation, kind="completion").inc(completion_tokens)
+
+
+class _CacheCollector:
+    """
+    Reads cache counters at scrape time, so caches keep their plain integer
+    counters and pay nothing per lookup.
+    """
+
+    def __init__(self):
+        self._caches: Dict[str, Callable[[], Dict[str, int]]] = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, stats: Callable[[], Dict[str, int]]) -> None:
+        with self._lock:
+            self._caches[name] = stats
+
+    def collect(self):
+        hits = CounterMetricFamily("cache_hits", "Lookups answered without calling the loader.", labels=["cache"])
+        misses = CounterMetricFamily("cache_misses", "Lookups that missed the in-memory tier.", labels=["cache"])
+        entries = GaugeMetricFamily("cache_entries", "Entries held in memory.", labels=["cache"])
+        ratio = GaugeMetricFamily("cache_hit_ratio", "Share of lookups answered from cache.", labels=["cache"])
+
+        with self._lock:
+            caches = list(self._caches.items())
+        for name, stats_fn in caches:
+            try:
+                stats = stats_fn()
+            except Exception as e:
+                logger.warning(f"Cache '{name}' stats unavailable: {e}")
+                continue
+            # TieredCache counts persistent-tier hits and coalesced loads as saved calls
+            saved = stats.get("saved_calls", stats.get("hits", 0))
+            lookups = stats.get("hits", 0) + stats.get("misses", 0)
+            hits.add_metric([name], saved)
+            misses.add_metric([name], stats.get("misses", 0))
+            entries.add_metric([name], stats.get("size", 0))
+            ratio.add_metric([name], saved / lookups if lookups else 0.0)
+        yield from (hits, misses, entries, ratio)
+
+
+_cache_collector = _CacheCollector()
+REGISTRY.register(_cache_collector)
+
+
+def register_cache(name: str, stats: Callable[[], Dict[str, int]]) -> None:
+    """Export a cache's `stats()` (hits, misses, size) on /metrics."""
+    _cache_collector.register(name, stats)
+
+
+def stage_summary() -> Dict[str, Dict[str, float]]:
+    """Count and mean seconds per pipeline stage, for logging where nothing scrapes /metrics (batch runs)."""
+    totals: Dict[str, Dict[str, float]] = {}
+    for metric in PIPELINE_STAGE_SECONDS.collect():
+        for sample in metric.samples:
+            if sample.name.endswith(("_count", "_sum")):
+                field = "count" if sample.name.endswith("_count") else "seconds"
+                totals.setdefault(sample.labels["stage"], {})[field] = sample.value
+    return {
+        name: {"count": int(t.get("count", 0)), "avg_seconds": round(t.get("seconds", 0.0) / (t.get("count") or 1), 3)}
+        for name, t in totals.items()
+    }
+
+
+def render_latest() -> bytes:
+    """Prometheus text exposition of every registered metric."""
+    return generate_latest(REGISTRY)
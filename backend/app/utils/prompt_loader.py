@@ -1,7 +1,12 @@
 import os
+import hashlib
 import logging
+import threading
+import time
 from string import Template
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Set
+
+from app.core.config import settings
 
 logger = logging.getLogger(__name__)
 
@@ -10,9 +15,160 @@ logger = logging.getLogger(__name__)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 PROMPTS_DIR = os.path.join(BASE_DIR, "prompts")
 
+# Variables each prompt is rendered with; templates are validated against these at load time
+PROMPT_VARIABLES: Dict[str, Set[str]] = {
+    "fund_recommendation.txt": {"user_fund_details_json"},
+    "fund_recommendation_shortlist.txt": {"user_fund_details_json", "candidates_json"},
+    "fund_enrichment.txt": {"payload_json"},
+    "market_data_fetch.txt": {"fund_name"},
+    "market_data_fetch_batch.txt": {"fund_names_json"},
+}
+
+
+class PromptTemplate:
+    """
+    A compiled prompt file with its placeholders and content version.
+    """
+
+    def __init__(self, filename: str, content: str, mtime: float):
+        self.filename = filename
+        self.template = Template(content)
+        self.mtime = mtime
+        self.version = hashlib.sha256(content.encode("utf-8")).hexdigest()[:12]
+
+        if not self.template.is_valid():
+            raise ValueError(f"Prompt '{filename}' contains an invalid placeholder (use $$ for a literal $)")
+        self.placeholders = set(self.template.get_identifiers())
+
+    def validate(self, expected: Set[str]) -> None:
+        missing = expected - self.placeholders
+        unknown = self.placeholders - expected
+        if missing or unknown:
+            raise ValueError(
+                f"Prompt '{self.filename}' placeholders do not match: "
+                f"missing {sorted(missing)}, unexpected {sorted(unknown)}"
+            )
+
+    def render(self, **kwargs) -> str:
+        # strict substitute (not safe_substitute) so a missing variable fails loudly
+        return self.template.substitute(**kwargs)
+
+
+class PromptRegistry:
+    """
+    Loads every prompt in `prompts_dir` once and serves compiled templates.
+    With `hot_reload`, a prompt whose file changed on disk is recompiled on
+    next use (files are stat'ed at most every `check_interval` seconds).
+    """
+
+    def __init__(
+        self,
+        prompts_dir: str = PROMPTS_DIR,
+        expected_variables: Optional[Dict[str, Set[str]]] = None,
+        hot_reload: bool = False,
+        check_interval: float = 1.0,
+    ):
+        self.prompts_dir = prompts_dir
+        self.expected_variables = expected_variables or {}
+        self.hot_reload = hot_reload
+        self.check_interval = check_interval
+        self._templates: Dict[str, PromptTemplate] = {}
+        self._last_checked: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _compile(self, filename: str) -> PromptTemplate:
+        file_path = os.path.join(self.prompts_dir, filename)
+        if not os.path.exists(file_path):
+            error_msg = f"Prompt file not found: {file_path}"
+            logger.error(error_msg)
+            raise FileNotFoundError(error_msg)
+
+        mtime = os.path.getmtime(file_path)
+        with open(file_path, "r", encoding="utf-8") as f:
+            prompt = PromptTemplate(filename, f.read(), mtime)
+
+        if filename in self.expected_variables:
+            prompt.validate(self.expected_variables[filename])
+        return prompt
+
+    def load_all(self) -> Dict[str, str]:
+        """
+        Compile and validate every prompt file, failing fast on the first bad
+        template. Returns the version of each prompt.
+        """
+        filenames = sorted(f for f in os.listdir(self.prompts_dir) if f.endswith(".txt"))
+        missing = set(self.expected_variables) - set(filenames)
+        if missing:
+            raise FileNotFoundError(f"Prompt files not found in {self.prompts_dir}: {sorted(missing)}")
+
+        templates = {filename: self._compile(filename) for filename in filenames}
+        now = time.monotonic()
+        with self._lock:
+            self._templates.update(templates)
+            self._last_checked.update({filename: now for filename in templates})
+
+        versions = self.versions()
+        logger.info(f"Loaded {len(templates)} prompts: {versions}")
+        return versions
+
+    def _is_stale(self, prompt: PromptTemplate) -> bool:
+        now = time.monotonic()
+        if now - self._last_checked.get(prompt.filename, 0.0) < self.check_interval:
+            return False
+        self._last_checked[prompt.filename] = now
+        try:
+            return os.path.getmtime(os.path.join(self.prompts_dir, prompt.filename)) != prompt.mtime
+        except OSError:
+            # Keep serving the compiled version if the file is briefly missing mid-edit
+            return False
+
+    def get(self, filename: str) -> PromptTemplate:
+        prompt = self._templates.get(filename)
+        if prompt is not None and not (self.hot_reload and self._is_stale(prompt)):
+            return prompt
+
+        with self._lock:
+            current = self._templates.get(filename)
+            if current is not None and current is not prompt:
+                return current  # Another thread already (re)loaded it
+            try:
+                reloaded = self._compile(filename)
+            except (OSError, ValueError) as e:
+                if prompt is None:
+                    raise
+                logger.error(f"Reloading prompt '{filename}' failed, keeping version {prompt.version}: {e}")
+                return prompt
+            if prompt is not None:
+                logger.info(f"Prompt '{filename}' changed on disk: {prompt.version} -> {reloaded.version}")
+            self._templates[filename] = reloaded
+            self._last_checked[filename] = time.monotonic()
+            return reloaded
+
+    def render(self, filename: str, **kwargs) -> str:
+        try:
+            return self.get(filename).render(**kwargs)
+        except KeyError as e:
+            logger.error(f"Missing variable for prompt template '{filename}': {e}")
+            raise
+        except Exception as e:
+            logger.error(f"Error loading prompt '{filename}': {e}")
+            raise
+
+    def version(self, filename: str) -> str:
+        return self.get(filename).version
+
+    def versions(self) -> Dict[str, str]:
+        return {filename: prompt.version for filename, prompt in sorted(self._templates.items())}
+
+
+prompt_registry = PromptRegistry(
+    expected_variables=PROMPT_VARIABLES,
+    hot_reload=settings.PROMPT_HOT_RELOAD,
+)
+
 def load_prompt(filename: str, **kwargs) -> str:
     """
-    Loads a prompt template from a file and substitutes variables using string.Template.
+    Renders a prompt template from the registry, substituting variables using string.Template.
     
     Args:
         filename (str): The name of the prompt file (e.g., 'fund_recommendation.txt').
@@ -25,25 +181,11 @@ def load_prompt(filename: str, **kwargs) -> str:
         FileNotFoundError: If the prompt file is not found.
         KeyError: If a required placeholder is missing in kwargs.
     """
-    file_path = os.path.join(PROMPTS_DIR, filename)
-    
-    if not os.path.exists(file_path):
-        error_msg = f"Prompt file not found: {file_path}"
-        logger.error(error_msg)
-        raise FileNotFoundError(error_msg)
-        
-    try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            content = f.read()
-            
-        template = Template(content)
-        # safe_substitute could be used if we want to ignore missing keys, 
-        # but strict substitute is better for ensuring prompt correctness.
-        return template.substitute(**kwargs)
-        
-    except KeyError as e:
-        logger.error(f"Missing variable for prompt template '{filename}': {e}")
-        raise
-    except Exception as e:
-        logger.error(f"Error loading prompt '{filename}': {e}")
-        raise
+    return prompt_registry.render(filename, **kwargs)
+
+def prompt_version(filename: str) -> str:
+    """
+    Short content hash of a prompt template, so anything derived from a
+    prompt (e.g. cached LLM responses) can be tied to its exact wording.
+    """
+    return prompt_registry.version(filename)
@@ -0,0 +1,329 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from app.core.config import settings
+from app.core.exceptions import RateLimitExceededError
+from app.utils.retry import is_throttling_error
+
+logger = logging.getLogger(__name__)
+
+# MongoDB collection holding the shared per-second call counters
+RATE_LIMIT_COLLECTION = "rate_limits"
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Callers reserve a token and are told how long
+    to wait for it, so the same bucket serves sync and async callers.
+    """
+
+    def __init__(self, rate_per_second: float, burst: int):
+        self.rate = rate_per_second
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait: float) -> Optional[float]:
+        """
+        Take one token, returning the seconds to wait before using it,
+        or None (nothing taken) if that wait would exceed `max_wait`.
+        """
+        if self.rate <= 0:
+            return 0.0
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            wait = 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+            if wait > max_wait:
+                return None
+            # Tokens may go negative: later callers queue up behind this reservation
+            self._tokens -= 1
+            return wait
+
+    def refund(self) -> None:
+        """Give back a token taken by a call that was rejected afterwards."""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + 1)
+
+
+class SharedWindowLimiter:
+    """
+    Cross-process limit using fixed one-second windows counted in MongoDB,
+    so several batch workers/machines share one provider quota.
+    """
+
+    def __init__(self, provider: str, rate_per_second: float, collection_getter: Callable[[], Any]):
+        self.provider = provider
+        self.limit = max(int(rate_per_second), 1)
+        self._collection_getter = collection_getter
+        self._indexed = False
+
+    def _collection(self):
+        collection = self._collection_getter()
+        if collection is not None and not self._indexed:
+            collection.create_index("expires_at", expireAfterSeconds=0)
+            self._indexed = True
+        return collection
+
+    def reserve(self, max_wait: float) -> Optional[float]:
+        """
+        Claim a slot in the current or a following window. Returns the seconds
+        to wait until that window opens, or None if it is further than `max_wait`.
+        Full windows are never incremented, so rejected calls use up no quota.
+        """
+        collection = self._collection()
+        if collection is None:
+            return 0.0
+
+        now = time.time()
+        window = int(now)
+        while window - now <= max_wait:
+            try:
+                # Only matches a window with room left; a full one makes the upsert collide on _id
+                doc = collection.find_one_and_update(
+                    {"_id": f"{self.provider}:{window}", "count": {"$lt": self.limit}},
+                    {
+                        "$inc": {"count": 1},
+                        "$setOnInsert": {"expires_at": datetime.now(timezone.utc) + timedelta(minutes=5)},
+                    },
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER,
+                )
+            except DuplicateKeyError:
+                doc = None
+            if doc is not None:
+                return max(window - now, 0.0)
+            window += 1
+        return None
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD concurrency limit: grows by ~1 slot per `limit` successful calls and
+    halves when the provider signals overload (429/5xx). At most one decrease
+    per second, so a burst of failures from one window counts once.
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int):
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def try_acquire(self) -> bool:
+        with self._cond:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            self.in_flight += 1
+            return True
+
+    async def acquire_async(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while not self.try_acquire():
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.05)
+        return True
+
+    def release(self, success: bool, throttled: bool = False) -> None:
+        """Free a slot; only successes grow the limit and only throttling shrinks it."""
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                if now - self._last_decrease >= 1.0:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._last_decrease = now
+            elif success:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+class ProviderLimiter:
+    """
+    Everything that gates calls to one external provider: a local token
+    bucket, an optional shared (cross-process) window limit and an adaptive
+    concurrency limit. Calls that cannot start within `max_wait` seconds are
+    rejected with RateLimitExceededError.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate_per_second: float,
+        burst: int,
+        min_concurrency: int,
+        max_concurrency: int,
+        max_wait: float,
+        shared: Optional[SharedWindowLimiter] = None,
+        initial_concurrency: Optional[int] = None,
+    ):
+        self.name = name
+        self.max_wait = max_wait
+        self.bucket = TokenBucket(rate_per_second, burst)
+        self.shared = shared
+        # Start low so the limit can grow on success; starting at the ceiling it could only shrink
+        self.concurrency = AdaptiveConcurrencyLimiter(
+            min_concurrency if initial_concurrency is None else initial_concurrency, min_concurrency, max_concurrency
+        )
+        self._recent_calls = deque()
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.throttled_waits = 0
+        self.throttled_wait_seconds = 0.0
+        self.rejected = 0
+        self.throttle_events = 0
+
+    def _reserve(self) -> float:
+        wait = self.bucket.reserve(self.max_wait)
+        if wait is not None and self.shared is not None:
+            try:
+                shared_wait = self.shared.reserve(self.max_wait - wait)
+                if shared_wait is None:
+                    self.bucket.refund()
+                wait = None if shared_wait is None else max(wait, shared_wait)
+            except Exception as e:
+                logger.warning(f"Shared rate limit unavailable for {self.name}, using local limit only: {e}")
+
+        if wait is None:
+            with self._lock:
+                self.rejected += 1
+            raise RateLimitExceededError(self.name)
+
+        if wait > 0:
+            with self._lock:
+                self.throttled_waits += 1
+                self.throttled_wait_seconds += wait
+        return wait
+
+    def _started(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self.calls += 1
+            self._recent_calls.append(now)
+            while self._recent_calls and self._recent_calls[0] < now - 60:
+                self._recent_calls.popleft()
+
+    def _finished(self, error: Optional[BaseException]) -> None:
+        throttled = error is not None and is_throttling_error(error)
+        if throttled:
+            with self._lock:
+                self.throttle_events += 1
+        self.concurrency.release(success=error is None, throttled=throttled)
+
+    def _reject_concurrency(self) -> None:
+        # The call never ran, so its token goes back. A shared window slot is
+        # not returned: after waiting for a free slot, its second has passed.
+        self.bucket.refund()
+        with self._lock:
+            self.rejected += 1
+        raise RateLimitExceededError(self.name)
+
+    @contextmanager
+    def limit(self):
+        """Gate one blocking call."""
+        time.sleep(self._reserve())
+        if not self.concurrency.acquire(self.max_wait):
+            self._reject_concurrency()
+        self._started()
+        try:
+            yield
+        except BaseException as e:
+            self._finished(e)
+            raise
+        else:
+            self._finished(None)
+
+    @asynccontextmanager
+    async def limit_async(self):
+        """Gate one awaited call without blocking the event loop."""
+        # The shared limiter talks to MongoDB, so reserve off the event loop
+        wait = await asyncio.to_thread(self._reserve) if self.shared else self._reserve()
+        await asyncio.sleep(wait)
+        if not await self.concurrency.acquire_async(self.max_wait):
+            self._reject_concurrency()
+        self._started()
+        try:
+            yield
+        except BaseException as e:
+            self._finished(e)
+            raise
+        else:
+            self._finished(None)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "configured_rate_per_second": self.bucket.rate,
+                "current_rate_per_second": round(len(self._recent_calls) / 60, 3),
+                "concurrency_limit": int(self.concurrency.limit),
+                "in_flight": self.concurrency.in_flight,
+                "calls": self.calls,
+                "throttled_waits": self.throttled_waits,
+                "throttled_wait_seconds": round(self.throttled_wait_seconds, 3),
+                "rejected": self.rejected,
+                "throttle_events": self.throttle_events,
+            }
+
+
+_limiters: Dict[str, ProviderLimiter] = {}
+
+
+def build_provider_limiter(
+    name: str,
+    rate_per_second: float,
+    burst: int,
+    collection_getter: Optional[Callable[[], Any]] = None,
+) -> ProviderLimiter:
+    """
+    Create the process-wide limiter for a provider from settings. With
+    RATE_LIMIT_SHARED, the quota is also enforced across processes via MongoDB.
+    """
+    shared = None
+    if settings.RATE_LIMIT_SHARED and collection_getter is not None:
+        shared = SharedWindowLimiter(name, rate_per_second, collection_getter)
+
+    limiter = ProviderLimiter(
+        name,
+        rate_per_second=rate_per_second,
+        burst=burst,
+        min_concurrency=settings.LLM_MIN_CONCURRENCY,
+        max_concurrency=settings.LLM_MAX_CONCURRENCY,
+        max_wait=settings.RATE_LIMIT_MAX_WAIT_SECONDS,
+        shared=shared,
+        initial_concurrency=settings.LLM_INITIAL_CONCURRENCY,
+    )
+    _limiters[name] = limiter
+    return limiter
+
+
+def rate_limiter_stats() -> Dict[str, Dict[str, float]]:
+    return {name: limiter.stats() for name, limiter in _limiters.items()}
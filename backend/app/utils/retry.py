@@ -0,0 +1,77 @@
+import logging
+from typing import Optional
+
+import httpx
+import requests
+from tenacity import retry, stop_after_attempt, wait_exponential_jitter, retry_if_exception, before_sleep_log
+
+from app.core.exceptions import AppError
+from app.utils.metrics import EXTERNAL_RETRIES
+
+# Statuses worth retrying: timeouts, rate limiting and transient server errors
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+THROTTLING_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def _status_code(exc: BaseException) -> Optional[int]:
+    """
+    HTTP status carried by an exception from requests, httpx or google-genai.
+    """
+    if isinstance(exc, AppError):
+        # Our own errors (misconfiguration, the local rate limiter's rejections, ...):
+        # their status is for the API response, not something the provider said
+        return None
+    response = getattr(exc, "response", None)
+    status = getattr(response, "status_code", None)
+    if isinstance(status, int):
+        return status
+    # google.genai.errors.APIError exposes the HTTP status as `code`
+    for attr in ("code", "status_code"):
+        value = getattr(exc, attr, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def is_retryable_error(exc: BaseException) -> bool:
+    """
+    Only transient failures are retried: network errors, timeouts, 429 and
+    5xx. Client errors (bad request, auth) and parsing errors are not.
+    """
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout, httpx.TransportError, ConnectionError, TimeoutError)):
+        return True
+    status = _status_code(exc)
+    return status in RETRYABLE_STATUS_CODES if status is not None else False
+
+
+def is_throttling_error(exc: BaseException) -> bool:
+    """
+    Errors that signal provider overload and should shrink our concurrency.
+    """
+    return _status_code(exc) in THROTTLING_STATUS_CODES
+
+
+def _count_and_log(logger: logging.Logger, provider: str):
+    log = before_sleep_log(logger, logging.WARNING)
+
+    def before_sleep(retry_state) -> None:
+        EXTERNAL_RETRIES.labels(provider=provider).inc()
+        log(retry_state)
+
+    return before_sleep
+
+
+def external_retry(logger: logging.Logger, provider: str = "unknown"):
+    """
+    Shared retry policy for external APIs: 3 attempts, exponential backoff
+    with jitter (so parallel workers don't retry in lockstep), retryable
+    errors only. Works for both sync and async functions. Each retry is
+    counted per `provider` in the metrics.
+    """
+    return retry(
+        stop=stop_after_attempt(3),
+        wait=wait_exponential_jitter(initial=2, max=10, jitter=2),
+        retry=retry_if_exception(is_retryable_error),
+        reraise=True,
+        before_sleep=_count_and_log(logger, provider)
+    )
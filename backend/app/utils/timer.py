@@ -1,10 +1,11 @@
 import time
 
 class Timer:
+    # perf_counter is monotonic, so clock adjustments cannot skew stage timings
     def __enter__(self):
-        self.start = time.time()
+        self.start = time.perf_counter()
         return self
-    
+
     def __exit__(self, *args):
-        self.end = time.time()
+        self.end = time.perf_counter()
         self.elapsed = self.end - self.start
@@ -1,5 +1,6 @@
 import asyncio
 import httpx
+import sys
 import time
 import random
 
@@ -63,9 +64,37 @@ async def run_concurrency_test():
             if not r["success"]:
                 print(f"Failed User {r['user_id']}: Status {r['status']}")
 
+async def run_refresh_coalescing_test():
+    """
+    Fire simultaneous refresh requests for the same user; all of them should
+    be coalesced into a single on-demand job (one pipeline run).
+    """
+    print(f"Starting Refresh Coalescing Test with {CONCURRENT_REQUESTS} simultaneous refreshes for User ID: {TEST_USER_ID}...")
+
+    async with httpx.AsyncClient(timeout=10.0) as client:
+        responses = await asyncio.gather(*[
+            client.post(f"{API_URL}/{TEST_USER_ID}/refresh") for _ in range(CONCURRENT_REQUESTS)
+        ])
+        job_ids = {r.json()["job_id"] for r in responses if r.status_code == 202}
+
+        print("\nTEST RESULTS")
+        print("=" * 30)
+        print(f"Total Requests: {len(responses)}")
+        print(f"Accepted:       {sum(1 for r in responses if r.status_code == 202)}")
+        print(f"Distinct Jobs:  {len(job_ids)}")
+        print("=" * 30)
+
+        # Long-poll until the shared job finishes
+        async with httpx.AsyncClient(timeout=120.0) as poller:
+            for job_id in job_ids:
+                response = await poller.get(f"{API_URL}/jobs/{job_id}", params={"wait": 60})
+                print(f"Job {job_id}: {response.json().get('status')}")
+
 if __name__ == "__main__":
     # Ensure the API is running before executing this
+    # Usage: python test_concurrency.py [refresh]
+    test = run_refresh_coalescing_test if "refresh" in sys.argv[1:] else run_concurrency_test
     try:
-        asyncio.run(run_concurrency_test())
+        asyncio.run(test())
     except KeyboardInterrupt:
         print("Test stopped.")
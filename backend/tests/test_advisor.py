@@ -0,0 +1,64 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from app.services.advisor import AdvisorService
+from app.utils.cache import TieredCache
+
+HOLDINGS = [{"name": "Alpha Flexi Cap Fund - Direct Growth", "category": "Equity: Flexi Cap"}]
+
+
+class ScriptedGemini:
+    """Answers each call with the next scripted response text."""
+
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.calls = 0
+        self.models = SimpleNamespace(generate_content=self._generate)
+        self.aio = SimpleNamespace(models=SimpleNamespace(generate_content=self._generate_async))
+
+    def _generate(self, model, contents, config=None):
+        self.calls += 1
+        return SimpleNamespace(text=self.answers.pop(0), usage_metadata=None)
+
+    async def _generate_async(self, model, contents, config=None):
+        return self._generate(model, contents, config)
+
+
+def _advisor(client):
+    advisor = AdvisorService()
+    advisor.client = client
+    advisor._config = object()
+    advisor.cache = TieredCache(name="test_advisor", maxsize=10, ttl_seconds=60)
+    return advisor
+
+
+@pytest.mark.parametrize("malformed", [
+    '["Alpha Fund", "Beta Fund"]',
+    '{"funds": ["Alpha Fund"]}',
+    '{"recommended_fund_names": "Alpha Fund"}',
+])
+def test_malformed_recommendation_is_not_cached(malformed):
+    valid = json.dumps({"recommended_fund_names": ["Beta Fund"]})
+    client = ScriptedGemini(malformed, valid)
+    advisor = _advisor(client)
+
+    assert advisor.recommend_fund_names(HOLDINGS) == {"recommended_fund_names": []}
+    # The identical portfolio asks Gemini again instead of getting the bad answer from the cache
+    assert advisor.recommend_fund_names(HOLDINGS) == {"recommended_fund_names": ["Beta Fund"]}
+    assert advisor.recommend_fund_names(HOLDINGS) == {"recommended_fund_names": ["Beta Fund"]}
+    assert client.calls == 2
+
+
+def test_malformed_enrichment_is_not_cached_async():
+    payload = {"user_fund_details": HOLDINGS, "recommended_funds": [{"name": "Beta Fund"}]}
+    valid = json.dumps({"user_fund_details": HOLDINGS, "recommendations": [{"name": "Beta Fund"}], "ranking": ["Beta Fund"]})
+    client = ScriptedGemini('{"recommendations": [{"name": "Beta Fund"}]}', valid)
+    advisor = _advisor(client)
+
+    assert asyncio.run(advisor.enrich_recommendations_async(payload)) is None
+    assert asyncio.run(advisor.enrich_recommendations_async(payload))["ranking"] == ["Beta Fund"]
+    assert asyncio.run(advisor.enrich_recommendations_async(payload))["ranking"] == ["Beta Fund"]
+    assert client.calls == 2
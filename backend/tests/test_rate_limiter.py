@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+from app.core.exceptions import RateLimitExceededError
+from app.utils.rate_limiter import AdaptiveConcurrencyLimiter, ProviderLimiter
+
+
+def _limiter(max_wait: float = 0.1) -> ProviderLimiter:
+    # One token a second and one concurrent call, so a held slot forces the concurrency timeout
+    return ProviderLimiter("test", rate_per_second=1, burst=1, min_concurrency=1, max_concurrency=1, max_wait=max_wait)
+
+
+def test_concurrency_rejection_refunds_the_token():
+    limiter = _limiter()
+    assert limiter.concurrency.try_acquire()
+
+    with pytest.raises(RateLimitExceededError):
+        with limiter.limit():
+            pass
+
+    assert limiter.stats()["rejected"] == 1
+    # Without the refund the bucket would be empty for most of a second
+    assert limiter.bucket.reserve(max_wait=0) == 0.0
+
+
+def test_concurrency_rejection_refunds_the_token_async():
+    limiter = _limiter()
+    assert limiter.concurrency.try_acquire()
+
+    async def call():
+        async with limiter.limit_async():
+            pass
+
+    with pytest.raises(RateLimitExceededError):
+        asyncio.run(call())
+    assert limiter.bucket.reserve(max_wait=0) == 0.0
+
+
+def test_concurrency_starts_low_and_grows_on_success():
+    limiter = ProviderLimiter("test", rate_per_second=0, burst=1, min_concurrency=1, max_concurrency=8,
+                              max_wait=1, initial_concurrency=2)
+    assert limiter.stats()["concurrency_limit"] == 2
+
+    for _ in range(20):
+        with limiter.limit():
+            pass
+    assert limiter.stats()["concurrency_limit"] > 2
+
+
+def test_throttling_halves_the_limit():
+    concurrency = AdaptiveConcurrencyLimiter(initial=8, minimum=1, maximum=16)
+    assert concurrency.try_acquire()
+    concurrency.release(success=False, throttled=True)
+    assert concurrency.limit == 4